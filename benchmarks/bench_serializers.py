@@ -0,0 +1,88 @@
+"""
+Throughput benchmark of the phenotype serializers (text/csv, text/plink2 and text/bgenie). Chunks of random
+data are serialized as the REST API does it, and compared with the previous approach (one StringIO per chunk).
+No database is needed.
+
+Usage:
+    python -m benchmarks.bench_serializers --n-samples 500000 --n-columns 20
+"""
+from io import StringIO
+
+import numpy as np
+import pandas as pd
+
+from benchmarks.common import get_argparse_arguments, time_it, write_results
+from ukbrest.config import logger
+from ukbrest.resources.formats import CSVSerializer, Plink2Serializer, BgenieSerializer
+
+
+SERIALIZERS = {
+    'text/csv': CSVSerializer,
+    'text/plink2': Plink2Serializer,
+    'text/bgenie': BgenieSerializer,
+}
+
+
+def _get_chunks(n_samples, n_columns, chunksize):
+    """
+    Returns a list of DataFrames with text values, like the ones returned by Pheno2SQL.
+    """
+    random_state = np.random.RandomState(0)
+
+    data = pd.DataFrame(
+        random_state.normal(size=(n_samples, n_columns)).round(5).astype(str),
+        index=pd.Index(np.arange(1000000, 1000000 + n_samples), name='eid'),
+        columns=['c{}_0_0'.format(i) for i in range(n_columns)],
+    )
+    data.iloc[::7, 0] = None
+
+    return [data.iloc[i:i + chunksize] for i in range(0, n_samples, chunksize)]
+
+
+def _string_io_generator(all_data, data_conversion_func, **kwargs):
+    for row_idx, row in enumerate(all_data):
+        f = StringIO()
+        data_conversion_func(row, f, header=(row_idx == 0), **kwargs)
+
+        yield f.getvalue().encode('utf-8')
+
+
+if __name__ == '__main__':
+    parser = get_argparse_arguments('Benchmark of phenotype serializers', db_uri_required=False)
+    parser.add_argument('--n-samples', type=int, default=500000)
+    parser.add_argument('--n-columns', type=int, default=20)
+    parser.add_argument('--chunksize', type=int, default=5000, help='Rows of each chunk (like UKBREST_SQL_CHUNKSIZE)')
+
+    args = parser.parse_args()
+
+    chunks = _get_chunks(args.n_samples, args.n_columns, args.chunksize)
+
+    results = []
+
+    for format_name, serializer_class in sorted(SERIALIZERS.items()):
+        serializer = serializer_class()
+
+        for generator_name, generator in (('string_io', _string_io_generator), ('buffer', serializer.data_generator)):
+            n_bytes = []
+
+            def run():
+                # serializers may modify chunks in place, as they are not used again in the API
+                n_bytes.append(sum(len(block) for block in generator(
+                    (c.copy() for c in chunks), serializer.serialize, na_rep='NA'
+                )))
+
+            elapsed_time = time_it(run, args.repeat)
+            throughput = n_bytes[-1] / elapsed_time / (1024 ** 2)
+
+            logger.info('{} ({}): {:.3f} s, {:.1f} MB/s'.format(format_name, generator_name, elapsed_time, throughput))
+
+            results.append({
+                'case': '{}_{}'.format(format_name.split('/')[1], generator_name),
+                'n_samples': args.n_samples,
+                'n_columns': args.n_columns,
+                'time': elapsed_time,
+                'bytes': n_bytes[-1],
+                'mb_per_second': throughput,
+            })
+
+    write_results(results, args.output_file)
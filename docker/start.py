@@ -124,7 +124,7 @@ if __name__ == '__main__':
         _setup_phenotype_path()
         _setup_db_uri()
 
-        commands = ('python', ['python', '/opt/ukbrest/load_data.py'])
+        commands = ('python', ['python', '/opt/ukbrest/load_data.py'] + unknown_args)
 
     elif args.load_sql:
         _setup_db_uri()
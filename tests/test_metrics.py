@@ -0,0 +1,37 @@
+import unittest
+
+from ukbrest.common.utils.metrics import MetricsRegistry, get_server_timing
+
+
+class MetricsTest(unittest.TestCase):
+    def test_histogram_render(self):
+        # Prepare
+        metrics = MetricsRegistry()
+
+        # Run
+        metrics.observe('ukbrest_stage_seconds', 0.003, {'stage': 'sql'})
+        metrics.observe('ukbrest_stage_seconds', 0.01, {'stage': 'sql'})
+        metrics.observe('ukbrest_stage_seconds', 1000, {'stage': 'sql'})
+        metrics.inc('ukbrest_rows_total', 10)
+        metrics.inc('ukbrest_rows_total', 5)
+
+        rendered = metrics.render({'ukbrest_db_pool_size': 5, 'ukbrest_prepared_statements_hit_rate': None})
+
+        # Validate
+        lines = rendered.splitlines()
+        assert 'ukbrest_stage_seconds_bucket{stage="sql",le="0.005"} 1' in lines
+        assert 'ukbrest_stage_seconds_bucket{stage="sql",le="0.01"} 2' in lines
+        assert 'ukbrest_stage_seconds_bucket{stage="sql",le="300.0"} 2' in lines
+        assert 'ukbrest_stage_seconds_bucket{stage="sql",le="+Inf"} 3' in lines
+        assert 'ukbrest_stage_seconds_count{stage="sql"} 3' in lines
+        assert 'ukbrest_rows_total 15' in lines
+        assert 'ukbrest_db_pool_size 5' in lines
+        assert not any(l.startswith('ukbrest_prepared_statements_hit_rate') for l in lines)
+
+    def test_server_timing(self):
+        # Prepare
+        # Run
+        server_timing = get_server_timing({'sql': 0.0123, 'auth': 0.002})
+
+        # Validate
+        assert server_timing == 'auth;dur=2.0, sql;dur=12.3', server_timing
@@ -1,6 +1,8 @@
+import json
 import os
 import tempfile
 import unittest
+from unittest.mock import patch
 
 import numpy as np
 import pandas as pd
@@ -9,6 +11,7 @@ from sqlalchemy import create_engine
 from tests.settings import POSTGRESQL_ENGINE, SQLITE_ENGINE
 from tests.utils import get_repository_path, DBTest
 from ukbrest.common.pheno2sql import Pheno2SQL
+from ukbrest.resources.exceptions import UkbRestSQLExecutionError
 
 
 class Pheno2SQLTest(DBTest):
@@ -361,6 +364,247 @@ class Pheno2SQLTest(DBTest):
         assert tmp.loc['c47_0_0', 'table_name'] == 'ukb_pheno_0_02'
         assert tmp.loc['c48_0_0', 'table_name'] == 'ukb_pheno_0_02'
 
+    def test_postgresql_load_profile(self):
+        # Prepare
+        csv_file = get_repository_path('pheno2sql/example01.csv')
+        db_engine = POSTGRESQL_ENGINE
+        profile_file = tempfile.mktemp(suffix='.json')
+
+        p2sql = Pheno2SQL(csv_file, db_engine, n_columns_per_table=3, load_profile_file=profile_file)
+
+        # Run
+        p2sql.load_data()
+
+        # Validate
+        assert os.path.isfile(profile_file)
+
+        with open(profile_file, 'r') as f:
+            profile = json.load(f)
+
+        assert profile['total_time'] > 0
+
+        stages = [s['stage'] for s in profile['stages']]
+        assert stages[:3] == ['create_tables_schema', 'create_temporary_csvs', 'load_csv'], stages
+        assert 'load_events' in stages
+        assert 'create_constraints' in stages
+
+        csvs_units = [u for u in profile['units'] if u['stage'] == 'create_temporary_csvs']
+        assert len(csvs_units) == 3
+        assert all(u['rows'] == 2 for u in csvs_units)
+        assert all(u['temp_bytes_written'] > 0 for u in csvs_units)
+        assert all(u['peak_rss'] > 0 for u in csvs_units)
+
+        load_units = [u for u in profile['units'] if u['stage'] == 'load_csv']
+        assert len(load_units) == 3
+        assert all(u['rows'] == 2 for u in load_units)
+
+        assert profile['summary']['load_csv']['rows'] == 6
+        assert profile['summary']['create_temporary_csvs']['max_worker_peak_rss'] > 0
+
+    def test_postgresql_load_resume(self):
+        # Prepare
+        csv_file = get_repository_path('pheno2sql/example01.csv')
+        db_engine = POSTGRESQL_ENGINE
+
+        p2sql = Pheno2SQL(csv_file, db_engine, n_columns_per_table=3, loading_n_jobs=1)
+
+        with patch.object(Pheno2SQL, '_load_events', side_effect=UkbRestSQLExecutionError('events failed')):
+            with self.assertRaises(UkbRestSQLExecutionError):
+                p2sql.load_data()
+
+        checkpoints = pd.read_sql('select unit from ukbrest_load_checkpoints', create_engine(db_engine))
+        units = set(checkpoints['unit'])
+        assert 'schema:0' in units
+        assert 'temp_csv:ukb_pheno_0_00' in units
+        assert 'copy:ukb_pheno_0_02' in units
+        assert 'all_eids' in units
+        assert 'events' not in units
+
+        # Run
+        p2sql = Pheno2SQL(csv_file, db_engine, n_columns_per_table=3, loading_n_jobs=1)
+
+        with patch.object(Pheno2SQL, '_save_column_range') as save_column_range, \
+                patch.object(Pheno2SQL, '_load_single_csv') as load_single_csv:
+            p2sql.load_data(resume=True)
+
+        # Validate
+        assert not save_column_range.called
+        assert not load_single_csv.called
+
+        checkpoints = pd.read_sql('select unit from ukbrest_load_checkpoints', create_engine(db_engine))
+        units = set(checkpoints['unit'])
+        assert 'events' in units
+        assert 'constraints' in units
+
+        tmp = pd.read_sql('select * from ukb_pheno_0_00', create_engine(db_engine), index_col='eid')
+        assert tmp.shape[0] == 2
+
+        query_result = next(p2sql.query(['c21_0_0', 'c48_0_0']))
+        assert query_result.shape == (2, 2)
+
+        # a new load (not resumed) starts from the beginning
+        p2sql.load_data()
+
+        checkpoints = pd.read_sql('select unit from ukbrest_load_checkpoints', create_engine(db_engine))
+        assert 'temp_csv:ukb_pheno_0_00' in set(checkpoints['unit'])
+
+    def test_postgresql_load_constraints_after_data(self):
+        # Prepare
+        csv_file = get_repository_path('pheno2sql/example01.csv')
+        db_engine = POSTGRESQL_ENGINE
+
+        p2sql = Pheno2SQL(csv_file, db_engine, n_columns_per_table=3, loading_n_jobs=2, maintenance_work_mem='96MB')
+
+        with patch.object(Pheno2SQL, '_create_constraints', side_effect=UkbRestSQLExecutionError('constraints failed')):
+            with self.assertRaises(UkbRestSQLExecutionError):
+                p2sql.load_data()
+
+        # primary keys are not created before data is loaded
+        for table_name in ('ukb_pheno_0_00', 'ukb_pheno_0_01', 'ukb_pheno_0_02', 'events'):
+            constraint_sql = self._get_table_contrains(table_name, relationship_query='pk_%%')
+            constraints_results = pd.read_sql(constraint_sql, create_engine(db_engine))
+            assert constraints_results.empty, table_name
+
+        tmp = pd.read_sql('select * from ukb_pheno_0_00', create_engine(db_engine))
+        assert tmp.shape[0] == 2
+
+        # Run
+        p2sql = Pheno2SQL(csv_file, db_engine, n_columns_per_table=3, loading_n_jobs=2, maintenance_work_mem='96MB')
+        p2sql.load_data(resume=True)
+
+        # Validate
+        for table_name in ('ukb_pheno_0_00', 'ukb_pheno_0_01', 'ukb_pheno_0_02'):
+            constraint_sql = self._get_table_contrains(table_name, column_query='eid', relationship_query='pk_%%')
+            constraints_results = pd.read_sql(constraint_sql, create_engine(db_engine))
+            assert not constraints_results.empty, table_name
+
+            # the index created by pandas is removed
+            constraint_sql = self._get_table_contrains(table_name, relationship_query='ix_%%')
+            constraints_results = pd.read_sql(constraint_sql, create_engine(db_engine))
+            assert constraints_results.empty, table_name
+
+        constraint_sql = self._get_table_contrains('events', relationship_query='pk_%%')
+        constraints_results = pd.read_sql(constraint_sql, create_engine(db_engine))
+        assert len(constraints_results['column_name'].tolist()) == 4
+
+        constraint_sql = self._get_table_contrains('fields', relationship_query='ix_%%')
+        constraints_results = pd.read_sql(constraint_sql, create_engine(db_engine))
+        assert len(constraints_results['index_name'].unique()) == 6
+
+        # the session setting is not kept in pooled connections
+        with p2sql._get_db_engine().connect() as conn:
+            assert conn.execute('show maintenance_work_mem').scalar() != '96MB'
+
+    def test_postgresql_bulk_load(self):
+        # Prepare
+        csv_file = get_repository_path('pheno2sql/example01.csv')
+        db_engine = POSTGRESQL_ENGINE
+
+        def get_persistence(table_name):
+            return pd.read_sql(
+                "select relpersistence from pg_class where relname = '{}'".format(table_name), create_engine(db_engine)
+            ).iloc[0, 0]
+
+        p2sql = Pheno2SQL(csv_file, db_engine, n_columns_per_table=3, loading_n_jobs=1, bulk_load=True)
+
+        with patch.object(Pheno2SQL, '_create_constraints', side_effect=UkbRestSQLExecutionError('constraints failed')):
+            with self.assertRaises(UkbRestSQLExecutionError):
+                p2sql.load_data()
+
+        for table_name in ('ukb_pheno_0_00', 'ukb_pheno_0_01', 'ukb_pheno_0_02', 'events'):
+            assert get_persistence(table_name) == 'u', table_name
+
+        # simulate a database crash, which empties unlogged tables
+        with create_engine(db_engine).connect() as conn:
+            conn.execute('TRUNCATE ukb_pheno_0_01')
+
+        # Run
+        p2sql = Pheno2SQL(csv_file, db_engine, n_columns_per_table=3, loading_n_jobs=1, bulk_load=True)
+        p2sql.load_data(resume=True)
+
+        # Validate
+        for table_name in ('ukb_pheno_0_00', 'ukb_pheno_0_01', 'ukb_pheno_0_02', 'events'):
+            assert get_persistence(table_name) == 'p', table_name
+
+        tmp = pd.read_sql('select * from ukb_pheno_0_01', create_engine(db_engine))
+        assert tmp.shape[0] == 2
+
+        checkpoints = pd.read_sql('select unit from ukbrest_load_checkpoints', create_engine(db_engine))
+        assert 'set_logged' in set(checkpoints['unit'])
+
+        query_result = next(p2sql.query(['c21_0_0', 'c48_0_0']))
+        assert query_result.shape == (2, 2)
+
+    def test_postgresql_load_blue_green(self):
+        # Prepare
+        csv_file = get_repository_path('pheno2sql/example01.csv')
+        db_engine = POSTGRESQL_ENGINE
+
+        p2sql = Pheno2SQL(csv_file, db_engine, n_columns_per_table=3, loading_n_jobs=1, blue_green=True)
+
+        def get_schemas():
+            return pd.read_sql('select name, status from ukbrest_schemas order by created_at', create_engine(db_engine))
+
+        # Run
+        p2sql.load_data()
+
+        # Validate
+        schemas = get_schemas()
+        assert schemas.shape[0] == 1
+        first_schema = schemas.loc[0, 'name']
+        assert first_schema.startswith('ukbrest_data_')
+        assert schemas.loc[0, 'status'] == 'active'
+
+        ## tables are not created in the public schema
+        table = pd.read_sql("SELECT EXISTS (SELECT 1 FROM pg_tables WHERE schemaname = 'public' AND tablename = 'ukb_pheno_0_00');", create_engine(db_engine))
+        assert not table.iloc[0, 0]
+
+        table = pd.read_sql("SELECT EXISTS (SELECT 1 FROM pg_tables WHERE schemaname = '{}' AND tablename = 'ukb_pheno_0_00');".format(first_schema), create_engine(db_engine))
+        assert table.iloc[0, 0]
+
+        query_result = next(p2sql.query(['c21_0_0', 'c48_0_0']))
+        assert query_result.shape == (2, 2)
+
+        ## a failed load does not change the active schema
+        with patch.object(Pheno2SQL, '_load_events', side_effect=UkbRestSQLExecutionError('events failed')):
+            with self.assertRaises(UkbRestSQLExecutionError):
+                p2sql.load_data()
+
+        schemas = get_schemas()
+        assert schemas.shape[0] == 2
+        assert schemas.loc[0, 'status'] == 'active'
+        assert schemas.loc[1, 'status'] == 'loading'
+
+        query_result = next(p2sql.query(['c21_0_0', 'c48_0_0']))
+        assert query_result.shape == (2, 2)
+
+        ## a new load replaces the schema of the failed one and becomes the active schema
+        p2sql.load_data()
+
+        schemas = get_schemas()
+        assert schemas.shape[0] == 2
+        assert schemas.loc[0, 'name'] == first_schema
+        assert schemas.loc[0, 'status'] == 'retired'
+        assert schemas.loc[1, 'status'] == 'active'
+
+        new_p2sql = Pheno2SQL(csv_file, db_engine, n_columns_per_table=3, loading_n_jobs=1, blue_green=True)
+        assert new_p2sql._get_active_schema() == schemas.loc[1, 'name']
+
+        query_result = next(new_p2sql.query(['c21_0_0', 'c48_0_0']))
+        assert query_result.shape == (2, 2)
+
+        ## only the last retired schema is kept
+        p2sql.load_data()
+
+        schemas = get_schemas()
+        assert schemas.shape[0] == 2
+        assert first_schema not in set(schemas['name'])
+        assert schemas.loc[0, 'status'] == 'retired'
+        assert schemas.loc[1, 'status'] == 'active'
+
+        schema_exists = pd.read_sql("SELECT EXISTS (SELECT 1 FROM pg_namespace WHERE nspname = '{}');".format(first_schema), create_engine(db_engine))
+        assert not schema_exists.iloc[0, 0]
+
     def test_postgresql_auxiliary_table_is_created_and_has_minimum_data_required(self):
         # Prepare
         csv_file = get_repository_path('pheno2sql/example01.csv')
@@ -1567,6 +1811,37 @@ class Pheno2SQLTest(DBTest):
         assert 1000061 in all_eids.index
         assert 1000070 in all_eids.index
 
+    def test_postgresql_all_eids_table_resume(self):
+        # Prepare
+        directory = get_repository_path('pheno2sql/example14')
+
+        csv_file1 = get_repository_path(os.path.join(directory, 'example14_00.csv'))
+        csv_file2 = get_repository_path(os.path.join(directory, 'example14_01.csv'))
+        db_engine = POSTGRESQL_ENGINE
+
+        p2sql = Pheno2SQL((csv_file1, csv_file2), db_engine, n_columns_per_table=2, loading_n_jobs=1)
+
+        with patch.object(Pheno2SQL, '_load_all_eids', side_effect=UkbRestSQLExecutionError('all_eids failed')):
+            with self.assertRaises(UkbRestSQLExecutionError):
+                p2sql.load_data()
+
+        # Run
+        p2sql = Pheno2SQL((csv_file1, csv_file2), db_engine, n_columns_per_table=2, loading_n_jobs=1)
+
+        # temporary CSV files are not written again, so eids are read from the CSV files
+        with patch.object(Pheno2SQL, '_save_column_range') as save_column_range:
+            p2sql.load_data(resume=True)
+
+        # Validate
+        assert not save_column_range.called
+
+        all_eids = pd.read_sql('select * from all_eids', create_engine(db_engine), index_col='eid')
+        assert len(all_eids.index) == 6 + 4, len(all_eids.index)
+        assert all_eids.index.is_unique
+        assert 1000010 in all_eids.index
+        assert 1000021 in all_eids.index
+        assert 1000070 in all_eids.index
+
     def test_postgresql_all_eids_table_constraints(self):
         # Prepare
         directory = get_repository_path('pheno2sql/example14')
@@ -2227,4 +2502,290 @@ class Pheno2SQLTest(DBTest):
         assert query_result.loc[1000040, 'c47_0_0'] == 5.20832
         assert pd.isnull(query_result.loc[1000050, 'c47_0_0'])
         assert query_result.loc[1000060, 'c47_0_0'] == 0.55478
-        assert pd.isnull(query_result.loc[1000070, 'c47_0_0'])
\ No newline at end of file
+        assert pd.isnull(query_result.loc[1000070, 'c47_0_0'])
+
+    def test_postgresql_load_data_with_layout_plan(self):
+        # Prepare
+        csv_file = get_repository_path('pheno2sql/example01.csv')
+        db_engine = POSTGRESQL_ENGINE
+
+        layout_plan = [['c21_0_0', 'c47_0_0'], ['c48_0_0']]
+
+        p2sql = Pheno2SQL(csv_file, db_engine, n_columns_per_table=3, layout_plan=layout_plan)
+
+        # Run
+        p2sql.load_data()
+
+        # Validate
+        ## Co-accessed columns are in the same table, the rest keep their order
+        tmp = pd.read_sql('select * from ukb_pheno_0_00', create_engine(db_engine))
+        expected_columns = ["eid", "c21_0_0", "c47_0_0", "c48_0_0"]
+        assert len(tmp.columns) == len(expected_columns)
+        assert all(x in expected_columns for x in tmp.columns)
+
+        tmp = pd.read_sql('select * from ukb_pheno_0_01', create_engine(db_engine))
+        expected_columns = ["eid", "c21_1_0", "c21_2_0", "c31_0_0"]
+        assert len(tmp.columns) == len(expected_columns)
+        assert all(x in expected_columns for x in tmp.columns)
+
+        tmp = pd.read_sql('select * from ukb_pheno_0_02', create_engine(db_engine))
+        expected_columns = ["eid", "c34_0_0", "c46_0_0"]
+        assert len(tmp.columns) == len(expected_columns)
+        assert all(x in expected_columns for x in tmp.columns)
+
+        ## Check fields table points to the right tables
+        tmp = pd.read_sql('select column_name, table_name from fields', create_engine(db_engine), index_col='column_name')
+        assert tmp.loc['c21_0_0', 'table_name'] == 'ukb_pheno_0_00'
+        assert tmp.loc['c47_0_0', 'table_name'] == 'ukb_pheno_0_00'
+        assert tmp.loc['c48_0_0', 'table_name'] == 'ukb_pheno_0_00'
+        assert tmp.loc['c21_1_0', 'table_name'] == 'ukb_pheno_0_01'
+        assert tmp.loc['c46_0_0', 'table_name'] == 'ukb_pheno_0_02'
+
+        ## Check data is correct
+        query_result = next(p2sql.query(['c21_0_0', 'c47_0_0', 'c48_0_0']))
+        assert query_result.shape[0] == 2
+        assert query_result.loc[1, 'c21_0_0'] == 'Option number 1'
+        assert query_result.loc[1, 'c47_0_0'].round(5) == 45.55412
+        assert query_result.loc[2, 'c48_0_0'].strftime('%Y-%m-%d') == '2010-03-29'
+
+    def test_create_eid_joins_same_csv_file(self):
+        # Prepare
+        p2sql = Pheno2SQL(get_repository_path('pheno2sql/example01.csv'), POSTGRESQL_ENGINE)
+
+        tables = ['ukb_pheno_0_00', 'ukb_pheno_0_01', 'ukb_pheno_0_02']
+
+        # Run
+        joins_sql, eids_condition = p2sql._create_eid_joins(p2sql._group_tables_by_eids(tables))
+
+        # Validate
+        assert eids_condition is None
+        assert 'full outer join' not in joins_sql
+        assert 'all_eids' not in joins_sql
+        assert joins_sql.count('inner join') == 2
+
+    def test_create_eid_joins_different_csv_files(self):
+        # Prepare
+        p2sql = Pheno2SQL(get_repository_path('pheno2sql/example01.csv'), POSTGRESQL_ENGINE)
+
+        tables = ['ukb_pheno_0_00', 'ukb_pheno_1_00', 'ukb_pheno_0_01', 'samples_data']
+
+        # Run
+        groups = p2sql._group_tables_by_eids(tables)
+        joins_sql, eids_condition = p2sql._create_eid_joins(groups)
+
+        # Validate
+        assert len(groups) == 3
+        assert joins_sql.startswith('all_eids ')
+        assert joins_sql.count('left outer join') == 4
+        assert 'full outer join' not in joins_sql
+        assert eids_condition == 'ukb_pheno_0_00.eid is not null or ukb_pheno_1_00.eid is not null or samples_data.eid is not null'
+
+    def test_postgresql_two_csv_files_query_multiple_tables_with_filter(self):
+        # Prepare
+        csv01 = get_repository_path('pheno2sql/example08_01.csv')
+        csv02 = get_repository_path('pheno2sql/example08_02.csv')
+        db_engine = POSTGRESQL_ENGINE
+
+        p2sql = Pheno2SQL((csv01, csv02), db_engine, n_columns_per_table=2)
+        p2sql.load_data()
+
+        # Run
+        columns = ['c21_0_0', 'c47_0_0', 'c110_0_0']
+        filterings = ['c47_0_0 > 0']
+
+        query_result = next(p2sql.query(columns, filterings=filterings))
+
+        # Validate
+        assert query_result.index.name == 'eid'
+        assert len(query_result.columns) == len(columns)
+        assert all(x in columns for x in query_result.columns)
+
+        assert query_result.shape[0] == 2
+        assert query_result.loc[1, 'c21_0_0'] == 'Option number 1'
+        assert query_result.loc[1, 'c47_0_0'].round(5) == 41.55312
+        assert query_result.loc[1, 'c110_0_0'].round(5) == 42.55312
+        assert query_result.loc[4, 'c21_0_0'] == 'Option number 4'
+        assert query_result.loc[4, 'c47_0_0'].round(5) == 5.20832
+        assert pd.isnull(query_result.loc[4, 'c110_0_0'])
+
+    def test_rewrite_not_in_subqueries(self):
+        # Prepare
+        p2sql = Pheno2SQL(get_repository_path('pheno2sql/example01.csv'), POSTGRESQL_ENGINE, rewrite_not_in=True)
+
+        filters = [
+            'eid not in (select eid from withdrawals)',
+            "c21_0_0 = 'a' and EID NOT IN (select distinct eid from events where event in ('(', 'J45'))",
+            'eid not in (1, 2, 3)',
+            'aet.eid not in (select eid from withdrawals)',
+        ]
+
+        # Run
+        rewritten = [p2sql._rewrite_not_in_subqueries(f, 'all_eids.eid') for f in filters]
+
+        # Validate
+        assert rewritten[0] == 'not exists (select 1 from (select eid from withdrawals) nx where nx.eid = all_eids.eid)'
+        assert rewritten[1] == "c21_0_0 = 'a' and not exists (select 1 from (select distinct eid from events " \
+                               "where event in ('(', 'J45')) nx where nx.eid = all_eids.eid)"
+        # not a subquery
+        assert rewritten[2] == filters[2]
+        # already qualified, not changed
+        assert rewritten[3] == filters[3]
+
+    def test_postgresql_query_filter_not_in_rewritten(self):
+        # Prepare
+        csv_file = get_repository_path('pheno2sql/example02.csv')
+        db_engine = POSTGRESQL_ENGINE
+
+        p2sql = Pheno2SQL(csv_file, db_engine, n_columns_per_table=2, rewrite_not_in=True)
+        p2sql.load_data()
+
+        # Run
+        columns = ['c21_0_0', 'c48_0_0']
+        filterings = ['eid not in (select eid from all_eids where eid in (1, 3))']
+
+        query_result = next(p2sql.query(columns, filterings=filterings))
+
+        # Validate
+        assert query_result.shape[0] == 2
+        assert all(x in query_result.index for x in (2, 4))
+        assert query_result.loc[2, 'c21_0_0'] == 'Option number 2'
+        assert query_result.loc[4, 'c21_0_0'] == 'Option number 4'
+
+    def test_get_statements_template(self):
+        # Prepare
+        p2sql = Pheno2SQL(None, POSTGRESQL_ENGINE)
+
+        statements = [
+            'c21003_0_0 > 40',
+            "c21_0_0 = 'it''s > 3'",
+            'c47_0_0 in (1, 2)',
+            "c34_0_0>=-1.5 and lower(c21_2_0) <> 'a=1'",
+            'c34_0_0 < 1e3 and c46_0_0 = 99999999999999999999',
+        ]
+
+        # Run
+        templates, values = p2sql._get_statements_template(statements)
+
+        # Validate
+        assert templates == [
+            'c21003_0_0 > $1::bigint',
+            'c21_0_0 = $2',
+            'c47_0_0 in (1, 2)',
+            'c34_0_0>=$3::numeric and lower(c21_2_0) <> $4',
+            'c34_0_0 < $5::numeric and c46_0_0 = $6::numeric',
+        ], templates
+        assert values == ['40', "it's > 3", '-1.5', 'a=1', '1e3', '99999999999999999999'], values
+
+    def test_postgresql_query_prepared_statements(self):
+        # Prepare
+        csv_file = get_repository_path('pheno2sql/example02.csv')
+        db_engine = POSTGRESQL_ENGINE
+
+        p2sql = Pheno2SQL(csv_file, db_engine, n_columns_per_table=2, prepared_statements=True)
+        p2sql.load_data()
+
+        columns = ['c21_0_0', 'c48_0_0']
+
+        # Run
+        query_result = next(p2sql.query(columns, filterings=['c47_0_0 > 0']))
+        query_result_other_constant = next(p2sql.query(columns, filterings=['c47_0_0 > -20']))
+
+        # Validate
+        assert query_result.shape[0] == 2
+        assert all(x in query_result.index for x in (1, 4))
+
+        assert query_result_other_constant.shape[0] == 4
+        assert all(x in query_result_other_constant.index for x in (1, 2, 3, 4))
+
+        stats = p2sql.get_prepared_statements_stats()
+        assert stats['hits'] + stats['misses'] == 2
+
+    def test_postgresql_prepare_statement_reused_in_connection(self):
+        # Prepare
+        csv_file = get_repository_path('pheno2sql/example02.csv')
+        db_engine = POSTGRESQL_ENGINE
+
+        p2sql = Pheno2SQL(csv_file, db_engine, n_columns_per_table=2, prepared_statements=True)
+        p2sql.load_data()
+
+        sql_query = 'select eid from all_eids where eid > $1::bigint order by eid'
+
+        # Run
+        with p2sql._get_db_engine().connect() as conn:
+            execute_sql, parameters = p2sql._prepare_statement(conn, sql_query, ['1'])
+            execute_sql_other, parameters_other = p2sql._prepare_statement(conn, sql_query, ['2'])
+
+            results = [r[0] for r in conn.execute(execute_sql_other, parameters_other).fetchall()]
+
+        # Validate
+        assert execute_sql == execute_sql_other
+        assert parameters == {'p0': '1'}
+        assert results == [3, 4]
+
+        stats = p2sql.get_prepared_statements_stats()
+        assert stats['hits'] == 1
+        assert stats['misses'] == 1
+        assert stats['hit_rate'] == 0.5
+
+    def test_postgresql_data_generation_cached(self):
+        # Prepare
+        csv_file = get_repository_path('pheno2sql/example02.csv')
+        db_engine = POSTGRESQL_ENGINE
+
+        p2sql = Pheno2SQL(csv_file, db_engine, n_columns_per_table=2, loading_n_jobs=1)
+        p2sql.load_data()
+
+        data_generation = p2sql._get_data_generation()
+        assert data_generation != ''
+
+        # Run
+        Pheno2SQL(None, db_engine)._update_data_generation()
+
+        # Validate
+        ## the data generation is not read again until the check interval has passed
+        assert p2sql._get_data_generation() == data_generation
+
+        with patch.object(Pheno2SQL, 'DATA_GENERATION_CHECK_INTERVAL', 0):
+            new_data_generation = p2sql._get_data_generation()
+
+        assert new_data_generation not in ('', data_generation)
+
+        ## updates made by the same object are seen immediately
+        p2sql._update_data_generation()
+        assert p2sql._get_data_generation() not in ('', data_generation, new_data_generation)
+
+    def test_postgresql_db_engine_shared_by_instances(self):
+        # Prepare
+        p2sql = Pheno2SQL(None, POSTGRESQL_ENGINE)
+        p2sql_other = Pheno2SQL(None, POSTGRESQL_ENGINE)
+
+        # Run
+        with p2sql._get_db_engine().connect() as conn:
+            assert conn.execute('select 1').scalar() == 1
+
+        pool_stats = p2sql_other.get_db_pool_stats()
+
+        # Validate
+        assert p2sql._get_db_engine() is p2sql_other._get_db_engine()
+
+        assert pool_stats['pool_class'] == 'QueuePool'
+        assert pool_stats['size'] == 10
+        assert pool_stats['checkedout'] == 0
+        assert pool_stats['connections_created'] >= 1
+        assert pool_stats['checkouts'] >= 1
+
+    def test_postgresql_db_engine_external_pool(self):
+        # Prepare
+        pool_parameters = {'external_pool': True}
+
+        p2sql_default_pool = Pheno2SQL(None, POSTGRESQL_ENGINE)
+        assert p2sql_default_pool.get_db_pool_stats()['pool_class'] == 'QueuePool'
+
+        # Run
+        p2sql = Pheno2SQL(None, POSTGRESQL_ENGINE, db_pool_parameters=pool_parameters, prepared_statements=True)
+
+        # Validate
+        assert p2sql.get_db_pool_stats()['pool_class'] == 'NullPool'
+        assert not p2sql._use_prepared_statements()
+
+        assert p2sql._get_db_engine() is not p2sql_default_pool._get_db_engine()
@@ -271,6 +271,58 @@ class PostloaderTest(DBTest):
         tables = vacuum_data['relname'].tolist()
         assert 'codings' in tables
 
+    def test_postload_codings_closure(self):
+        # prepare
+        directory = get_repository_path('postloader/codings03_tree')
+
+        # run
+        pl = Postloader(POSTGRESQL_ENGINE)
+        pl.load_codings(directory)
+
+        # Validate
+        db_engine = create_engine(POSTGRESQL_ENGINE)
+
+        closure = pd.read_sql("""
+            select coding, depth from codings_closure
+            where data_coding = 6 and ancestor_coding = '1065'
+            order by coding
+        """, db_engine)
+
+        assert closure.shape[0] == 3
+        assert closure['coding'].tolist() == ['1065', '1072', '1073']
+        assert closure['depth'].tolist() == [0, 1, 1]
+
+        # cardiovascular (node 1071) has hypertension and its children under it (depth 2)
+        closure = pd.read_sql("""
+            select coding, depth from codings_closure
+            where data_coding = 6 and ancestor_node_id = 1071 and coding in ('1065', '1072')
+            order by coding
+        """, db_engine)
+
+        assert closure['depth'].tolist() == [1, 2]
+
+        # non-hierarchical codings are not included
+        closure = pd.read_sql("select count(*) as n from codings_closure where data_coding = 7", db_engine)
+        assert closure.loc[0, 'n'] == 0
+
+    def test_postload_withdrawals(self):
+        # prepare
+        directory = get_repository_path('postloader/withdrawals01')
+
+        # run
+        pl = Postloader(POSTGRESQL_ENGINE)
+        pl.load_withdrawals(directory)
+
+        # validate
+        withdrawals = pd.read_sql('select eid from withdrawals order by eid', create_engine(POSTGRESQL_ENGINE))
+        assert withdrawals['eid'].tolist() == [1000010, 1000020, 1000030, 1000040]
+
+        # loading the same files again does not add anything
+        pl.load_withdrawals(directory)
+
+        withdrawals = pd.read_sql('select eid from withdrawals order by eid', create_engine(POSTGRESQL_ENGINE))
+        assert withdrawals['eid'].tolist() == [1000010, 1000020, 1000030, 1000040]
+
     def test_postload_load_samples_data_one_file(self):
         # prepare
         directory = get_repository_path('postloader/samples_data01')
@@ -770,6 +822,54 @@ class PostloaderTest(DBTest):
         assert tmp.loc['ckinship_0_0', 'field_id'] == 'ckinship_0_0'
         assert tmp.loc['ckinship_0_0', 'type'] == 'Continuous'
 
+    def test_postload_load_samples_data_blue_green(self):
+        # prepare
+        postloader_directory = get_repository_path('postloader/samples_data04')
+        pl = Postloader(POSTGRESQL_ENGINE)
+
+        pheno_directory = get_repository_path('pheno2sql/example12')
+        csv_file = get_repository_path(os.path.join(pheno_directory, 'example12_diseases.csv'))
+        p2sql = Pheno2SQL(csv_file, POSTGRESQL_ENGINE, bgen_sample_file=os.path.join(pheno_directory, 'impv2.sample'),
+                          n_columns_per_table=2, loading_n_jobs=1, blue_green=True)
+
+        # run
+        p2sql.load_data()
+
+        pl.load_samples_data(postloader_directory,
+                 identifier_columns={
+                     'relatedness.txt': 'ID1',
+                     'samplesqc.txt': 'ID',
+                 },
+                 separators={
+                     'relatedness.txt': '\t',
+                     'samplesqc.txt': ',',
+                 }
+        )
+
+        # Validate
+        db_engine = create_engine(POSTGRESQL_ENGINE)
+        active_schema = p2sql._get_active_schema()
+        assert active_schema is not None
+
+        ## tables are created in the active schema, not in public
+        for schema_name, expected in ((active_schema, True), ('public', False)):
+            table = pd.read_sql("""
+                SELECT EXISTS (
+                    SELECT 1 FROM pg_tables
+                    WHERE schemaname = '{}' AND tablename = '{}'
+                )""".format(schema_name, 'samplesqc'), db_engine)
+
+            assert table.iloc[0, 0] == expected, schema_name
+
+        tmp = pd.read_sql("select * from {}.fields where table_name = 'samplesqc'".format(active_schema), db_engine,
+                          index_col='column_name')
+        assert tmp.shape[0] == 4
+        assert tmp.loc['cpc1_0_0', 'type'] == 'Continuous'
+
+        ## samples data columns can be queried
+        query_result = next(Pheno2SQL(csv_file, POSTGRESQL_ENGINE, blue_green=True).query(['c21_0_0', 'cpc1_0_0']))
+        assert 'cpc1_0_0' in query_result.columns
+
     def test_postload_samples_data_check_constrains_exist(self):
         # prepare
         directory = get_repository_path('postloader/samples_data04')
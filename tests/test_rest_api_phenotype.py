@@ -1,16 +1,29 @@
+import gzip
 import io
 import json
+import os
+import threading
+import time
 import unittest
+from unittest.mock import patch
 import tempfile
 from base64 import b64encode
 
 from ukbrest import app
 import pandas as pd
 
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
 from tests.settings import POSTGRESQL_ENGINE
 from tests.utils import get_repository_path, DBTest
 from ukbrest.common.pheno2sql import Pheno2SQL
+from ukbrest.common.postloader import Postloader
 from ukbrest.common.utils.auth import PasswordHasher
+from ukbrest.common.utils.metrics import METRICS, ROWS_TOTAL
+from ukbrest.resources.formats import Plink2Serializer
 
 
 class TestRestApiPhenotype(DBTest):
@@ -109,6 +122,111 @@ class TestRestApiPhenotype(DBTest):
         fields = json.loads(response.data.decode('utf-8'))
         assert len(fields) == 8
 
+    def test_phenotype_fields_catalog_search(self):
+        # Prepare
+        # Run
+        response = self.app.get('/ukbrest/api/v1.0/phenotype/fields/catalog', query_string={
+            'prefix': 'c21_',
+            'offset': 1,
+            'limit': 1,
+        })
+
+        # Validate
+        assert response.status_code == 200, response.status_code
+        assert response.headers['X-Total-Count'] == '3'
+
+        fields = json.loads(response.data.decode('utf-8'))
+        assert len(fields) == 1
+        assert fields[0]['column_name'] == 'c21_1_0'
+        assert fields[0]['field_id'] == '21'
+        assert fields[0]['instance'] == 1
+        assert fields[0]['array'] == 0
+
+        # instance filter
+        response = self.app.get('/ukbrest/api/v1.0/phenotype/fields/catalog', query_string={
+            'instance': 0,
+        })
+
+        assert response.status_code == 200, response.status_code
+        assert response.headers['X-Total-Count'] == '6'
+        fields = json.loads(response.data.decode('utf-8'))
+        assert len(fields) == 6
+        assert all(f['instance'] == 0 for f in fields)
+
+        # regex
+        response = self.app.get('/ukbrest/api/v1.0/phenotype/fields/catalog', query_string={
+            'regex': '^c4[68]_',
+        })
+
+        assert response.status_code == 200, response.status_code
+        fields = json.loads(response.data.decode('utf-8'))
+        assert [f['column_name'] for f in fields] == ['c46_0_0', 'c48_0_0']
+
+        # invalid regex
+        response = self.app.get('/ukbrest/api/v1.0/phenotype/fields/catalog', query_string={
+            'regex': 'c4[',
+        })
+
+        assert response.status_code == 400, response.status_code
+
+    def test_phenotype_fields_catalog_etag(self):
+        # Prepare
+        response = self.app.get('/ukbrest/api/v1.0/phenotype/fields/catalog', query_string={'prefix': 'c21_'})
+        assert response.status_code == 200, response.status_code
+        etag = response.headers['ETag']
+
+        # Run
+        response = self.app.get('/ukbrest/api/v1.0/phenotype/fields/catalog', query_string={'prefix': 'c21_'},
+                                headers={'If-None-Match': etag})
+
+        # Validate
+        assert response.status_code == 304, response.status_code
+        assert response.headers['ETag'] == etag
+
+        # a different search has a different ETag
+        response = self.app.get('/ukbrest/api/v1.0/phenotype/fields/catalog', query_string={'prefix': 'c34_'},
+                                headers={'If-None-Match': etag})
+
+        assert response.status_code == 200, response.status_code
+        assert response.headers['ETag'] != etag
+
+        # loading data again changes the ETag
+        self.setUp()
+
+        response = self.app.get('/ukbrest/api/v1.0/phenotype/fields/catalog', query_string={'prefix': 'c21_'},
+                                headers={'If-None-Match': etag})
+
+        assert response.status_code == 200, response.status_code
+        assert response.headers['ETag'] != etag
+
+    def test_codings_descendants(self):
+        # Prepare
+        Postloader(POSTGRESQL_ENGINE).load_codings(get_repository_path('postloader/codings03_tree'))
+
+        # Run
+        response = self.app.get('/ukbrest/api/v1.0/codings/6', query_string={
+            'coding': '1065',
+            'descendants': 'true',
+        })
+
+        # Validate
+        assert response.status_code == 200, response.status_code
+
+        codings = json.loads(response.data.decode('utf-8'))
+        assert [c['coding'] for c in codings] == ['1065', '1072', '1073']
+        assert [c['depth'] for c in codings] == [0, 1, 1]
+        assert codings[1]['meaning'] == 'essential hypertension'
+        assert codings[1]['parent_id'] == 1081
+        assert codings[1]['selectable'] is True
+
+        # without descendants
+        response = self.app.get('/ukbrest/api/v1.0/codings/6', query_string={'coding': '1065'})
+
+        assert response.status_code == 200, response.status_code
+        codings = json.loads(response.data.decode('utf-8'))
+        assert len(codings) == 1
+        assert codings[0]['meaning'] == 'hypertension'
+
     def test_phenotype_fields_http_auth_no_credentials(self):
         # Prepare
         self.configureAppWithAuth('user: thepassword2')
@@ -169,6 +287,58 @@ class TestRestApiPhenotype(DBTest):
         fields = json.loads(response.data.decode('utf-8'))
         assert len(fields) == 8
 
+    def test_phenotype_query_metrics_and_server_timing(self):
+        # Prepare
+        parameters = {
+            'columns': ['c21_0_0', 'c34_0_0'],
+        }
+
+        # Run
+        with patch('ukbrest.config.server_timing', True):
+            response = self.app.get('/ukbrest/api/v1.0/phenotype',
+                                    query_string=parameters, headers={'accept': 'text/csv'})
+
+        # Validate
+        assert response.status_code == 200, response.status_code
+
+        server_timing = response.headers['Server-Timing']
+        assert 'metadata;dur=' in server_timing, server_timing
+        assert 'sql;dur=' in server_timing, server_timing
+
+        with patch('ukbrest.config.metrics', True):
+            response = self.app.get('/metrics')
+        assert response.status_code == 200, response.status_code
+
+        metrics = response.data.decode('utf-8')
+        assert '# TYPE ukbrest_stage_seconds histogram' in metrics
+        assert 'ukbrest_stage_seconds_bucket{stage="sql",le="+Inf"}' in metrics
+        assert 'ukbrest_stage_seconds_count{format="csv",stage="serialize"}' in metrics
+        assert 'ukbrest_rows_total' in metrics
+        assert 'ukbrest_bytes_total{format="csv"}' in metrics
+        assert 'ukbrest_db_pool_checkouts' in metrics
+
+    def test_metrics_disabled_by_default(self):
+        # Run
+        response = self.app.get('/metrics')
+
+        # Validate
+        assert response.status_code == 404, response.status_code
+
+    def test_metrics_http_auth(self):
+        # Prepare
+        self.configureAppWithAuth('user: thepassword2')
+
+        # Run
+        with patch('ukbrest.config.metrics', True):
+            response_no_credentials = self.app.get('/metrics')
+            response = self.app.get('/metrics', headers=self._get_http_basic_auth_header('user', 'thepassword2'))
+
+        # Validate
+        assert response_no_credentials.status_code == 401, response_no_credentials.status_code
+
+        assert response.status_code == 200, response.status_code
+        assert response.mimetype == 'text/plain'
+
     def test_phenotype_query_single_column_format_csv(self):
         # Prepare
         columns = ['c21_0_0']
@@ -3806,3 +3976,590 @@ class TestRestApiPhenotype(DBTest):
         assert data_fetched.loc[1000050, 'field_name_34'] == '-4'
         assert data_fetched.loc[1000060, 'field_name_34'] == 'NA'
         assert data_fetched.loc[1000070, 'field_name_34'] == '-5'
+
+    def test_phenotype_query_yaml_materialized_section(self):
+        # Prepare
+        self.setUp('pheno2sql/example13/example13_diseases.csv',
+                   bgen_sample_file=get_repository_path('pheno2sql/example13/impv2.sample'),
+                   sql_chunksize=2, n_columns_per_table=2)
+
+        yaml_data = b"""
+        samples_filters:
+          - lower(c21_2_0) in ('yes', 'no', 'maybe', 'probably')
+          - c34_0_0 > -10
+
+        data:
+          another_disease_name:
+            case_control:
+              85:
+                coding: [978, 1701]
+              84:
+                coding: [Z876, Z678]
+          second_column:
+            case_control:
+              85:
+                coding: 1114
+          third_column:
+            sql:
+              1: c46_0_0 > 0
+              0: c46_0_0 < 0
+        """
+
+        expected_columns = ['another_disease_name', 'second_column', 'third_column']
+
+        data_not_materialized = self._make_yaml_request(yaml_data, 'data', 4, expected_columns)
+
+        # Run
+        from ruamel.yaml import YAML
+        p2sql = app.app.config['pheno2sql']
+        table_name = p2sql.register_derived_phenotypes(YAML(typ='safe').load(yaml_data), 'data', name='mydata')
+
+        # Validate
+        assert table_name == 'derived_mydata'
+
+        derived = pd.read_sql('select * from derived_phenotypes', p2sql._get_db_engine())
+        assert derived.shape[0] == 1
+        assert derived.loc[0, 'name'] == 'mydata'
+        assert derived.loc[0, 'table_name'] == 'derived_mydata'
+
+        data_materialized = self._make_yaml_request(yaml_data, 'data', 4, expected_columns)
+        assert data_materialized.sort_index().equals(data_not_materialized.sort_index())
+
+        ## queries read the materialized table directly
+        with p2sql._get_db_engine().connect() as conn:
+            conn.execute("update derived_mydata set second_column = '9' where eid = 1000050")
+
+        data_materialized = self._make_yaml_request(yaml_data, 'data', 4, expected_columns)
+        assert data_materialized.loc[1000050, 'second_column'] == '9'
+
+        ## a different samples filter is not the same definition
+        yaml_data_other_filters = yaml_data.replace(b'c34_0_0 > -10', b'c34_0_0 > -100')
+        data_other_filters = self._make_yaml_request(yaml_data_other_filters, 'data', 4, expected_columns)
+        assert data_other_filters.loc[1000050, 'second_column'] == '1'
+
+    def test_phenotype_query_yaml_materialized_section_refreshed_on_load(self):
+        # Prepare
+        self.setUp('pheno2sql/example13/example13_diseases.csv',
+                   bgen_sample_file=get_repository_path('pheno2sql/example13/impv2.sample'),
+                   sql_chunksize=2, n_columns_per_table=2)
+
+        yaml_data = b"""
+        data:
+          second_column:
+            case_control:
+              85:
+                coding: 1114
+        """
+
+        from ruamel.yaml import YAML
+        p2sql = app.app.config['pheno2sql']
+        p2sql.register_derived_phenotypes(YAML(typ='safe').load(yaml_data), 'data')
+
+        with p2sql._get_db_engine().connect() as conn:
+            conn.execute("update derived_data set second_column = '9'")
+
+        # Run
+        self.setUp('pheno2sql/example13/example13_diseases.csv', wipe_database=False,
+                   bgen_sample_file=get_repository_path('pheno2sql/example13/impv2.sample'),
+                   sql_chunksize=2, n_columns_per_table=2)
+
+        # Validate
+        data_fetched = pd.read_sql('select * from derived_data', app.app.config['pheno2sql']._get_db_engine())
+        assert data_fetched.shape[0] > 0
+        assert all(data_fetched['second_column'].isin(['0', '1']))
+
+    def test_phenotype_query_yaml_materialized_section_refreshed_on_withdrawals(self):
+        # Prepare
+        self.setUp('pheno2sql/example13/example13_diseases.csv',
+                   bgen_sample_file=get_repository_path('pheno2sql/example13/impv2.sample'),
+                   sql_chunksize=2, n_columns_per_table=2)
+
+        withdrawals_dir = tempfile.mkdtemp(prefix='ukbrest')
+
+        pl = Postloader(POSTGRESQL_ENGINE)
+        pl.load_withdrawals(withdrawals_dir)
+
+        yaml_data = b"""
+        samples_filters:
+          - eid not in (select eid from withdrawals)
+
+        data:
+          third_column:
+            sql:
+              1: c46_0_0 > 0
+              0: c46_0_0 < 0
+        """
+
+        from ruamel.yaml import YAML
+        p2sql = app.app.config['pheno2sql']
+        p2sql.register_derived_phenotypes(YAML(typ='safe').load(yaml_data), 'data')
+
+        data_fetched = pd.read_sql('select * from derived_data', p2sql._get_db_engine())
+        assert 1000010 in data_fetched['eid'].tolist()
+
+        # Run
+        with open(os.path.join(withdrawals_dir, 'w1.csv'), 'w') as f:
+            f.write('1000010\n')
+
+        pl.load_withdrawals(withdrawals_dir)
+
+        # Validate
+        data_fetched = pd.read_sql('select * from derived_data', p2sql._get_db_engine())
+        assert data_fetched.shape[0] > 0
+        assert 1000010 not in data_fetched['eid'].tolist()
+
+        ## the table is replaced by the one built aside
+        tables = pd.read_sql("select tablename from pg_tables where tablename like 'derived\\_data%%'",
+                             p2sql._get_db_engine())
+        assert tables['tablename'].tolist() == ['derived_data']
+
+        constraint_sql = self._get_table_contrains('derived_data', relationship_query='ix_%%')
+        constraints_results = pd.read_sql(constraint_sql, p2sql._get_db_engine())
+        assert constraints_results['index_name'].tolist() == ['ix_derived_data_eid']
+
+    def test_phenotype_query_yaml_materialized_section_removed_if_refresh_fails(self):
+        # Prepare
+        self.setUp('pheno2sql/example13/example13_diseases.csv',
+                   bgen_sample_file=get_repository_path('pheno2sql/example13/impv2.sample'),
+                   sql_chunksize=2, n_columns_per_table=2)
+
+        p2sql = app.app.config['pheno2sql']
+
+        with p2sql._get_db_engine().connect() as conn:
+            conn.execute('create table excluded_samples (eid bigint)')
+
+        yaml_data = b"""
+        samples_filters:
+          - eid not in (select eid from excluded_samples)
+
+        data:
+          third_column:
+            sql:
+              1: c46_0_0 > 0
+              0: c46_0_0 < 0
+        """
+
+        from ruamel.yaml import YAML
+        yaml_file = YAML(typ='safe').load(yaml_data)
+        p2sql.register_derived_phenotypes(yaml_file, 'data')
+        assert p2sql._get_derived_phenotypes_table(yaml_file, 'data') == 'derived_data'
+
+        ## the section cannot be computed anymore
+        with p2sql._get_db_engine().connect() as conn:
+            conn.execute('drop table excluded_samples')
+
+        # Run
+        p2sql.refresh_derived_data()
+
+        # Validate
+        assert p2sql._get_derived_phenotypes_table(yaml_file, 'data') is None
+
+        tables = pd.read_sql("select tablename from pg_tables where tablename like 'derived\\_data%%'",
+                             p2sql._get_db_engine())
+        assert tables.shape[0] == 0
+
+    def test_phenotype_query_yaml_samples_filters_cache(self):
+        # Prepare
+        self.setUp('pheno2sql/example13/example13_diseases.csv',
+                   bgen_sample_file=get_repository_path('pheno2sql/example13/impv2.sample'),
+                   sql_chunksize=2, n_columns_per_table=2)
+
+        yaml_data = b"""
+        samples_filters:
+          - lower(c21_2_0) in ('yes', 'no', 'maybe', 'probably')
+          - c34_0_0 > -10
+
+        simple_covariates:
+          field_34: c34_0_0
+
+        data:
+          another_disease_name:
+            case_control:
+              85:
+                coding: [978, 1701]
+              84:
+                coding: [Z876, Z678]
+          third_column:
+            sql:
+              1: c46_0_0 > 0
+              0: c46_0_0 < 0
+          field_46: c46_0_0
+        """
+
+        data_expected = self._make_yaml_request(yaml_data, 'data', 4, ['another_disease_name', 'third_column', 'field_46'])
+        simple_expected = self._make_yaml_request(yaml_data, 'simple_covariates', 4, ['field_34'])
+
+        # Run
+        self.setUp('pheno2sql/example13/example13_diseases.csv', load_data=False, wipe_database=False,
+                   bgen_sample_file=get_repository_path('pheno2sql/example13/impv2.sample'),
+                   sql_chunksize=2, n_columns_per_table=2, samples_filters_cache=True)
+
+        data_cached = self._make_yaml_request(yaml_data, 'data', 4, ['another_disease_name', 'third_column', 'field_46'])
+        simple_cached = self._make_yaml_request(yaml_data, 'simple_covariates', 4, ['field_34'])
+
+        # Validate
+        assert data_cached.sort_index().equals(data_expected.sort_index())
+        assert simple_cached.sort_index().equals(simple_expected.sort_index())
+
+        p2sql = app.app.config['pheno2sql']
+        filters_tables = pd.read_sql("select tablename from pg_tables where tablename like 'samples\\_filter\\_%%'",
+                                     p2sql._get_db_engine())
+        assert filters_tables.shape[0] == 1
+
+        ## a new load invalidates previous samples filters
+        self.setUp('pheno2sql/example13/example13_diseases.csv', wipe_database=False,
+                   bgen_sample_file=get_repository_path('pheno2sql/example13/impv2.sample'),
+                   sql_chunksize=2, n_columns_per_table=2, samples_filters_cache=True)
+
+        p2sql = app.app.config['pheno2sql']
+        filters_tables = pd.read_sql("select tablename from pg_tables where tablename like 'samples\\_filter\\_%%'",
+                                     p2sql._get_db_engine())
+        assert filters_tables.shape[0] == 0
+
+    def test_phenotype_query_yaml_samples_filters_cache_withdrawals(self):
+        # Prepare
+        self.setUp('pheno2sql/example13/example13_diseases.csv',
+                   bgen_sample_file=get_repository_path('pheno2sql/example13/impv2.sample'),
+                   sql_chunksize=2, n_columns_per_table=2, samples_filters_cache=True)
+
+        withdrawals_dir = tempfile.mkdtemp(prefix='ukbrest')
+
+        pl = Postloader(POSTGRESQL_ENGINE)
+        pl.load_withdrawals(withdrawals_dir)
+
+        yaml_data = b"""
+        samples_filters:
+          - eid not in (select eid from withdrawals)
+
+        simple_covariates:
+          field_34: c34_0_0
+        """
+
+        pheno_file = self._make_yaml_request(yaml_data, 'simple_covariates', 7, ['field_34'])
+        assert 1000010 in pheno_file.index
+
+        # Run
+        with open(os.path.join(withdrawals_dir, 'w1.csv'), 'w') as f:
+            f.write('1000010\n')
+
+        pl.load_withdrawals(withdrawals_dir)
+
+        # Validate
+        ## the data generation is read again once the check interval has passed
+        with patch.object(Pheno2SQL, 'DATA_GENERATION_CHECK_INTERVAL', 0):
+            pheno_file = self._make_yaml_request(yaml_data, 'simple_covariates', 6, ['field_34'])
+        assert 1000010 not in pheno_file.index
+
+    def test_phenotype_query_yaml_overlapping_categories_and_nulls(self):
+        # Prepare
+        self.setUp('pheno2sql/example13/example13_diseases.csv',
+                   bgen_sample_file=get_repository_path('pheno2sql/example13/impv2.sample'),
+                   sql_chunksize=2, n_columns_per_table=2)
+
+        yaml_data = b"""
+        data:
+          overlapping:
+            sql:
+              1: c46_0_0 > 0
+              2: c46_0_0 > 2
+          is_null:
+            sql:
+              1: c46_0_0 is null
+          field_34: c34_0_0
+        """
+
+        # Run
+        pheno_file = self._make_yaml_request(yaml_data, 'data', 8, ['overlapping', 'is_null', 'field_34'])
+
+        # Validate
+        ## eids matching two categories appear once per category
+        assert sorted(pheno_file.loc[1000040, 'overlapping'].tolist()) == ['1', '2']
+        assert all(pheno_file.loc[1000040, 'field_34'] == '3')
+
+        assert pheno_file.loc[1000050, 'overlapping'] == '1'
+        assert pheno_file.loc[1000070, 'overlapping'] == '1'
+        assert pheno_file.loc[1000010, 'overlapping'] == ''
+
+        assert pheno_file.loc[1000060, 'is_null'] == '1'
+        assert pheno_file.loc[1000060, 'overlapping'] == ''
+        assert pheno_file.loc[1000060, 'field_34'] == ''
+        assert pheno_file.loc[1000010, 'is_null'] == ''
+        assert pheno_file.loc[1000010, 'field_34'] == '-33'
+
+    def test_phenotype_query_yaml_columns_in_parallel(self):
+        # Prepare
+        self.setUp('pheno2sql/example13/example13_diseases.csv',
+                   bgen_sample_file=get_repository_path('pheno2sql/example13/impv2.sample'),
+                   sql_chunksize=2, n_columns_per_table=2)
+
+        yaml_data = b"""
+        samples_filters:
+          - c34_0_0 > -10
+
+        data:
+          another_disease_name:
+            case_control:
+              85:
+                coding: [978, 1701]
+              84:
+                coding: [Z876, Z678]
+          overlapping:
+            sql:
+              1: c46_0_0 > 0
+              2: c46_0_0 > 2
+          field_47: c47_0_0
+        """
+
+        expected_columns = ['another_disease_name', 'overlapping', 'field_47']
+
+        data_single_query = self._make_yaml_request(yaml_data, 'data', 6, expected_columns)
+
+        # Run
+        self.setUp('pheno2sql/example13/example13_diseases.csv', load_data=False, wipe_database=False,
+                   bgen_sample_file=get_repository_path('pheno2sql/example13/impv2.sample'),
+                   sql_chunksize=2, n_columns_per_table=2, yaml_columns_n_jobs=3)
+
+        def get_rows_total():
+            return sum(METRICS.counters.get(ROWS_TOTAL, {}).values())
+
+        rows_total = get_rows_total()
+
+        data_parallel = self._make_yaml_request(yaml_data, 'data', 6, expected_columns)
+
+        # Validate
+        def sort_data(data):
+            return data.reset_index().sort_values(['eid'] + expected_columns).reset_index(drop=True)
+
+        assert sort_data(data_parallel).equals(sort_data(data_single_query))
+        assert sorted(data_parallel.loc[1000040, 'overlapping'].tolist()) == ['1', '2']
+
+        ## rows are counted as in the single query mode
+        assert get_rows_total() - rows_total == data_parallel.shape[0]
+
+    def test_phenotype_explain(self):
+        # Prepare
+        self.setUp('pheno2sql/example02.csv', n_columns_per_table=2)
+
+        parameters = {
+            'columns': ['c21_0_0', 'c48_0_0'],
+            'filters': ['c47_0_0 > 0'],
+        }
+
+        # Run
+        response = self.app.get('/ukbrest/api/v1.0/phenotype/explain', query_string=parameters)
+
+        # Validate
+        assert response.status_code == 200, response.status_code
+
+        explain = json.loads(response.data.decode('utf-8'))
+        assert explain['n_columns'] == 2
+        assert explain['columns'] == ['c21_0_0', 'c48_0_0']
+        assert 'c47_0_0' in explain['sql']
+        assert len(explain['tables']) > 0, explain['tables']
+        assert all(t.startswith('ukb_pheno_') for t in explain['tables'])
+        assert explain['total_cost'] > 0
+        assert explain['max_query_cost'] is None
+        assert explain['allowed']
+
+    def test_phenotype_query_yaml_explain(self):
+        # Prepare
+        self.setUp('pheno2sql/example13/example13_diseases.csv',
+                   bgen_sample_file=get_repository_path('pheno2sql/example13/impv2.sample'),
+                   sql_chunksize=2, n_columns_per_table=2)
+
+        yaml_data = b"""
+        data:
+          second_column:
+            case_control:
+              85:
+                coding: 1114
+          field_34: c34_0_0
+        """
+
+        # Run
+        response = self.app.post('/ukbrest/api/v1.0/query/explain', data={
+            'file': (io.BytesIO(yaml_data), 'data.yaml'),
+            'section': 'data',
+        })
+
+        # Validate
+        assert response.status_code == 200, response.status_code
+
+        explain = json.loads(response.data.decode('utf-8'))
+        assert explain['n_columns'] == 2
+        assert explain['columns'] == ['second_column', 'field_34']
+        assert 'events' in explain['tables']
+        assert explain['total_cost'] > 0
+
+    def test_phenotype_query_max_query_cost(self):
+        # Prepare
+        self.setUp('pheno2sql/example02.csv', n_columns_per_table=2, max_query_cost=0.01)
+
+        parameters = {
+            'columns': ['c21_0_0', 'c48_0_0'],
+        }
+
+        # Run
+        response = self.app.get('/ukbrest/api/v1.0/phenotype',
+                                query_string=parameters, headers={'accept': 'text/csv'})
+
+        # Validate
+        assert response.status_code == 400, response.status_code
+        data = json.load(io.StringIO(response.data.decode('utf-8')))
+
+        assert data['status_code'] == 400, data['status_code']
+        assert data['error_type'] == 'QUERY_COST_ERROR', data['error_type']
+
+        response = self.app.get('/ukbrest/api/v1.0/phenotype/explain', query_string=parameters)
+        assert response.status_code == 200, response.status_code
+
+        explain = json.loads(response.data.decode('utf-8'))
+        assert explain['max_query_cost'] == 0.01
+        assert not explain['allowed']
+
+    def test_serializer_data_generator_buffer(self):
+        # Prepare
+        chunks = [
+            pd.DataFrame({'c21_0_0': ['a', None]}, index=pd.Index([1, 2], name='eid')),
+            pd.DataFrame({'c21_0_0': ['c', 'd']}, index=pd.Index([3, 4], name='eid')),
+        ]
+
+        # Run
+        blocks_large_buffer = list(Plink2Serializer(buffer_size=1024 * 1024).data_generator(
+            (c.copy() for c in chunks), Plink2Serializer().serialize, na_rep='NA'))
+
+        blocks_small_buffer = list(Plink2Serializer(buffer_size=1).data_generator(
+            (c.copy() for c in chunks), Plink2Serializer().serialize, na_rep='NA'))
+
+        # Validate
+        assert len(blocks_large_buffer) == 1
+        assert all(isinstance(b, bytes) for b in blocks_large_buffer)
+        assert blocks_large_buffer[0] == b'FID\tIID\tc21_0_0\n1\t1\ta\n2\t2\tNA\n3\t3\tc\n4\t4\td\n'
+
+        assert len(blocks_small_buffer) >= 2
+        assert b''.join(blocks_small_buffer) == blocks_large_buffer[0]
+
+    def test_phenotype_query_gzip_compression(self):
+        # Prepare
+        self.setUp('pheno2sql/example02.csv', n_columns_per_table=2, sql_chunksize=2)
+
+        parameters = {
+            'columns': ['c21_0_0', 'c21_2_0', 'c48_0_0'],
+        }
+
+        response_uncompressed = self.app.get('/ukbrest/api/v1.0/phenotype', query_string=parameters,
+                                             headers={'accept': 'text/csv'})
+        assert response_uncompressed.status_code == 200, response_uncompressed.status_code
+        assert 'Content-Encoding' not in response_uncompressed.headers
+
+        # Run
+        response = self.app.get('/ukbrest/api/v1.0/phenotype', query_string=parameters,
+                                headers={'accept': 'text/csv', 'accept-encoding': 'br;q=1.0, gzip;q=0.8'})
+
+        # Validate
+        assert response.status_code == 200, response.status_code
+        assert response.headers['Content-Encoding'] == 'gzip'
+        assert response.headers['Vary'] == 'Accept-Encoding'
+
+        assert gzip.decompress(response.data) == response_uncompressed.data
+
+    def test_get_content_encoding(self):
+        from ukbrest.resources.compression import get_content_encoding
+
+        assert get_content_encoding(None) is None
+        assert get_content_encoding('identity') is None
+        assert get_content_encoding('gzip, deflate') == 'gzip'
+        assert get_content_encoding('gzip;q=0') is None
+        assert get_content_encoding('*') in ('gzip', 'zstd')
+
+    def test_compress_stream_thread_abandoned(self):
+        from ukbrest.resources.compression import compress_stream
+
+        # Prepare
+        producer_closed = threading.Event()
+
+        def blocks():
+            try:
+                for i in range(1000):
+                    # random bytes, so the compressor outputs data for every block
+                    yield os.urandom(64 * 1024)
+            finally:
+                producer_closed.set()
+
+        n_threads = threading.active_count()
+
+        # Run
+        stream = compress_stream(blocks(), 'gzip', use_thread=True)
+        next(stream)
+        next(stream)
+        stream.close()
+
+        # Validate
+        assert producer_closed.wait(5)
+
+        for i in range(50):
+            if threading.active_count() <= n_threads:
+                break
+            time.sleep(0.1)
+
+        assert threading.active_count() == n_threads
+
+    @unittest.skipIf(pyarrow is None, 'pyarrow not installed')
+    def test_phenotype_query_format_arrow(self):
+        # Prepare
+        self.setUp('pheno2sql/example02.csv', n_columns_per_table=2, sql_chunksize=2)
+
+        parameters = {
+            'columns': ['c21_0_0', 'c34_0_0', 'c47_0_0', 'c48_0_0 as mydate'],
+        }
+
+        # Run
+        response = self.app.get('/ukbrest/api/v1.0/phenotype', query_string=parameters,
+                                headers={'accept': 'application/vnd.apache.arrow.stream'})
+
+        # Validate
+        assert response.status_code == 200, response.status_code
+
+        table = pyarrow.ipc.open_stream(pyarrow.py_buffer(response.data)).read_all()
+        assert table.num_rows == 4
+        assert table.schema.names == ['eid', 'c21_0_0', 'c34_0_0', 'c47_0_0', 'mydate']
+        assert table.schema.field('eid').type == pyarrow.int64()
+        assert table.schema.field('c21_0_0').type == pyarrow.string()
+        assert table.schema.field('c34_0_0').type == pyarrow.int64()
+        assert table.schema.field('c47_0_0').type == pyarrow.float64()
+        assert pyarrow.types.is_timestamp(table.schema.field('mydate').type)
+
+        data = table.to_pandas().set_index('eid')
+        assert data.loc[1, 'c21_0_0'] == 'Option number 1'
+        assert data.loc[1, 'c34_0_0'] == 21
+        assert data.loc[4, 'c47_0_0'] == 55.19832
+        assert data.loc[3, 'mydate'] == pd.Timestamp('2010-01-01')
+
+    @unittest.skipIf(pyarrow is None, 'pyarrow not installed')
+    def test_phenotype_query_yaml_format_parquet(self):
+        # Prepare
+        self.setUp('pheno2sql/example02.csv', n_columns_per_table=2, sql_chunksize=2)
+
+        yaml_data = b"""
+        simple_covariates:
+          field_34: c34_0_0
+          field_47: c47_0_0
+        """
+
+        # Run
+        response = self.app.post('/ukbrest/api/v1.0/query', data={
+            'file': (io.BytesIO(yaml_data), 'data.yaml'),
+            'section': 'simple_covariates',
+        }, headers={'accept': 'application/parquet'})
+
+        # Validate
+        assert response.status_code == 200, response.status_code
+
+        import pyarrow.parquet
+        parquet_file = pyarrow.parquet.ParquetFile(pyarrow.BufferReader(response.data))
+        assert parquet_file.num_row_groups == 2
+
+        data = parquet_file.read().to_pandas().set_index('eid')
+        assert data.shape == (4, 2)
+        assert data.loc[2, 'field_34'] == 12
+        assert data.loc[2, 'field_47'] == -0.55461
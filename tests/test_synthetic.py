@@ -0,0 +1,52 @@
+import tempfile
+from os.path import join
+
+import numpy as np
+import pandas as pd
+
+from tests.settings import POSTGRESQL_ENGINE
+from tests.utils import DBTest
+from ukbrest.common.pheno2sql import Pheno2SQL
+from ukbrest.common.utils.synthetic import generate_dataset, get_fields_schema
+
+
+class SyntheticDataTest(DBTest):
+    def test_fields_schema(self):
+        # Prepare
+        # Run
+        schema = get_fields_schema(500, np.random.RandomState(0))
+
+        # Validate
+        assert schema.shape[0] == 500
+        assert schema['column_name'].is_unique
+        assert set(schema['type']) == {'Integer', 'Continuous', 'Categorical (single)', 'Categorical (multiple)',
+                                       'Date', 'Text'}
+
+        multiple = schema.loc[schema['type'] == 'Categorical (multiple)']
+        assert multiple['array'].max() > 0
+        assert multiple['coding'].notnull().all()
+        assert schema.loc[schema['type'] == 'Integer', 'coding'].isnull().all()
+
+    def test_generate_and_load(self):
+        # Prepare
+        output_dir = tempfile.mkdtemp()
+
+        # Run
+        generate_dataset(output_dir, n_samples=250, n_columns=60, block_cells=100 * 60, seed=1)
+
+        # Validate
+        data = pd.read_csv(join(output_dir, 'synthetic.csv'), index_col='eid', dtype=str)
+        assert data.shape == (250, 60)
+        assert data.index.is_unique
+        assert data.isnull().any().any()
+
+        p2sql = Pheno2SQL(join(output_dir, 'synthetic.csv'), POSTGRESQL_ENGINE, n_columns_per_table=20,
+                          loading_n_jobs=1)
+        p2sql.load_data()
+
+        fields = pd.read_sql('select * from fields', POSTGRESQL_ENGINE)
+        assert fields.shape[0] == 60
+        assert fields.loc[fields['type'].str.startswith('Categorical'), 'coding'].notnull().all()
+
+        all_eids = pd.read_sql('select count(*) as n from all_eids', POSTGRESQL_ENGINE)
+        assert all_eids.loc[0, 'n'] == 250
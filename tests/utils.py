@@ -33,6 +33,15 @@ class DBTest(unittest.TestCase):
             for idx, drop_table_st in tables.iterrows():
                 con.execute(drop_table_st.iloc[0])
 
+        # wipe schemas of blue/green loading
+        schemas = pd.read_sql(
+            "select nspname from pg_namespace where nspname like 'ukbrest\\_data\\_%%'", db_engine
+        )
+
+        with db_engine.connect() as con:
+            for schema_name in schemas['nspname']:
+                con.execute('drop schema if exists "{}" cascade'.format(schema_name))
+
     def _get_table_contrains(self, table_name, column_query='%%', relationship_query='%%'):
         return """
         select t.relname as table_name, i.relname as index_name, a.attname as column_name
@@ -1,10 +1,14 @@
 import logging
 
-from flask import Flask
-from ukbrest.resources.phenotype import PhenotypeFieldsAPI, PhenotypeAPI, QueryAPI, PhenotypeApiObject
+from flask import Flask, Response, g
+from ukbrest.resources.phenotype import PhenotypeFieldsAPI, PhenotypeAPI, QueryAPI, PhenotypeApiObject, \
+    PhenotypeExplainAPI, QueryExplainAPI, PhenotypeFieldsCatalogAPI, \
+    CodingsAPI
 
 from ukbrest.resources.genotype import GenotypeApiObject
 from ukbrest.resources.genotype import GenotypePositionsAPI, GenotypeRsidsAPI
+from ukbrest.common.utils.metrics import METRICS, get_server_timing
+from ukbrest import config as ukbrest_config
 
 
 app = Flask(__name__)
@@ -41,6 +45,26 @@ phenotype_info_api.add_resource(
     '/ukbrest/api/v1.0/phenotype/fields',
 )
 
+phenotype_info_api.add_resource(
+    PhenotypeFieldsCatalogAPI,
+    '/ukbrest/api/v1.0/phenotype/fields/catalog',
+)
+
+phenotype_info_api.add_resource(
+    CodingsAPI,
+    '/ukbrest/api/v1.0/codings/<int:data_coding>',
+)
+
+phenotype_info_api.add_resource(
+    PhenotypeExplainAPI,
+    '/ukbrest/api/v1.0/phenotype/explain',
+)
+
+phenotype_info_api.add_resource(
+    QueryExplainAPI,
+    '/ukbrest/api/v1.0/query/explain',
+)
+
 # Query API
 phenotype_api = PhenotypeApiObject(app)
 
@@ -49,6 +73,43 @@ phenotype_api.add_resource(
     '/ukbrest/api/v1.0/query',
 )
 
+# Metrics
+def _render_metrics():
+    gauges = {}
+
+    pheno2sql = app.config.get('pheno2sql')
+    if pheno2sql is not None:
+        for stat_name, value in pheno2sql.get_db_pool_stats().items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                gauges['ukbrest_db_pool_{}'.format(stat_name)] = value
+
+        for stat_name, value in pheno2sql.get_prepared_statements_stats().items():
+            gauges['ukbrest_prepared_statements_{}'.format(stat_name)] = value
+
+    return Response(METRICS.render(gauges), 200, mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/metrics')
+def metrics():
+    if not ukbrest_config.metrics:
+        return Response('Metrics are disabled\n', 404, mimetype='text/plain')
+
+    # same http authentication as the API
+    auth = app.config.get('auth')
+    if auth is not None:
+        return auth.login_required(_render_metrics)()
+
+    return _render_metrics()
+
+
+@app.after_request
+def add_server_timing(response):
+    if ukbrest_config.server_timing and 'ukbrest_timings' in g:
+        response.headers['Server-Timing'] = get_server_timing(g.ukbrest_timings)
+
+    return response
+
+
 @app.before_first_request
 def setup_logging():
     if not app.debug:
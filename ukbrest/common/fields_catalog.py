@@ -0,0 +1,137 @@
+import hashlib
+import json
+import re
+import threading
+
+import pandas as pd
+
+from ukbrest.config import logger
+from ukbrest.resources.exceptions import UkbRestValidationError
+
+
+class FieldsCatalog(object):
+    """
+    In-memory index of the fields table, used to search fields without querying the database each time. It is
+    reloaded when new data is loaded.
+    """
+
+    MAX_LIMIT = 1000
+
+    def __init__(self, pheno2sql):
+        self.pheno2sql = pheno2sql
+
+        self.fields = None
+        self.data_generation = None
+
+        self._lock = threading.Lock()
+
+    def _load(self):
+        fields = pd.read_sql(
+            'select column_name, field_id, inst, arr, type, coding, description '
+            'from fields '
+            'order by column_name',
+            self.pheno2sql._get_db_engine()
+        )
+
+        fields['description'] = fields['description'].fillna('')
+        fields = fields.assign(description_lower=fields['description'].str.lower())
+
+        logger.info('Fields catalog loaded ({} fields)'.format(fields.shape[0]))
+
+        return fields
+
+    def get_fields(self):
+        """
+        Returns the fields (a DataFrame) and the data generation they belong to.
+        """
+        data_generation = self.pheno2sql._get_data_generation()
+
+        with self._lock:
+            if self.fields is None or self.data_generation != data_generation:
+                self.fields = self._load()
+                self.data_generation = data_generation
+
+            return self.fields, self.data_generation
+
+    def get_column_names(self):
+        fields, _ = self.get_fields()
+        return fields['column_name'].tolist()
+
+    def get_etag(self, **search_args):
+        """
+        Returns the ETag of a search response: it only changes if data is loaded again or the search is different.
+        """
+        _, data_generation = self.get_fields()
+
+        etag_data = json.dumps([data_generation, sorted((k, str(v)) for k, v in search_args.items() if v is not None)])
+
+        return hashlib.md5(etag_data.encode('utf-8')).hexdigest()
+
+    def search(self, prefix=None, regex=None, q=None, type=None, coding=None, instance=None, field_id=None,
+               offset=0, limit=100):
+        """
+        Searches fields. All conditions specified must be true (AND).
+        :param prefix: column name prefix (like c21_).
+        :param regex: regular expression the column name must match.
+        :param q: text in the description (case insensitive).
+        :param type: field type (like Integer or Categorical (single)).
+        :param coding: data-coding id.
+        :param instance: instance number.
+        :param field_id: field id (like 21).
+        :param offset: number of fields to skip (pagination).
+        :param limit: maximum number of fields returned.
+        :return: a tuple with the total number of fields found and a list of dictionaries (one per field).
+        """
+        if offset < 0:
+            raise UkbRestValidationError('offset must be a non-negative number')
+
+        if limit < 0 or limit > FieldsCatalog.MAX_LIMIT:
+            raise UkbRestValidationError('limit must be between 0 and {}'.format(FieldsCatalog.MAX_LIMIT))
+
+        fields, _ = self.get_fields()
+
+        selected = pd.Series(True, index=fields.index)
+
+        if prefix is not None:
+            selected &= fields['column_name'].str.startswith(prefix)
+
+        if regex is not None:
+            try:
+                re.compile(regex)
+            except re.error as e:
+                raise UkbRestValidationError('Invalid regular expression: {}'.format(str(e)))
+
+            selected &= fields['column_name'].str.contains(regex, regex=True)
+
+        if q is not None:
+            selected &= fields['description_lower'].str.contains(q.lower(), regex=False)
+
+        if type is not None:
+            selected &= fields['type'] == type
+
+        if coding is not None:
+            selected &= fields['coding'] == coding
+
+        if instance is not None:
+            selected &= fields['inst'] == instance
+
+        if field_id is not None:
+            selected &= fields['field_id'] == str(field_id)
+
+        found = fields.loc[selected.values]
+        page = found.iloc[offset:offset + limit]
+
+        results = [
+            {
+                'column_name': row.column_name,
+                'field_id': row.field_id,
+                'instance': int(row.inst),
+                'array': int(row.arr),
+                'type': row.type,
+                'coding': int(row.coding) if not pd.isnull(row.coding) else None,
+                'description': row.description,
+            }
+            for row in page.itertuples()
+        ]
+
+        return found.shape[0], results
@@ -3,6 +3,7 @@ import shutil
 import subprocess
 
 from ukbrest.common.utils.datagen import get_temp_file_name, get_tmpdir
+from ukbrest.common.utils.metrics import timed, METRICS, BYTES_TOTAL
 from ukbrest.config import logger
 from ukbrest.resources.exceptions import UkbRestValidationError, UkbRestProgramExecutionError
 
@@ -37,9 +38,10 @@ class GenoQuery:
 
             logger.info(f'Running: {full_command}')
 
-            run_status = subprocess.run(
-                full_command, stdout=bgen_file, stderr=subprocess.PIPE
-            )
+            with timed('bgenix'):
+                run_status = subprocess.run(
+                    full_command, stdout=bgen_file, stderr=subprocess.PIPE
+                )
 
             if run_status.returncode != 0:
                 message = f'bgenix failed: {" ".join(run_status.args)}'
@@ -54,6 +56,8 @@ class GenoQuery:
 
                 raise e
 
+        METRICS.inc(BYTES_TOTAL, os.path.getsize(random_bgen_file), {'format': 'bgen'})
+
         return random_bgen_file
 
     def get_incl_range(self, chr, start=None, stop=None):
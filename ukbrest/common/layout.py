@@ -0,0 +1,139 @@
+import re
+from collections import Counter
+from itertools import combinations
+
+from ruamel.yaml import YAML
+
+from ukbrest.common.pheno2sql import Pheno2SQL
+from ukbrest.config import logger
+
+
+# YAML sections that do not define queries by themselves
+NON_QUERY_YAML_SECTIONS = ('samples_filters', 'data_aliases')
+
+
+class LayoutPlanner(object):
+    """
+    Assigns columns to physical tables so that fields frequently queried together end up in the same table,
+    reducing the number of joins needed by each query. The plan is built from a workload: a set of queries,
+    each one represented by the columns it touches.
+    """
+
+    def __init__(self, n_columns_per_table):
+        self.n_columns_per_table = n_columns_per_table
+
+        self.column_counts = Counter()
+        self.pair_counts = Counter()
+
+    def _get_columns(self, statements):
+        return sorted(set(x.lower() for st in statements for x in re.findall(Pheno2SQL.RE_COLUMN_NAME, str(st))))
+
+    def _get_yaml_statements(self, value):
+        if isinstance(value, dict):
+            return [st for v in value.values() for st in self._get_yaml_statements(v)]
+        elif isinstance(value, (list, tuple)):
+            return [st for v in value for st in self._get_yaml_statements(v)]
+
+        return [str(value)]
+
+    def add_query(self, statements, weight=1):
+        """
+        Adds a query to the workload.
+        :param statements: list of SQL statements (columns, filters, etc) used by the query.
+        :param weight: how many times this query was run.
+        """
+        columns = self._get_columns(statements)
+
+        for col in columns:
+            self.column_counts[col] += weight
+
+        for col_pair in combinations(columns, 2):
+            self.pair_counts[col_pair] += weight
+
+    def add_yaml(self, yaml_file):
+        """
+        Adds each section of a YAML query file to the workload. Samples filters are considered part of every
+        section, since they are joined with all of them.
+        """
+        samples_filters = yaml_file.get('samples_filters', None) or []
+
+        for section, section_data in yaml_file.items():
+            if section in NON_QUERY_YAML_SECTIONS:
+                continue
+
+            self.add_query(self._get_yaml_statements(section_data) + list(samples_filters))
+
+    def add_query_log(self, query_log_file):
+        """
+        Adds a query log to the workload. Each non-empty line of the file is considered one query.
+        """
+        with open(query_log_file, 'r') as f:
+            for line in f:
+                line = line.strip()
+
+                if line == '' or line.startswith('#'):
+                    continue
+
+                self.add_query([line])
+
+    def plan(self):
+        """
+        Greedily merges groups of columns starting from the most frequently co-accessed pairs, as long as the
+        resulting group fits in one table.
+        :return: a list of column groups (lists), hottest first.
+        """
+        groups = {col: [col] for col in self.column_counts}
+
+        for (col_a, col_b), _ in sorted(self.pair_counts.items(), key=lambda x: (-x[1], x[0])):
+            group_a = groups[col_a]
+            group_b = groups[col_b]
+
+            if group_a is group_b or len(group_a) + len(group_b) > self.n_columns_per_table:
+                continue
+
+            group_a.extend(group_b)
+            for col in group_b:
+                groups[col] = group_a
+
+        unique_groups = {id(g): g for g in groups.values()}.values()
+
+        def group_count(group):
+            return sum(self.column_counts[c] for c in group)
+
+        return [
+            sorted(g, key=lambda c: (-self.column_counts[c], c))
+            for g in sorted(unique_groups, key=lambda g: (-group_count(g), min(g)))
+        ]
+
+    def save(self, output_file):
+        plan = self.plan()
+
+        yaml = YAML()
+        with open(output_file, 'w') as f:
+            yaml.dump({'tables': plan}, f)
+
+        logger.info('Layout plan with {} column groups saved to {}'.format(len(plan), output_file))
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('output_file', type=str, help='Output layout plan file (YAML)')
+    parser.add_argument('--yaml-files', type=str, nargs='+', default=[], help='YAML query files')
+    parser.add_argument('--query-logs', type=str, nargs='+', default=[], help='Query logs (one query per line)')
+    parser.add_argument('--n-columns-per-table', type=int, default=1500, help='Maximum number of columns per table')
+
+    args = parser.parse_args()
+
+    planner = LayoutPlanner(args.n_columns_per_table)
+
+    yaml = YAML(typ='safe')
+    for yaml_file in args.yaml_files:
+        with open(yaml_file, 'r') as f:
+            planner.add_yaml(yaml.load(f))
+
+    for query_log in args.query_logs:
+        planner.add_query_log(query_log)
+
+    planner.save(args.output_file)
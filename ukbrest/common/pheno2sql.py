@@ -1,24 +1,39 @@
 import csv
+import hashlib
+import json
 import os
 import re
 import sys
 import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 from subprocess import Popen, PIPE
+from datetime import datetime
 from urllib.parse import urlparse
 
 import numpy as np
 import pandas as pd
 from joblib import Parallel, delayed
-from sqlalchemy.exc import ProgrammingError
+from ruamel.yaml import YAML
+from sqlalchemy.exc import ProgrammingError, DataError
 from sqlalchemy.types import TEXT, FLOAT, TIMESTAMP, INT
 from sqlalchemy.exc import OperationalError
 
-from ukbrest.common.utils.db import create_table, create_indexes, DBAccess
+from ukbrest.common.fields_catalog import FieldsCatalog
+from ukbrest.common.utils.db import create_table, create_indexes, DBAccess, get_db_engine, get_db_uri, \
+    dispose_db_engine, get_create_index_statements, copy_data
 from ukbrest.common.utils.datagen import get_tmpdir
-from ukbrest.common.utils.constants import BGEN_SAMPLES_TABLE, ALL_EIDS_TABLE
+from ukbrest.common.utils.constants import BGEN_SAMPLES_TABLE, ALL_EIDS_TABLE, DERIVED_PHENOTYPES_TABLE, \
+    DERIVED_PHENOTYPES_TABLE_PREFIX, METADATA_TABLE, SAMPLES_FILTERS_TABLE_PREFIX, CODINGS_CLOSURE_TABLE, \
+    LOAD_CHECKPOINTS_TABLE, BLUE_GREEN_SCHEMAS_TABLE, BLUE_GREEN_SCHEMA_PREFIX
 from ukbrest.config import logger, SQL_CHUNKSIZE_ENV
 from ukbrest.common.utils.misc import get_list
-from ukbrest.resources.exceptions import UkbRestSQLExecutionError, UkbRestProgramExecutionError
+from ukbrest.common.utils.metrics import timed, METRICS, ROWS_TOTAL
+from ukbrest.common.utils.load_profiler import LoadProfiler, ProgressReporter, get_peak_rss
+from ukbrest.resources.exceptions import UkbRestSQLExecutionError, UkbRestProgramExecutionError, \
+    UkbRestValidationError, UkbRestQueryCostError
 
 
 class Pheno2SQL(DBAccess):
@@ -31,25 +46,78 @@ class Pheno2SQL(DBAccess):
     _RE_FIELD_CODING_PATTERN = '(?i)Uses data-coding (?P<coding>[0-9]+) '
     RE_FIELD_CODING = re.compile(_RE_FIELD_CODING_PATTERN)
 
+    _RE_NOT_IN_SUBQUERY_PATTERN = '(?i)(?<![\w.])eid\s+not\s+in\s*\('
+    RE_NOT_IN_SUBQUERY = re.compile(_RE_NOT_IN_SUBQUERY_PATTERN)
+
+    _RE_SELECT_EID_PATTERN = '(?i)^\s*select\s+(distinct\s+)?eid\b'
+    RE_SELECT_EID = re.compile(_RE_SELECT_EID_PATTERN)
+
+    # string literals are matched to skip them; only literals right after a comparison operator are parameters
+    _RE_FILTER_LITERAL_PATTERN = (
+        "(?P<string>'(?:[^']|'')*')|"
+        "(?P<operator>(?:<=|>=|<>|!=|=|<|>)\\s*)"
+        "(?P<literal>'(?:[^']|'')*'|-?\\d+(?:\\.\\d+)?(?:e[+-]?\\d+)?(?![\\w.]))"
+    )
+    RE_FILTER_LITERAL = re.compile(_RE_FILTER_LITERAL_PATTERN, re.IGNORECASE)
+
+    # prepared statements kept by each database connection
+    MAX_PREPARED_STATEMENTS = 100
+
+    # seconds during which the active schema (blue/green loading) is not checked again
+    ACTIVE_SCHEMA_CHECK_INTERVAL = 5
+
+    # seconds during which the data generation (and materialized sections) are not checked again
+    DATA_GENERATION_CHECK_INTERVAL = 5
+
+    # retired schemas (blue/green loading) kept for queries still running on them
+    RETIRED_SCHEMAS_KEPT = 1
+
     _RE_FULL_COLUMN_NAME_RENAME_PATTERN = '^(?i)\(?(?P<field>{})\)?([ ]+([ ]*as[ ]+)?(?P<rename>[\w_]+))?$'.format(_RE_COLUMN_NAME_PATTERN)
     RE_FULL_COLUMN_NAME_RENAME = re.compile(_RE_FULL_COLUMN_NAME_RENAME_PATTERN)
 
     def __init__(self, ukb_csvs, db_uri, bgen_sample_file=None, table_prefix='ukb_pheno_',
                  n_columns_per_table=sys.maxsize, loading_n_jobs=-1, tmpdir=tempfile.mkdtemp(prefix='ukbrest'),
-                 loading_chunksize=5000, sql_chunksize=None, delete_temp_csv=True):
+                 loading_chunksize=5000, sql_chunksize=None, delete_temp_csv=True, layout_plan=None,
+                 rewrite_not_in=False, samples_filters_cache=False, yaml_columns_n_jobs=1, max_query_cost=None,
+                 prepared_statements=False, db_pool_parameters=None, load_profile_file=None, blue_green=False,
+                 maintenance_work_mem=None, bulk_load=False):
         """
         :param ukb_csvs: files are loaded in the order they are specified
         :param db_uri:
         :param table_prefix:
         :param n_columns_per_table:
+        :param layout_plan: list of column groups (or a YAML file with them, see ukbrest.common.layout) that
+        should be stored in the same table. Columns not in the plan are split by their position in the CSV file.
         :param loading_n_jobs:
         :param tmpdir:
         :param loading_chunksize: number of lines to read when loading CSV files to the SQL database.
         :param sql_chunksize: when an SQL query is submited to get phenotypes, this parameteres indicates the
         chunksize (number of rows).
+        :param rewrite_not_in: if True, user conditions like "eid not in (select eid from ...)" are rewritten with
+        "not exists", which PostgreSQL plans as an anti join. Results differ only if the subquery returns NULL eids.
+        :param samples_filters_cache: if True, samples filters of YAML queries are evaluated once per data load and
+        stored in a table, which is joined instead of applying the filters in each subquery.
+        :param yaml_columns_n_jobs: if greater than one, each column of a YAML section is queried separately, using
+        up to this number of concurrent database connections, and the results are joined by eid. In this mode,
+        results are not streamed: the whole section is read into memory before the first chunk is returned.
+        :param max_query_cost: if set, queries with an estimated cost (from PostgreSQL's EXPLAIN) larger than this
+        are not run.
+        :param prepared_statements: if True, constants in filters are replaced by parameters and queries are run as
+        prepared statements, which are reused by each connection when the same query is run with other constants.
+        :param db_pool_parameters: parameters of the database connection pool (see ukbrest.common.utils.db). By
+        default, they are taken from the configuration.
+        :param load_profile_file: if set, a JSON file with the time, rows, bytes and peak memory of each loading stage
+        and table is written there when loading finishes.
+        :param blue_green: if True, data is loaded into a new database schema, and queries are switched to it (in a
+        single transaction) only when loading finishes. Until then, queries keep using the previous schema.
+        :param maintenance_work_mem: PostgreSQL's maintenance_work_mem (like '256MB') of each connection building
+        primary keys and indexes once data is loaded (up to loading_n_jobs at once). By default, the server's one.
+        :param bulk_load: if True, phenotype and events tables are created UNLOGGED and switched to LOGGED once they
+        are loaded and indexed, and COPY does not wait for WAL flushes (synchronous_commit=off). If PostgreSQL
+        crashes while loading, UNLOGGED tables are emptied (they are loaded again when resuming).
         """
 
-        super(Pheno2SQL, self).__init__(db_uri)
+        super(Pheno2SQL, self).__init__(db_uri, db_pool_parameters)
 
         if isinstance(ukb_csvs, (tuple, list)):
             self.ukb_csvs = ukb_csvs
@@ -94,6 +162,125 @@ class Pheno2SQL(DBAccess):
 
         self.delete_temp_csv = delete_temp_csv
 
+        self.layout_plan = layout_plan
+
+        self.rewrite_not_in = rewrite_not_in
+
+        self.samples_filters_cache = samples_filters_cache
+        self._samples_filters_tables = {}
+
+        # last data generation read (with the database URI and the time it was read), and tables of materialized
+        # sections found for each definition
+        self._data_generation = (None, None, None)
+        self._derived_phenotypes_tables = {}
+
+        self.yaml_columns_n_jobs = yaml_columns_n_jobs
+
+        self.max_query_cost = max_query_cost
+
+        self.prepared_statements = prepared_statements
+        self._prepared_statements_stats = {'hits': 0, 'misses': 0}
+        self._prepared_statements_lock = threading.Lock()
+
+        self._fields_catalog = None
+
+        self.load_profile_file = load_profile_file
+        self._load_profiler = None
+
+        self.blue_green = blue_green
+        if self.blue_green and self.db_type == 'sqlite':
+            logger.warning('sqlite does not support blue/green loading')
+            self.blue_green = False
+
+        # search_path used while loading (blue/green), and last active schema read (with the time it was read)
+        self._load_search_path = None
+        self._active_schema = (None, None)
+
+        self.maintenance_work_mem = maintenance_work_mem
+
+        self.bulk_load = bulk_load and self.db_type == 'postgresql'
+
+    def _get_default_db_engine(self):
+        """
+        Returns an engine with the default search_path, where the schemas table of blue/green loading is.
+        """
+        return get_db_engine(self.db_uri, **self.db_pool_parameters)
+
+    def _get_active_schema(self):
+        """
+        Returns the schema with the data that queries should use (blue/green loading), or None if data was not
+        loaded in this mode. It is read again only every ACTIVE_SCHEMA_CHECK_INTERVAL seconds.
+        """
+        active_schema, check_time = self._active_schema
+        if check_time is not None and time.monotonic() - check_time < self.ACTIVE_SCHEMA_CHECK_INTERVAL:
+            return active_schema
+
+        db_engine = self._get_default_db_engine()
+
+        new_active_schema = None
+        if db_engine.has_table(BLUE_GREEN_SCHEMAS_TABLE):
+            with db_engine.connect() as conn:
+                new_active_schema = conn.execute(
+                    "select name from {} where status = 'active'".format(BLUE_GREEN_SCHEMAS_TABLE)
+                ).scalar()
+
+        if active_schema is not None and new_active_schema != active_schema:
+            logger.info('Active schema changed from {} to {}'.format(active_schema, new_active_schema))
+            dispose_db_engine(get_db_uri(self.db_uri, (active_schema, 'public')))
+
+        self._active_schema = (new_active_schema, time.monotonic())
+
+        return new_active_schema
+
+    def _get_search_path(self):
+        if not self.blue_green:
+            return None
+
+        if self._load_search_path is not None:
+            return self._load_search_path
+
+        active_schema = self._get_active_schema()
+        if active_schema is None:
+            return None
+
+        # codings and withdrawals (loaded by the postloader) are in the public schema
+        return (active_schema, 'public')
+
+    def _get_db_uri(self):
+        return get_db_uri(self.db_uri, self._get_search_path())
+
+    def _get_qualified_table_name(self, table_name):
+        """
+        Qualifies a table name with the schema where tables are created, so a table with the same name in another
+        schema of the search_path is never dropped.
+        """
+        search_path = self._get_search_path()
+        if search_path is None:
+            return table_name
+
+        return '{}.{}'.format(search_path[0], table_name)
+
+    def __getstate__(self):
+        # this object is sent to the loading workers (joblib), locks cannot be pickled
+        state = self.__dict__.copy()
+        del state['_prepared_statements_lock']
+        state['_fields_catalog'] = None
+
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._prepared_statements_lock = threading.Lock()
+
+    def get_fields_catalog(self):
+        """
+        Returns an in-memory index of the fields table (see ukbrest.common.fields_catalog).
+        """
+        if self._fields_catalog is None:
+            self._fields_catalog = FieldsCatalog(self)
+
+        return self._fields_catalog
+
     def __enter__(self):
         return self
 
@@ -113,6 +300,65 @@ class Pheno2SQL(DBAccess):
         """
         return (seq[pos:pos + size] for pos in range(0, len(seq), size))
 
+    def _read_layout_plan(self, layout_plan_file):
+        """
+        Reads a layout plan file as written by ukbrest.common.layout.LayoutPlanner.
+        :param layout_plan_file:
+        :return: a list of column groups.
+        """
+        logger.info('Reading layout plan from {}'.format(layout_plan_file))
+
+        with open(layout_plan_file, 'r') as f:
+            plan = YAML(typ='safe').load(f)
+
+        if plan is None:
+            return []
+
+        return [[str(c) for c in group] for group in plan.get('tables', None) or []]
+
+    def _get_column_chunks(self, all_columns):
+        """
+        Divides columns in tables. If a layout plan was given, columns in the same group are stored in the same
+        table (groups are packed together while they fit); the rest of the columns fill the remaining space
+        keeping their order in the CSV file.
+        :param all_columns: list of tuples (original column name, new column name)
+        :return: list of chunks of all_columns
+        """
+        layout_plan = self.layout_plan
+        if isinstance(layout_plan, str):
+            layout_plan = self._read_layout_plan(layout_plan)
+
+        if not layout_plan:
+            return list(self._chunker(all_columns, self.n_columns_per_table))
+
+        columns_by_name = {col[1]: col for col in all_columns}
+
+        chunks = [[]]
+        placed_columns = set()
+
+        def add_columns(columns):
+            for col_group in self._chunker(columns, self.n_columns_per_table):
+                if len(chunks[-1]) + len(col_group) > self.n_columns_per_table:
+                    chunks.append([])
+
+                chunks[-1].extend(col_group)
+
+        for group in layout_plan:
+            group_columns = [columns_by_name[c] for c in group if c in columns_by_name and c not in placed_columns]
+            placed_columns.update(c[1] for c in group_columns)
+            add_columns(group_columns)
+
+        for col in all_columns:
+            if col[1] in placed_columns:
+                continue
+
+            if len(chunks[-1]) == self.n_columns_per_table:
+                chunks.append([])
+
+            chunks[-1].append(col)
+
+        return [tuple(c) for c in chunks if len(c) > 0]
+
     def _get_db_columns_dtypes(self, ukbcsv_file):
         """
         Returns a Pandas-compatible type list with SQLAlchemy types for each column.
@@ -178,12 +424,14 @@ class Pheno2SQL(DBAccess):
 
         return 'c{}'.format(column_name.replace('.', '_').replace('-', '_'))
 
-    def _create_tables_schema(self, csv_file, csv_file_idx):
+    def _create_tables_schema(self, csv_file, csv_file_idx, create_tables=True):
         """
         Reads the data types of each data field in csv_file and create the necessary database tables.
+        :param create_tables: if False, only the information needed by the next loading stages is computed (tables
+        were already created).
         :return:
         """
-        logger.info('Creating database tables')
+        logger.info('Creating database tables' if create_tables else 'Reading tables schema')
 
         tmp = pd.read_csv(csv_file, index_col=0, header=0, nrows=1, low_memory=False)
         old_columns = tmp.columns.tolist()
@@ -219,7 +467,7 @@ class Pheno2SQL(DBAccess):
         all_columns = tuple(zip(old_columns, new_columns))
 
         # FIXME: check if self.n_columns_per_table is greater than the real number of columns
-        self._loading_tmp['chunked_column_names'] = tuple(enumerate(self._chunker(all_columns, self.n_columns_per_table)))
+        self._loading_tmp['chunked_column_names'] = tuple(enumerate(self._get_column_chunks(all_columns)))
         self._loading_tmp['chunked_table_column_names'] = \
             {self._get_table_name(col_idx, csv_file_idx): [col[1] for col in col_names]
              for col_idx, col_names in self._loading_tmp['chunked_column_names']}
@@ -232,6 +480,9 @@ class Pheno2SQL(DBAccess):
         data_sample = pd.read_csv(csv_file, index_col=0, header=0, nrows=1, dtype=str)
         data_sample = data_sample.rename(columns=self._rename_columns)
 
+        if not create_tables:
+            return
+
         # create fields table
         if csv_file_idx == 0:
             create_table('fields',
@@ -283,14 +534,13 @@ class Pheno2SQL(DBAccess):
             logger.info('Table {} ({} columns)'.format(table_name, len(new_columns_names)))
             data_sample.loc[[], new_columns_names].to_sql(table_name, self._get_db_engine(), if_exists='replace', dtype=db_dtypes)
 
-            with self._get_db_engine().connect() as conn:
-                conn.execute("""
-                    ALTER TABLE {table_name} ADD CONSTRAINT pk_{table_name} PRIMARY KEY (eid);
-                """.format(table_name=table_name))
-
+            # the primary key is created once data is loaded (see _create_constraints)
             with self._get_db_engine().connect() as conn:
                 conn.execute('DROP INDEX ix_{table_name}_eid;'.format(table_name=table_name))
 
+                if self.bulk_load:
+                    conn.execute('ALTER TABLE {table_name} SET UNLOGGED;'.format(table_name=table_name))
+
             # Create auxiliary table
             n_column_names = len(new_columns_names)
             current_start = current_stop
@@ -333,49 +583,132 @@ class Pheno2SQL(DBAccess):
             logger.warning(f'No {self.csv_files_encoding_file} found, assuming {self.csv_files_encoding}')
             return self.csv_files_encoding
 
-    def _save_column_range(self, csv_file, csv_file_idx, column_names_idx, column_names):
+    def _save_column_range(self, csv_file, csv_file_idx, column_names_idx, column_names, collect_eids=False):
+        """
+        Writes the columns of a table to a temporary CSV file.
+        :param collect_eids: if True, the eids read are also returned (they are the same for all tables of a CSV file).
+        :return: the table name, the temporary CSV file, statistics and the eids (or None).
+        """
         table_name = self._get_table_name(column_names_idx, csv_file_idx)
         output_csv_filename = os.path.join(get_tmpdir(self.tmpdir), table_name + '.csv')
         full_column_names = ['eid'] + [x[0] for x in column_names]
 
-        data_reader = pd.read_csv(csv_file, index_col=0, header=0, usecols=full_column_names,
-                                  chunksize=self.loading_chunksize, dtype=str,
-                                  encoding=self._get_file_encoding(csv_file))
+        start_time = time.perf_counter()
+        csv_file_size = os.path.getsize(csv_file)
+        progress = ProgressReporter(table_name)
+        n_rows = 0
+        eids_chunks = []
 
-        new_columns = [x[1] for x in column_names]
+        # the file is opened here to know how much of it was read
+        with open(csv_file, 'rb') as csv_file_handle:
+            data_reader = pd.read_csv(csv_file_handle, index_col=0, header=0, usecols=full_column_names,
+                                      chunksize=self.loading_chunksize, dtype=str,
+                                      encoding=self._get_file_encoding(csv_file))
 
-        logger.debug('{}'.format(output_csv_filename))
+            new_columns = [x[1] for x in column_names]
 
-        write_headers = True
-        if self.db_type == 'sqlite':
-            write_headers = False
+            logger.debug('{}'.format(output_csv_filename))
 
-        for chunk_idx, chunk in enumerate(data_reader):
-            chunk = chunk.rename(columns=self._rename_columns)
-            # chunk = self._replace_null_str(chunk)
+            write_headers = True
+            if self.db_type == 'sqlite':
+                write_headers = False
 
-            if chunk_idx == 0:
-                chunk.loc[:, new_columns].to_csv(output_csv_filename, quoting=csv.QUOTE_NONNUMERIC, na_rep=np.nan, header=write_headers, mode='w')
-            else:
-                chunk.loc[:, new_columns].to_csv(output_csv_filename, quoting=csv.QUOTE_NONNUMERIC, na_rep=np.nan, header=False, mode='a')
+            for chunk_idx, chunk in enumerate(data_reader):
+                chunk = chunk.rename(columns=self._rename_columns)
+                # chunk = self._replace_null_str(chunk)
+
+                if chunk_idx == 0:
+                    chunk.loc[:, new_columns].to_csv(output_csv_filename, quoting=csv.QUOTE_NONNUMERIC, na_rep=np.nan, header=write_headers, mode='w')
+                else:
+                    chunk.loc[:, new_columns].to_csv(output_csv_filename, quoting=csv.QUOTE_NONNUMERIC, na_rep=np.nan, header=False, mode='a')
+
+                if collect_eids:
+                    eids_chunks.append(chunk.index.values.astype(np.int64))
 
+                n_rows += chunk.shape[0]
+                progress.update(csv_file_handle.tell() / csv_file_size if csv_file_size > 0 else 1.0, n_rows)
 
-        return table_name, output_csv_filename
+        self._set_unit_completed('temp_csv:{}'.format(table_name))
+
+        stats = {
+            'table': table_name,
+            'rows': n_rows,
+            'columns': len(new_columns),
+            'bytes_read': csv_file_size,
+            'temp_bytes_written': os.path.getsize(output_csv_filename),
+            'time': time.perf_counter() - start_time,
+            'peak_rss': get_peak_rss(),
+        }
+
+        eids = np.concatenate(eids_chunks) if collect_eids and len(eids_chunks) > 0 else None
+
+        return table_name, output_csv_filename, stats, eids
 
     def _create_temporary_csvs(self, csv_file, csv_file_idx):
         logger.info('Writing temporary CSV files')
 
+        # when resuming, temporary files already written (or loaded) are not written again
+        pending_column_names = []
+        self.table_csvs = []
+
+        tables_names = [self._get_table_name(column_names_idx, csv_file_idx)
+                        for column_names_idx, _ in self._loading_tmp['chunked_column_names']]
+        self._discard_truncated_units([('copy:{}'.format(table_name), table_name) for table_name in tables_names])
+
+        for column_names_idx, column_names in self._loading_tmp['chunked_column_names']:
+            table_name = self._get_table_name(column_names_idx, csv_file_idx)
+            output_csv_filename = os.path.join(get_tmpdir(self.tmpdir), table_name + '.csv')
+
+            if self._is_unit_completed('copy:{}'.format(table_name)) or \
+                    (self._is_unit_completed('temp_csv:{}'.format(table_name)) and os.path.isfile(output_csv_filename)):
+                logger.info('Skipping {} (already done)'.format(table_name))
+                self.table_csvs.append((table_name, output_csv_filename))
+            else:
+                pending_column_names.append((column_names_idx, column_names))
+
         self._close_db_engine()
-        self.table_csvs = Parallel(n_jobs=self.loading_n_jobs)(
-            delayed(self._save_column_range)(csv_file, csv_file_idx, column_names_idx, column_names)
-            for column_names_idx, column_names in self._loading_tmp['chunked_column_names']
+        tables_results = Parallel(n_jobs=self.loading_n_jobs)(
+            delayed(self._save_column_range)(csv_file, csv_file_idx, column_names_idx, column_names,
+                                             collect_eids=(pending_idx == 0))
+            for pending_idx, (column_names_idx, column_names) in enumerate(pending_column_names)
         )
 
+        self.table_csvs.extend((table_name, file_path) for table_name, file_path, _, _ in tables_results)
+
+        for _, _, table_stats, _ in tables_results:
+            self._add_load_profile_unit('create_temporary_csvs', **table_stats)
+
+        # eids of the CSV file (None if no table was written, like when resuming). As before, files without
+        # tables (all their columns were loaded from previous files) do not add eids.
+        if len(tables_results) > 0:
+            csv_eids = tables_results[0][3]
+        elif len(self._loading_tmp['chunked_column_names']) == 0:
+            csv_eids = np.array([], dtype=np.int64)
+        else:
+            csv_eids = None
+
+        self._loading_tmp.setdefault('csv_eids', {})[csv_file_idx] = csv_eids
+
         self.table_list.update(table_name for table_name, file_path in self.table_csvs)
 
+    def _add_load_profile_unit(self, stage, **metrics):
+        if self._load_profiler is not None:
+            self._load_profiler.add_unit(stage, **metrics)
+
     def _load_single_csv(self, table_name, file_path):
         logger.info('{} -> {}'.format(file_path, table_name))
 
+        start_time = time.perf_counter()
+        stats = {
+            'table': table_name,
+            'bytes_read': os.path.getsize(file_path),
+        }
+
+        # a previous (failed) run could have loaded the table without recording it
+        if self._loading_tmp.get('resume', False) and self.db_type == 'postgresql':
+            with self._get_db_engine().connect() as conn:
+                conn.execute('TRUNCATE {}'.format(table_name))
+
         if self.db_type == 'sqlite':
             statement = (
                 '.mode csv\n' +
@@ -408,27 +741,52 @@ class Pheno2SQL(DBAccess):
                 "\copy {table_name} from '{file_path}' (format csv, header, null ('nan'))"
             ).format(**locals())
 
-            self._run_psql(statement)
+            psql_output = self._run_psql(statement)
+
+            copy_match = re.search(r'COPY (?P<rows>[0-9]+)', psql_output)
+            if copy_match is not None:
+                stats['rows'] = int(copy_match.group('rows'))
+
+            self._set_unit_completed('copy:{}'.format(table_name))
 
             if self.delete_temp_csv:
                 logger.debug(f'Removing CSV already loaded: {file_path}')
                 os.remove(file_path)
 
+        stats['copy_time'] = time.perf_counter() - start_time
+        stats['peak_rss'] = get_peak_rss()
+
+        return stats
+
     def _load_csv(self):
         logger.info('Loading CSV files into database')
 
         if self.db_type != 'sqlite':
             self._close_db_engine()
             # parallel csv loading is only supported in databases different than sqlite
-            Parallel(n_jobs=self.loading_n_jobs)(
+            tables_stats = Parallel(n_jobs=self.loading_n_jobs)(
                 delayed(self._load_single_csv)(table_name, file_path)
                 for table_name, file_path in self.table_csvs
+                if not self._is_unit_completed('copy:{}'.format(table_name))
             )
         else:
-            for table_name, file_path in self.table_csvs:
+            tables_stats = [
                 self._load_single_csv(table_name, file_path)
+                for table_name, file_path in self.table_csvs
+            ]
+
+        for table_stats in tables_stats:
+            self._add_load_profile_unit('load_csv', **table_stats)
+
+    def _get_csv_eids(self, csv_file):
+        eids = pd.read_csv(csv_file, usecols=[0], header=0, dtype=str, encoding=self._get_file_encoding(csv_file))
+        return eids.iloc[:, 0].values.astype(np.int64)
 
     def _load_all_eids(self):
+        """
+        Loads the eids of all CSV files. They are collected when temporary CSV files are written (or read from the
+        eid column of the CSV file otherwise), so phenotype tables are not read.
+        """
         logger.info('Loading all eids into table {}'.format(ALL_EIDS_TABLE))
 
         create_table(ALL_EIDS_TABLE,
@@ -441,23 +799,24 @@ class Pheno2SQL(DBAccess):
             db_engine=self._get_db_engine()
          )
 
-        select_eid_sql = ' UNION DISTINCT '.join(
-            'select eid from {}'.format(table_name)
-            for table_name in self.table_list
-        )
+        csv_eids = self._loading_tmp.get('csv_eids', {})
 
-        insert_eids_sql = """
-            insert into {all_eids_table} (eid)
-            (
-                {sql_eids}
-            )
-        """.format(
-            all_eids_table=ALL_EIDS_TABLE,
-            sql_eids=select_eid_sql
-        )
+        all_eids = np.array([], dtype=np.int64)
+        for csv_file_idx, csv_file in enumerate(self.ukb_csvs):
+            eids = csv_eids.get(csv_file_idx)
+            if eids is None:
+                eids = self._get_csv_eids(csv_file)
 
-        with self._get_db_engine().connect() as con:
-            con.execute(insert_eids_sql)
+            all_eids = np.union1d(all_eids, eids)
+
+        all_eids = pd.DataFrame({'eid': all_eids})
+
+        if self.db_type == 'sqlite':
+            all_eids.to_sql(ALL_EIDS_TABLE, self._get_db_engine(), if_exists='append', index=False)
+        else:
+            copy_data(ALL_EIDS_TABLE, all_eids, self._get_db_engine())
+
+        self._add_load_profile_unit('load_all_eids', rows=all_eids.shape[0])
 
     def _load_bgen_samples(self):
         if self.bgen_sample_file is None or not os.path.isfile(self.bgen_sample_file):
@@ -488,6 +847,19 @@ class Pheno2SQL(DBAccess):
         current_env = os.environ.copy()
         current_env['PGPASSWORD'] = self.db_pass
 
+        pg_options = []
+
+        search_path = self._get_search_path()
+        if search_path is not None:
+            pg_options.append('-c search_path={}'.format(','.join(search_path)))
+
+        # COPY does not wait for its WAL records to be flushed to disk
+        if self.bulk_load:
+            pg_options.append('-c synchronous_commit=off')
+
+        if len(pg_options) > 0:
+            current_env['PGOPTIONS'] = ' '.join(pg_options)
+
         p = Popen(['psql', '-w', '-h', self.db_host, '-p', str(self.db_port),
                    '-U', self.db_user, '-d', self.db_name,
                    '-f' if is_file else '-c', sql_statement],
@@ -502,6 +874,8 @@ class Pheno2SQL(DBAccess):
         elif stderr_data is not None and 'ERROR:' in stderr_data:
             raise UkbRestSQLExecutionError(stderr_data)
 
+        return stdout_data
+
     def _load_events(self):
         if self.db_type == 'sqlite':
             logger.warning('Events loading is not supported in SQLite')
@@ -519,10 +893,8 @@ class Pheno2SQL(DBAccess):
                 'instance integer NOT NULL',
                 'event text NOT NULL',
             ],
-            constraints=[
-                'pk_events PRIMARY KEY (eid, field_id, instance, event)'
-            ],
-            db_engine=db_engine
+            db_engine=db_engine,
+            unlogged=self.bulk_load
          )
 
         # insert data of categorical multiple fields
@@ -550,8 +922,64 @@ class Pheno2SQL(DBAccess):
                 tables=self._create_joins(list(set(field_data['table_name'])), join_type='inner join'),
             )
 
+            start_time = time.perf_counter()
+
             with db_engine.connect() as con:
-                con.execute(sql_st)
+                n_rows = con.execute(sql_st).rowcount
+
+            self._add_load_profile_unit('load_events', field_id=field_id, instance=int(field_instance), rows=n_rows,
+                                        time=time.perf_counter() - start_time)
+
+    def _get_primary_keys(self):
+        """
+        Returns the names of the primary keys of tables in the current schema.
+        """
+        with self._get_db_engine().connect() as conn:
+            return {row[0] for row in conn.execute("""
+                select c.conname
+                from pg_constraint c join pg_namespace n on n.oid = c.connamespace
+                where c.contype = 'p' and n.nspname = current_schema()
+            """)}
+
+    def _get_loading_n_jobs(self):
+        if self.loading_n_jobs > 0:
+            return self.loading_n_jobs
+
+        # same meaning as in joblib (-1 is all CPUs)
+        return max((os.cpu_count() or 1) + 1 + self.loading_n_jobs, 1)
+
+    def _run_index_statements(self, statements, stage='create_constraints'):
+        """
+        Runs statements that build indexes (or primary keys) concurrently, each one on its own connection, with
+        maintenance_work_mem set for it.
+        :param statements: list of tuples with the table name and the SQL statement.
+        :param stage: the loading stage where the time of each statement is reported.
+        """
+        if len(statements) == 0:
+            return
+
+        def run_statement(table_name, sql_statement):
+            start_time = time.perf_counter()
+
+            with self._get_db_engine().connect() as conn:
+                if self.maintenance_work_mem is not None:
+                    conn.execute("select set_config('maintenance_work_mem', %(value)s, false)",
+                                 value=str(self.maintenance_work_mem))
+
+                try:
+                    conn.execute(sql_statement)
+                finally:
+                    if self.maintenance_work_mem is not None:
+                        conn.execute('RESET maintenance_work_mem')
+
+            self._add_load_profile_unit(stage, table=table_name, time=time.perf_counter() - start_time)
+
+        with ThreadPoolExecutor(max_workers=min(self._get_loading_n_jobs(), len(statements))) as executor:
+            futures = [executor.submit(run_statement, table_name, sql_statement)
+                       for table_name, sql_statement in statements]
+
+            for future in futures:
+                future.result()
 
     def _create_constraints(self):
         if self.db_type == 'sqlite':
@@ -560,17 +988,87 @@ class Pheno2SQL(DBAccess):
 
         logger.info('Creating table constraints (indexes, primary keys, etc)')
 
+        # when resuming, some indexes could have been created by the failed run
+        if_not_exists = self._loading_tmp.get('resume', False)
+        existing_primary_keys = self._get_primary_keys() if if_not_exists else set()
+
+        # primary keys are built first (concurrently for all tables), as they lock their table
+        primary_keys = [(table_name, ('eid',)) for table_name in sorted(self.table_list)]
+        primary_keys.append(('events', ('eid', 'field_id', 'instance', 'event')))
+
+        self._run_index_statements([
+            (table_name, 'ALTER TABLE {table_name} ADD CONSTRAINT pk_{table_name} PRIMARY KEY ({columns})'.format(
+                table_name=table_name, columns=', '.join(columns)
+            ))
+            for table_name, columns in primary_keys
+            if 'pk_{}'.format(table_name) not in existing_primary_keys
+        ])
+
+        indexes = []
+
         # bgen's samples table
         if self.bgen_sample_file is not None and os.path.isfile(self.bgen_sample_file):
-            create_indexes(BGEN_SAMPLES_TABLE, ('index', 'eid'), db_engine=self._get_db_engine())
+            indexes.append((BGEN_SAMPLES_TABLE, ('index', 'eid')))
 
         # fields table
-        create_indexes('fields', ('field_id', 'inst', 'arr', 'table_name', 'type', 'coding'),
-                       db_engine=self._get_db_engine())
+        indexes.append(('fields', ('field_id', 'inst', 'arr', 'table_name', 'type', 'coding')))
 
         # events table
-        create_indexes('events', ('eid', 'field_id', 'instance', 'event', ('field_id', 'event')),
-                       db_engine=self._get_db_engine())
+        indexes.append(('events', ('eid', 'field_id', 'instance', 'event', ('field_id', 'event'))))
+
+        self._run_index_statements([
+            (table_name, index_sql)
+            for table_name, columns in indexes
+            for index_sql in get_create_index_statements(table_name, columns, if_not_exists=if_not_exists)
+        ])
+
+    def _get_unlogged_tables(self):
+        with self._get_db_engine().connect() as conn:
+            return {row[0] for row in conn.execute("""
+                select c.relname
+                from pg_class c join pg_namespace n on n.oid = c.relnamespace
+                where c.relkind = 'r' and c.relpersistence = 'u' and n.nspname = current_schema()
+            """)}
+
+    def _set_tables_logged(self):
+        """
+        Switches the tables loaded as UNLOGGED (bulk load) to LOGGED. Each table (with its indexes) is written to
+        the WAL once, instead of logging each row inserted and each index page built.
+        """
+        if not self.bulk_load:
+            return
+
+        loaded_tables = self.table_list | {'events'}
+        unlogged_tables = sorted(self._get_unlogged_tables() & loaded_tables)
+
+        logger.info('Setting {} tables as LOGGED'.format(len(unlogged_tables)))
+
+        self._run_index_statements(
+            [(table_name, 'ALTER TABLE {} SET LOGGED'.format(table_name)) for table_name in unlogged_tables],
+            stage='set_logged'
+        )
+
+    def _discard_truncated_units(self, units):
+        """
+        UNLOGGED tables are emptied when PostgreSQL recovers from a crash, so when resuming a bulk load, units of
+        work whose table is now empty are done again (and then constraints, which skip those already created).
+        :param units: list of tuples with the unit of work and the table it loads.
+        """
+        if not self.bulk_load or not self._loading_tmp.get('resume', False):
+            return
+
+        completed_units = self._loading_tmp['completed_units']
+        unlogged_tables = self._get_unlogged_tables()
+
+        with self._get_db_engine().connect() as conn:
+            for unit, table_name in units:
+                if unit not in completed_units or table_name not in unlogged_tables:
+                    continue
+
+                if not conn.execute('select exists (select 1 from {})'.format(table_name)).scalar():
+                    logger.warning('Table {} was emptied (database crash?), loading it again'.format(table_name))
+                    completed_units.discard(unit)
+                    completed_units.discard('constraints')
 
     def _vacuum(self):
         logger.info('Vacuuming')
@@ -580,34 +1078,101 @@ class Pheno2SQL(DBAccess):
                 vacuum analyze;
             """)
 
-    def load_data(self, vacuum=False):
+    def _run_load_unit(self, unit, func, *args):
+        """
+        Runs a unit of work of the loading process, unless it was completed by a previous run (when resuming).
+        """
+        if self._is_unit_completed(unit):
+            logger.info('Skipping {} (already done)'.format(unit))
+            return
+
+        func(*args)
+
+        self._set_unit_completed(unit)
+
+    def load_data(self, vacuum=False, resume=False):
         """
         Load all CSV files specified into the database configured.
+        :param resume: if True, units of work completed by a previous (failed) run with the same input files and
+        parameters are not done again (tables schema, temporary CSV files, tables loaded, events, etc). In
+        blue/green mode, loading continues in the schema of the failed run.
         :return:
         """
         logger.info('Loading phenotype data into database')
 
+        self._loading_tmp = {}
+        self._load_profiler = profiler = LoadProfiler()
+
         try:
+            if self.blue_green:
+                self._start_schema_load(resume)
+
+            self._init_load_checkpoints(resume)
+
             for csv_file_idx, csv_file in enumerate(self.ukb_csvs):
-                logger.info('Working on {}'.format(csv_file))
+                logger.info('Working on {} ({} of {})'.format(csv_file, csv_file_idx + 1, len(self.ukb_csvs)))
+
+                with profiler.stage('create_tables_schema', csv_file=csv_file):
+                    schema_unit = 'schema:{}'.format(csv_file_idx)
 
-                self._create_tables_schema(csv_file, csv_file_idx)
-                self._create_temporary_csvs(csv_file, csv_file_idx)
-                self._load_csv()
+                    if self._is_unit_completed(schema_unit):
+                        self._create_tables_schema(csv_file, csv_file_idx, create_tables=False)
+                    else:
+                        self._create_tables_schema(csv_file, csv_file_idx)
+                        self._set_unit_completed(schema_unit)
+
+                with profiler.stage('create_temporary_csvs', csv_file=csv_file):
+                    self._create_temporary_csvs(csv_file, csv_file_idx)
+
+                with profiler.stage('load_csv', csv_file=csv_file):
+                    self._load_csv()
+
+            with profiler.stage('load_all_eids'):
+                self._run_load_unit('all_eids', self._load_all_eids)
+
+            with profiler.stage('load_bgen_samples'):
+                self._run_load_unit('bgen_samples', self._load_bgen_samples)
+
+            with profiler.stage('load_events'):
+                self._discard_truncated_units([('events', 'events')])
+                self._run_load_unit('events', self._load_events)
+
+            with profiler.stage('create_constraints'):
+                self._run_load_unit('constraints', self._create_constraints)
+
+            with profiler.stage('set_logged'):
+                self._run_load_unit('set_logged', self._set_tables_logged)
 
-            self._load_all_eids()
-            self._load_bgen_samples()
-            self._load_events()
-            self._create_constraints()
+            self._update_data_generation()
+
+            if self.blue_green:
+                self._copy_derived_phenotypes_registry()
+
+                # derived phenotypes can use tables of the public schema (like codings)
+                self._load_search_path = (self._load_search_path[0], 'public')
+
+            with profiler.stage('refresh_derived_phenotypes'):
+                self._refresh_derived_phenotypes()
 
             if vacuum:
-                self._vacuum()
+                with profiler.stage('vacuum'):
+                    self._vacuum()
+
+            if self.blue_green:
+                self._switch_schema()
 
         except OperationalError as e:
             raise UkbRestSQLExecutionError('There was an error with the database: ' + str(e))
         except UnicodeDecodeError as e:
             logger.debug(str(e))
             raise UkbRestProgramExecutionError('Unicode decoding error when reading CSV file. Activate debug to show more details.')
+        finally:
+            # the profile is also useful when loading fails
+            if self.load_profile_file is not None:
+                profiler.save(self.load_profile_file)
+
+            self._load_profiler = None
+            self._load_search_path = None
 
         # delete temporary variable
         del(self._loading_tmp)
@@ -637,6 +1202,63 @@ class Pheno2SQL(DBAccess):
             '{join_type} {table} using (eid) '.format(join_type=join_type, table=t) for t in tables[1:]
         ])
 
+    def _get_table_eids_group(self, table_name):
+        """
+        Returns an identifier of the set of eids a table has. All phenotype tables created from the same CSV file
+        have exactly the same eids; any other table (for instance, from samples data) is its own group.
+        """
+        match = re.match('^{}(?P<csv_file_idx>[0-9]+)_[0-9]+$'.format(re.escape(self.table_prefix)), table_name)
+        if match is not None:
+            return 'csv_{}'.format(match.group('csv_file_idx'))
+
+        return table_name
+
+    def _group_tables_by_eids(self, tables):
+        """
+        Groups tables with the same set of eids. Each table is returned as a tuple (relation, name), as expected by
+        _create_eid_joins.
+        """
+        groups = {}
+        groups_order = []
+
+        for table in tables:
+            group = self._get_table_eids_group(table)
+
+            if group not in groups:
+                groups[group] = []
+                groups_order.append(group)
+
+            groups[group].append((table, table))
+
+        return [groups[g] for g in groups_order]
+
+    def _create_eid_joins(self, relations_groups):
+        """
+        Joins relations by eid, keeping all eids present in at least one of them (as a chain of full outer joins
+        would do). Relations in the same group have the same set of eids, so they are inner joined. If there is
+        more than one group, the all_eids table is used as the driving table with left joins, and a condition is
+        returned to keep only those eids present in any group.
+
+        :param relations_groups: list of groups; each group is a list of tuples (relation SQL, relation name).
+        :return: a tuple with the join SQL and a condition for the where clause (None if not needed).
+        """
+        relations_groups = [g for g in relations_groups if len(g) > 0]
+
+        if len(relations_groups) == 0:
+            return '', None
+
+        if len(relations_groups) == 1:
+            return self._create_joins([r for r, _ in relations_groups[0]], join_type='inner join'), None
+
+        joins_sql = self._create_joins(
+            [ALL_EIDS_TABLE] + [r for g in relations_groups for r, _ in g],
+            join_type='left outer join'
+        )
+
+        eids_condition = ' or '.join('{}.eid is not null'.format(g[0][1]) for g in relations_groups)
+
+        return joins_sql, eids_condition
+
     def _get_needed_tables(self, all_columns):
         if len(all_columns) == 0:
             return []
@@ -696,32 +1318,75 @@ class Pheno2SQL(DBAccess):
     def _get_integer_fields(self, columns):
         """This method returns a list of fields (either its column specification, like c64_0_0 or its rename like
         myfield) that are of type integer."""
-        int_columns = []
+        return [col for col, col_type in self.get_columns_types(columns).items() if col_type == 'Integer']
 
-        for col in columns:
-            if col == 'eid':
+    def _find_closing_parenthesis(self, statement, start):
+        """
+        Returns the position of the parenthesis closing the one at position start (None if not found). Quoted
+        strings are skipped.
+        """
+        depth = 0
+        in_quotes = False
+
+        for idx in range(start, len(statement)):
+            char = statement[idx]
+
+            if char == "'":
+                in_quotes = not in_quotes
+            elif in_quotes:
                 continue
+            elif char == '(':
+                depth += 1
+            elif char == ')':
+                depth -= 1
 
-            match = re.search(Pheno2SQL.RE_FULL_COLUMN_NAME_RENAME, col)
+                if depth == 0:
+                    return idx
 
-            if match is None:
+        return None
+
+    def _rewrite_not_in_subqueries(self, statement, eid_column):
+        """
+        Rewrites conditions like "eid not in (select eid from ...)" as "not exists (...)", so PostgreSQL can plan
+        them as an anti join. Both are equivalent as long as the subquery does not return NULL eids.
+        :param statement: SQL condition.
+        :param eid_column: qualified eid column of the outer query (like all_eids.eid), since an unqualified eid
+        would refer to the subquery.
+        """
+        new_statement = []
+        current_pos = 0
+
+        for match in re.finditer(Pheno2SQL.RE_NOT_IN_SUBQUERY, statement):
+            if match.start() < current_pos:
+                # nested in a subquery already rewritten
                 continue
 
-            col_field = match.group('field')
+            open_parenthesis_pos = match.end() - 1
+            close_parenthesis_pos = self._find_closing_parenthesis(statement, open_parenthesis_pos)
+            if close_parenthesis_pos is None:
+                continue
 
-            if self.get_field_dtype(col_field) != 'Integer':
+            subquery = statement[open_parenthesis_pos + 1:close_parenthesis_pos]
+            if re.match(Pheno2SQL.RE_SELECT_EID, subquery) is None:
                 continue
 
-            # select rename first, if not specified select field column
-            col_rename = next((grp_val for grp_val in (match.group('rename'), match.group('field')) if grp_val is not None))
-            int_columns.append(col_rename)
+            new_statement.append(statement[current_pos:match.start()])
+            new_statement.append('not exists (select 1 from ({subquery}) nx where nx.eid = {eid_column})'.format(
+                subquery=subquery, eid_column=eid_column))
+
+            current_pos = close_parenthesis_pos + 1
 
-        return int_columns
+        new_statement.append(statement[current_pos:])
+
+        return ''.join(new_statement)
+
+    def _get_filterings(self, filter_statements, eid_column=None):
+        if self.rewrite_not_in and eid_column is not None:
+            filter_statements = [self._rewrite_not_in_subqueries(afilter, eid_column) for afilter in filter_statements]
 
-    def _get_filterings(self, filter_statements):
         return ' AND '.join('({})'.format(afilter) for afilter in filter_statements)
 
-    def _query_generic(self, sql_query, order_by_dict=None, results_transformator=None):
+    def _query_generic(self, sql_query, order_by_dict=None, results_transformator=None, parameters=None):
         final_sql_query = sql_query
 
         if order_by_dict is not None:
@@ -742,66 +1407,647 @@ class Pheno2SQL(DBAccess):
 
         logger.debug(final_sql_query)
 
+        # prepared statements only exist in the connection (session) where they were created
+        conn = None
+        if self._use_prepared_statements():
+            conn = self._get_db_engine().connect()
+
         try:
-            results_iterator = pd.read_sql(
-                final_sql_query, self._get_db_engine(), index_col='eid', chunksize=self.sql_chunksize
-            )
-        except ProgrammingError as e:
-            raise UkbRestSQLExecutionError(str(e))
+            if conn is not None:
+                final_sql_query, parameters = self._prepare_statement(conn, final_sql_query, parameters)
 
-        if self.sql_chunksize is None:
-            results_iterator = iter([results_iterator])
+            self._check_query_cost(final_sql_query, parameters, conn)
 
-        for chunk in results_iterator:
-            if results_transformator is not None:
-                chunk = results_transformator(chunk)
+            try:
+                with timed('sql'):
+                    results_iterator = pd.read_sql(
+                        final_sql_query, conn if conn is not None else self._get_db_engine(), params=parameters,
+                        index_col='eid', chunksize=self.sql_chunksize
+                    )
+            except ProgrammingError as e:
+                raise UkbRestSQLExecutionError(str(e))
 
-            yield chunk
+            if self.sql_chunksize is None:
+                results_iterator = iter([results_iterator])
 
-    def _get_query_sql(self, columns=None, ecolumns=None, filterings=None):
-        # select needed tables to join
-        columns_fields = self._get_fields_from_statements(columns)
-        reg_exp_columns_fields = self._get_fields_from_reg_exp(ecolumns)
-        filterings_columns_fields = self._get_fields_from_statements(filterings)
+            while True:
+                # with chunks, rows are fetched while the response is sent
+                with timed('sql'):
+                    chunk = next(results_iterator, None)
 
-        tables_needed_df = self._get_needed_tables(columns_fields + reg_exp_columns_fields + filterings_columns_fields)
+                if chunk is None:
+                    break
 
-        all_columns = ['eid'] + (columns if columns is not None else []) + reg_exp_columns_fields
+                if results_transformator is not None:
+                    with timed('transform'):
+                        chunk = results_transformator(chunk)
 
-        base_sql = """
-            select {data_fields}
-            {from_clause}
-            {where_statements}
-        """
+                METRICS.inc(ROWS_TOTAL, chunk.shape[0])
 
-        tables_join_sql = self._create_joins(tables_needed_df, join_type='full outer join')
+                yield chunk
+        finally:
+            if conn is not None:
+                conn.close()
 
-        if tables_join_sql:
-            from_clause_sql = f'from {tables_join_sql}'
-        else:
-            from_clause_sql = 'from all_eids'
+    def _use_prepared_statements(self):
+        # with an external pool (in transaction mode) consecutive statements may run on different server sessions
+        return self.prepared_statements and self.db_type == 'postgresql' and \
+            not self.db_pool_parameters.get('external_pool', False)
 
+    def _get_statements_template(self, statements):
+        """
+        Replaces the constants compared in the statements (like 40 in "c21003_0_0 > 40") by parameters, so queries
+        differing only in those constants have the same SQL code.
+        :return: a tuple with the statements (with parameters $1, $2, ...) and the list of values.
+        """
+        values = []
 
-        return base_sql.format(
-            data_fields=','.join(all_columns),
-            from_clause=from_clause_sql,
-            where_statements=((' where ' + self._get_filterings(filterings)) if filterings is not None else ''),
-        )
+        def replace_literal(match):
+            if match.group('string') is not None:
+                return match.group('string')
 
-    def query(self, columns=None, ecolumns=None, filterings=None, order_by_table=None):
-        reg_exp_columns_fields = self._get_fields_from_reg_exp(ecolumns)
-        all_columns = ['eid'] + (columns if columns is not None else []) + reg_exp_columns_fields
+            literal = match.group('literal')
 
-        order_by_dict = None
-        if order_by_table is not None:
-            order_by_dict = {
-                'table': order_by_table,
-                'columns_select': ','.join(all_columns),
-            }
+            if literal.startswith("'"):
+                values.append(literal[1:-1].replace("''", "'"))
+                param_type = ''
+            else:
+                values.append(literal)
+                # integer literals as bigint, so they can use indexes on integer columns
+                if re.fullmatch('-?\\d+', literal) and -2**63 <= int(literal) < 2**63:
+                    param_type = '::bigint'
+                else:
+                    param_type = '::numeric'
+
+            return '{}${}{}'.format(match.group('operator'), len(values), param_type)
+
+        templates = [re.sub(Pheno2SQL.RE_FILTER_LITERAL, replace_literal, str(st)) for st in statements]
+
+        return templates, values
+
+    def _prepare_statement(self, conn, sql_query, parameters=None):
+        """
+        Prepares the query in the connection, if it was not done before.
+        :return: a tuple with the SQL code to execute the prepared statement and its parameters.
+        """
+        parameters = parameters if parameters is not None else []
+
+        statement_name = 'ukbrest_{}'.format(hashlib.md5(sql_query.encode('utf-8')).hexdigest()[:20])
+        prepared_statements = conn.connection.info.setdefault('ukbrest_prepared_statements', set())
+
+        with self._prepared_statements_lock:
+            self._prepared_statements_stats['hits' if statement_name in prepared_statements else 'misses'] += 1
+
+        if statement_name not in prepared_statements:
+            if len(prepared_statements) >= Pheno2SQL.MAX_PREPARED_STATEMENTS:
+                conn.execute('DEALLOCATE ALL')
+                prepared_statements.clear()
+
+            try:
+                conn.execute('PREPARE {} AS {}'.format(statement_name, sql_query))
+            except ProgrammingError as e:
+                raise UkbRestSQLExecutionError(str(e))
+
+            prepared_statements.add(statement_name)
+
+        execute_sql = 'EXECUTE {}'.format(statement_name)
+        if len(parameters) == 0:
+            return execute_sql, None
+
+        execute_sql += ' ({})'.format(', '.join('%(p{})s'.format(i) for i in range(len(parameters))))
+
+        return execute_sql, {'p{}'.format(i): value for i, value in enumerate(parameters)}
+
+    def get_prepared_statements_stats(self):
+        """
+        Returns how many times queries were run with an already prepared statement (hits) and how many times they
+        had to be prepared (misses).
+        """
+        with self._prepared_statements_lock:
+            stats = dict(self._prepared_statements_stats)
+
+        n_queries = stats['hits'] + stats['misses']
+        stats['hit_rate'] = stats['hits'] / n_queries if n_queries > 0 else None
+
+        return stats
+
+    def _get_query_plan(self, sql_query, parameters=None, conn=None):
+        """
+        Returns the plan estimated by PostgreSQL for a query (the query is not run).
+        """
+        explain_sql = 'explain (format json) {}'.format(sql_query)
+
+        try:
+            if conn is not None:
+                query_plan = conn.execute(explain_sql, parameters).scalar() if parameters else \
+                    conn.execute(explain_sql).scalar()
+            else:
+                with self._get_db_engine().connect() as conn:
+                    query_plan = conn.execute(explain_sql).scalar()
+        except ProgrammingError as e:
+            raise UkbRestSQLExecutionError(str(e))
+
+        if isinstance(query_plan, str):
+            query_plan = json.loads(query_plan)
+
+        return query_plan[0]['Plan']
+
+    def _check_query_cost(self, sql_query, parameters=None, conn=None):
+        if self.max_query_cost is None:
+            return
+
+        query_cost = self._get_query_plan(sql_query, parameters, conn)['Total Cost']
+
+        if query_cost > self.max_query_cost:
+            raise UkbRestQueryCostError(
+                'The estimated cost of the query ({:.0f}) is larger than the maximum allowed ({:.0f}). Try requesting '
+                'less columns or adding filters.'.format(query_cost, self.max_query_cost)
+            )
+
+    def _explain_sql(self, sql_query, columns):
+        query_plan = self._get_query_plan(sql_query)
+
+        def get_relations(plan_node):
+            relations = [plan_node['Relation Name']] if 'Relation Name' in plan_node else []
+
+            for child_node in plan_node.get('Plans', []):
+                relations.extend(get_relations(child_node))
+
+            return relations
+
+        return {
+            'sql': sql_query.strip(),
+            'tables': sorted(set(get_relations(query_plan))),
+            'n_columns': len(columns),
+            'columns': columns,
+            'startup_cost': query_plan['Startup Cost'],
+            'total_cost': query_plan['Total Cost'],
+            'plan_rows': query_plan['Plan Rows'],
+            'max_query_cost': self.max_query_cost,
+            'allowed': self.max_query_cost is None or query_plan['Total Cost'] <= self.max_query_cost,
+        }
+
+    def explain(self, columns=None, ecolumns=None, filterings=None):
+        """
+        Returns information about a query without running it: the SQL code, tables used, columns selected and
+        the costs estimated by PostgreSQL.
+        """
+        sql_query = self._get_query_sql(columns, ecolumns, filterings)
+
+        all_columns = (columns if columns is not None else []) + self._get_fields_from_reg_exp(ecolumns)
+
+        return self._explain_sql(sql_query, all_columns)
+
+    def explain_yaml(self, yaml_file, section):
+        """
+        Same as explain, but for a YAML section.
+        """
+        if section not in yaml_file:
+            raise UkbRestValidationError('Section {} not found'.format(section))
+
+        if section.startswith('simple_'):
+            section_field_statements, include_only_stmts, samples_filter_table = \
+                self._get_yaml_simple_data_args(yaml_file, section)
+
+            sql_query = self._get_query_sql(section_field_statements, filterings=include_only_stmts,
+                                            samples_filter_table=samples_filter_table)
+            all_columns = list(yaml_file[section].keys())
+        else:
+            sql_query, all_columns = self._get_yaml_section_sql(yaml_file, section)
+
+        return self._explain_sql(sql_query, all_columns)
+
+    def _get_load_key(self):
+        """
+        Identifies a load by its input files and the parameters that change the tables created, so checkpoints of a
+        different load are not used when resuming.
+        """
+        load_info = [
+            self.table_prefix,
+            str(self.n_columns_per_table),
+            json.dumps(self.layout_plan, sort_keys=True, default=str),
+        ]
+
+        for csv_file in self.ukb_csvs:
+            csv_file_stat = os.stat(csv_file)
+            load_info.extend([os.path.realpath(csv_file), str(csv_file_stat.st_size), str(csv_file_stat.st_mtime)])
+
+        return hashlib.md5('\n'.join(load_info).encode('utf-8')).hexdigest()
+
+    def _init_load_checkpoints(self, resume):
+        """
+        Creates the checkpoints table (if needed) and returns the units of work already completed. If resume is
+        False, or checkpoints belong to a different load, previous checkpoints are removed.
+        """
+        if self.db_type == 'sqlite':
+            return set()
+
+        create_table(LOAD_CHECKPOINTS_TABLE,
+            columns=[
+                'unit text NOT NULL',
+                'load_key text NOT NULL',
+                'completed_at timestamp NOT NULL DEFAULT now()',
+            ],
+            constraints=[
+                'pk_{} PRIMARY KEY (unit)'.format(LOAD_CHECKPOINTS_TABLE)
+            ],
+            db_engine=self._get_db_engine(),
+            drop_if_exists=False
+        )
+
+        load_key = self._get_load_key()
+
+        checkpoints = pd.read_sql(
+            'select unit, load_key from {}'.format(LOAD_CHECKPOINTS_TABLE), self._get_db_engine()
+        )
+
+        completed_units = set()
+
+        if resume:
+            if (checkpoints['load_key'] != load_key).any():
+                logger.warning('Checkpoints belong to a different load (input files or parameters changed), '
+                               'starting from the beginning')
+            else:
+                completed_units = set(checkpoints['unit'])
+                logger.info('Resuming load: {} units of work already completed'.format(len(completed_units)))
+
+        if len(completed_units) == 0:
+            with self._get_db_engine().connect() as conn:
+                conn.execute('DELETE FROM {}'.format(LOAD_CHECKPOINTS_TABLE))
+
+        self._loading_tmp['load_key'] = load_key
+        self._loading_tmp['completed_units'] = completed_units
+        self._loading_tmp['resume'] = len(completed_units) > 0
+
+        return completed_units
+
+    def _is_unit_completed(self, unit):
+        return unit in self._loading_tmp.get('completed_units', ())
+
+    def _set_unit_completed(self, unit):
+        """
+        Records that a unit of work finished (it can be called from loading workers).
+        """
+        if self.db_type == 'sqlite':
+            return
+
+        with self._get_db_engine().connect() as conn:
+            conn.execute(
+                """
+                INSERT INTO {checkpoints_table} (unit, load_key) VALUES (%(unit)s, %(load_key)s)
+                ON CONFLICT (unit) DO NOTHING
+                """.format(checkpoints_table=LOAD_CHECKPOINTS_TABLE),
+                unit=unit, load_key=self._loading_tmp['load_key']
+            )
+
+    def _start_schema_load(self, resume):
+        """
+        Creates the schema where data is loaded in blue/green mode (or, when resuming, reuses the one of the failed
+        load), and makes it the only one visible while loading. Schemas of other failed loads are removed.
+        """
+        db_engine = self._get_default_db_engine()
 
-        int_columns = self._get_integer_fields(all_columns)
+        create_table(BLUE_GREEN_SCHEMAS_TABLE,
+            columns=[
+                'name text NOT NULL',
+                'status text NOT NULL',
+                'created_at timestamp NOT NULL DEFAULT now()',
+                'activated_at timestamp',
+            ],
+            constraints=[
+                'pk_{} PRIMARY KEY (name)'.format(BLUE_GREEN_SCHEMAS_TABLE)
+            ],
+            db_engine=db_engine,
+            drop_if_exists=False
+        )
+
+        with db_engine.connect() as conn:
+            loading_schemas = [row[0] for row in conn.execute(
+                "select name from {} where status = 'loading' order by created_at desc".format(BLUE_GREEN_SCHEMAS_TABLE)
+            )]
+
+        schema_name = None
+        if resume and len(loading_schemas) > 0:
+            schema_name = loading_schemas.pop(0)
+            logger.info('Resuming load into schema {}'.format(schema_name))
+
+        self._drop_schemas(loading_schemas)
+
+        if schema_name is None:
+            schema_name = '{}{}_{}'.format(
+                BLUE_GREEN_SCHEMA_PREFIX, datetime.now().strftime('%Y%m%d%H%M%S'), uuid.uuid4().hex[:8]
+            )
+
+            logger.info('Loading data into new schema {}'.format(schema_name))
+
+            with db_engine.begin() as conn:
+                conn.execute('CREATE SCHEMA {}'.format(schema_name))
+                conn.execute(
+                    "INSERT INTO {} (name, status) VALUES (%(name)s, 'loading')".format(BLUE_GREEN_SCHEMAS_TABLE),
+                    name=schema_name
+                )
+
+        # tables being replaced (in the active schema or in public) are not visible while loading
+        self._load_search_path = (schema_name,)
+
+        return schema_name
+
+    def _copy_derived_phenotypes_registry(self):
+        """
+        Copies the registry of derived phenotypes from the active schema (or public) into the schema being loaded,
+        so they are materialized there before switching to it.
+        """
+        schema_name = self._load_search_path[0]
+        source_schema = self._get_active_schema() or 'public'
+
+        db_engine = self._get_default_db_engine()
+        if not db_engine.has_table(DERIVED_PHENOTYPES_TABLE, schema=source_schema):
+            return
+
+        with db_engine.begin() as conn:
+            conn.execute("""
+                DROP TABLE IF EXISTS {schema_name}.{registry_table};
+                CREATE TABLE {schema_name}.{registry_table} (LIKE {source_schema}.{registry_table} INCLUDING ALL);
+                INSERT INTO {schema_name}.{registry_table} SELECT * FROM {source_schema}.{registry_table};
+            """.format(schema_name=schema_name, source_schema=source_schema, registry_table=DERIVED_PHENOTYPES_TABLE))
+
+    def _switch_schema(self):
+        """
+        Makes the schema just loaded the active one (in a single transaction) and drops old retired schemas.
+        Processes serving queries start using it within ACTIVE_SCHEMA_CHECK_INTERVAL seconds.
+        """
+        schema_name = self._load_search_path[0]
+
+        db_engine = self._get_default_db_engine()
+
+        with db_engine.begin() as conn:
+            conn.execute(
+                "UPDATE {} SET status = 'retired' WHERE status = 'active'".format(BLUE_GREEN_SCHEMAS_TABLE)
+            )
+            conn.execute(
+                "UPDATE {} SET status = 'active', activated_at = now() WHERE name = %(name)s".format(
+                    BLUE_GREEN_SCHEMAS_TABLE
+                ),
+                name=schema_name
+            )
+
+        logger.info('Schema {} is now active'.format(schema_name))
+
+        self._load_search_path = None
+        self._active_schema = (schema_name, time.monotonic())
+
+        with db_engine.connect() as conn:
+            retired_schemas = [row[0] for row in conn.execute(
+                "select name from {} where status = 'retired' order by activated_at desc".format(
+                    BLUE_GREEN_SCHEMAS_TABLE
+                )
+            )]
+
+        self._drop_schemas(retired_schemas[self.RETIRED_SCHEMAS_KEPT:])
+
+    def _drop_schemas(self, schemas):
+        with self._get_default_db_engine().connect() as conn:
+            for schema_name in schemas:
+                logger.info('Dropping schema {}'.format(schema_name))
+
+                conn.execute('DROP SCHEMA IF EXISTS {} CASCADE'.format(schema_name))
+                conn.execute(
+                    'DELETE FROM {} WHERE name = %(name)s'.format(BLUE_GREEN_SCHEMAS_TABLE),
+                    name=schema_name
+                )
+
+    def _get_data_generation(self):
+        """
+        Returns the identifier of the data currently loaded (it changes each time data is loaded). It is read again
+        only every DATA_GENERATION_CHECK_INTERVAL seconds.
+        """
+        db_uri = self._get_db_uri()
+
+        data_generation_db_uri, data_generation, check_time = self._data_generation
+        if data_generation_db_uri == db_uri and \
+                time.monotonic() - check_time < self.DATA_GENERATION_CHECK_INTERVAL:
+            return data_generation
+
+        data_generation = ''
+        if self._get_db_engine().has_table(METADATA_TABLE):
+            data_generation_df = pd.read_sql(
+                "select value from {} where key = 'data_generation'".format(METADATA_TABLE),
+                self._get_db_engine()
+            )
+
+            if data_generation_df.shape[0] > 0:
+                data_generation = data_generation_df.iloc[0, 0]
+
+        self._data_generation = (db_uri, data_generation, time.monotonic())
+
+        return data_generation
+
+    def _update_data_generation(self):
+        if self.db_type == 'sqlite':
+            return
 
-        final_sql_query = self._get_query_sql(columns, ecolumns, filterings)
+        create_table(METADATA_TABLE,
+            columns=[
+                'key text NOT NULL',
+                'value text NOT NULL',
+            ],
+            constraints=[
+                'pk_{} PRIMARY KEY (key)'.format(METADATA_TABLE)
+            ],
+            db_engine=self._get_db_engine(),
+            drop_if_exists=False
+        )
+
+        data_generation = uuid.uuid4().hex
+
+        with self._get_db_engine().connect() as conn:
+            conn.execute("""
+                DELETE FROM {metadata_table} WHERE key = 'data_generation';
+                INSERT INTO {metadata_table} (key, value) VALUES ('data_generation', %(data_generation)s);
+            """.format(metadata_table=METADATA_TABLE), data_generation=data_generation)
+
+        self._data_generation = (self._get_db_uri(), data_generation, time.monotonic())
+
+        # samples filters evaluated on previous data are not valid anymore
+        samples_filters_tables = pd.read_sql(
+            "select tablename from pg_tables where schemaname = current_schema() and tablename like %(prefix)s",
+            self._get_db_engine(),
+            params={'prefix': SAMPLES_FILTERS_TABLE_PREFIX.replace('_', '\\_') + '%'}
+        )
+
+        with self._get_db_engine().connect() as conn:
+            for table_name in samples_filters_tables['tablename']:
+                conn.execute('DROP TABLE IF EXISTS {}'.format(table_name))
+
+        self._samples_filters_tables = {}
+        self._derived_phenotypes_tables = {}
+
+    def refresh_derived_data(self):
+        """
+        Invalidates the samples filters evaluated on previous data and refreshes materialized sections. It must be
+        called when tables that queries can use change outside load_data (like withdrawals, codings or samples data
+        loaded by the Postloader).
+        """
+        if self.db_type == 'sqlite':
+            return
+
+        self._update_data_generation()
+        self._refresh_derived_phenotypes()
+
+    def _get_samples_filters_table(self, samples_filters):
+        """
+        Evaluates the samples filters once per data generation and stores the selected eids in a table, which is
+        then joined by queries instead of applying the filters again on each subquery.
+        :param samples_filters: list of conditions (AND).
+        :return: the name of the table with the selected eids.
+        """
+        filters_key = hashlib.md5(
+            json.dumps([self._get_data_generation()] + sorted(str(f) for f in samples_filters)).encode('utf-8')
+        ).hexdigest()
+
+        if filters_key in self._samples_filters_tables:
+            return self._samples_filters_tables[filters_key]
+
+        table_name = SAMPLES_FILTERS_TABLE_PREFIX + filters_key[:20]
+
+        if not self._get_db_engine().has_table(table_name):
+            logger.info('Evaluating samples filters into table {}'.format(table_name))
+
+            filters_tables = self._get_needed_tables(self._get_fields_from_statements(samples_filters))
+
+            try:
+                with self._get_db_engine().connect() as conn:
+                    conn.execute("""
+                        CREATE TABLE {table_name} AS
+                            select distinct eid
+                            from {filters_joins}
+                            where {filters};
+                        ALTER TABLE {table_name} ADD CONSTRAINT pk_{table_name} PRIMARY KEY (eid);
+                        ANALYZE {table_name};
+                    """.format(
+                        table_name=table_name,
+                        filters_joins=self._create_joins([ALL_EIDS_TABLE] + filters_tables),
+                        filters=self._get_filterings(samples_filters, eid_column='{}.eid'.format(ALL_EIDS_TABLE)),
+                    ))
+            except ProgrammingError as e:
+                # another process could have created it in the meantime
+                if not self._get_db_engine().has_table(table_name):
+                    raise UkbRestSQLExecutionError(str(e))
+
+        self._samples_filters_tables[filters_key] = table_name
+
+        return table_name
+
+    def _get_query_sql(self, columns=None, ecolumns=None, filterings=None, samples_filter_table=None):
+        # select needed tables to join
+        columns_fields = self._get_fields_from_statements(columns)
+        reg_exp_columns_fields = self._get_fields_from_reg_exp(ecolumns)
+        filterings_columns_fields = self._get_fields_from_statements(filterings)
+
+        tables_needed_df = self._get_needed_tables(columns_fields + reg_exp_columns_fields + filterings_columns_fields)
+
+        all_columns = ['eid'] + (columns if columns is not None else []) + reg_exp_columns_fields
+
+        base_sql = """
+            select {data_fields}
+            {from_clause}
+            {where_statements}
+        """
+
+        tables_groups = self._group_tables_by_eids(tables_needed_df)
+        tables_join_sql, eids_condition = self._create_eid_joins(tables_groups)
+
+        if samples_filter_table is not None:
+            if tables_join_sql:
+                tables_join_sql = '{} inner join {} using (eid)'.format(tables_join_sql, samples_filter_table)
+            else:
+                tables_join_sql = samples_filter_table
+                tables_groups = [[(samples_filter_table, samples_filter_table)]]
+
+        if tables_join_sql:
+            from_clause_sql = f'from {tables_join_sql}'
+        else:
+            from_clause_sql = 'from all_eids'
+
+        # the relation driving the joins, used to qualify the eid column
+        eid_column = '{}.eid'.format(tables_groups[0][0][1] if len(tables_groups) == 1 else ALL_EIDS_TABLE)
+
+        where_conditions = []
+        if eids_condition is not None:
+            where_conditions.append(eids_condition)
+
+        if filterings is not None:
+            where_conditions.append(self._get_filterings(filterings, eid_column=eid_column))
+
+        return base_sql.format(
+            data_fields=','.join(all_columns),
+            from_clause=from_clause_sql,
+            where_statements=((' where ' + self._get_filterings(where_conditions)) if where_conditions else ''),
+        )
+
+    def get_columns_types(self, columns):
+        """
+        Returns the type (as in the fields table, like Integer or Continuous) of the columns specified as a field
+        (like c64_0_0), optionally renamed (c64_0_0 as myfield). Other columns (like expressions) are not included.
+        :return: a dictionary with the column name (or its rename) as key.
+        """
+        columns_types = {}
+
+        for col in columns:
+            if col == 'eid':
+                continue
+
+            match = re.search(Pheno2SQL.RE_FULL_COLUMN_NAME_RENAME, col)
+
+            if match is None:
+                continue
+
+            col_type = self.get_field_dtype(match.group('field'))
+            if col_type is None:
+                continue
+
+            col_rename = match.group('rename') if match.group('rename') is not None else match.group('field')
+            columns_types[col_rename] = col_type
+
+        return columns_types
+
+    def get_query_columns_types(self, columns=None, ecolumns=None):
+        return self.get_columns_types((columns if columns is not None else []) + self._get_fields_from_reg_exp(ecolumns))
+
+    def get_yaml_columns_types(self, yaml_file, section):
+        """
+        Same as get_columns_types, but for a YAML section. Columns of non-simple sections are always text.
+        """
+        if not section.startswith('simple_'):
+            return {}
+
+        return self.get_columns_types(['({}) as {}'.format(v, x) for x, v in yaml_file[section].items()])
+
+    def query(self, columns=None, ecolumns=None, filterings=None, order_by_table=None, samples_filter_table=None,
+              format_integers=True):
+        """
+        :param format_integers: if True, integer columns are returned as text (with no decimals); otherwise they are
+        returned as read by pandas (float if there are missing values).
+        """
+        with timed('metadata'):
+            reg_exp_columns_fields = self._get_fields_from_reg_exp(ecolumns)
+            all_columns = ['eid'] + (columns if columns is not None else []) + reg_exp_columns_fields
+
+            order_by_dict = None
+            if order_by_table is not None:
+                order_by_dict = {
+                    'table': order_by_table,
+                    'columns_select': ','.join(all_columns),
+                }
+
+            int_columns = self._get_integer_fields(all_columns)
+
+            parameters = None
+            if filterings is not None and self._use_prepared_statements():
+                filterings, parameters = self._get_statements_template(filterings)
+
+            final_sql_query = self._get_query_sql(columns, ecolumns, filterings,
+                                                  samples_filter_table=samples_filter_table)
 
         def format_integer_columns(chunk):
             for col in int_columns:
@@ -811,122 +2057,354 @@ class Pheno2SQL(DBAccess):
 
         return self._query_generic(
             final_sql_query,
-            results_transformator=format_integer_columns,
-            order_by_dict=order_by_dict
+            results_transformator=format_integer_columns if format_integers else None,
+            order_by_dict=order_by_dict,
+            parameters=parameters,
         )
 
-    def query_yaml_simple_data(self, yaml_file, section, order_by_table=None):
+    def _get_yaml_simple_data_args(self, yaml_file, section):
         section_data = yaml_file[section]
 
         include_only_stmts = None
+        samples_filter_table = None
         if 'samples_filters' in yaml_file:
-            include_only_stmts = yaml_file['samples_filters']
+            if self.samples_filters_cache:
+                samples_filter_table = self._get_samples_filters_table(yaml_file['samples_filters'])
+            else:
+                include_only_stmts = yaml_file['samples_filters']
 
         section_field_statements = ['({}) as {}'.format(v, x) for x, v in section_data.items()]
 
-        for chunk in self.query(section_field_statements, filterings=include_only_stmts, order_by_table=order_by_table):
+        return section_field_statements, include_only_stmts, samples_filter_table
+
+    def query_yaml_simple_data(self, yaml_file, section, order_by_table=None, format_integers=True):
+        section_field_statements, include_only_stmts, samples_filter_table = \
+            self._get_yaml_simple_data_args(yaml_file, section)
+
+        for chunk in self.query(section_field_statements, filterings=include_only_stmts, order_by_table=order_by_table,
+                                samples_filter_table=samples_filter_table, format_integers=format_integers):
             # chunk = chunk.rename(columns={v:k for x in section_data.items()})
             yield chunk
 
-    def query_yaml_data(self, yaml_file, section, order_by_table=None):
+    def _get_tables_presence(self, tables, operator='and'):
+        """
+        Returns a condition that is true if the eid has a row in the tables (all of them or any of them, depending
+        on the operator) or None if there are no tables.
+        """
+        if len(tables) == 0:
+            return None
+
+        return '({})'.format(' {} '.format(operator).join('{}.eid is not null'.format(t) for t in tables))
+
+    def _get_case_control_condition(self, field_id, field_cond):
+        """
+        Returns the condition over the events table for one data-field of a case_control column. If 'descendants' is
+        true, all the codings under the ones specified (in the hierarchy of the data-field's coding) are included.
+        """
+        codings = ', '.join("'{}'".format(cod) for cod in get_list(field_cond['coding']))
+
+        events_condition = 'event in ({})'.format(codings)
+
+        if field_cond.get('descendants', False):
+            events_condition = """(
+                {events_condition} or event in (
+                    select coding from {closure_table}
+                    where data_coding = (select distinct coding from fields where field_id = '{field_id}')
+                    and ancestor_coding in ({codings})
+                )
+            )""".format(
+                events_condition=events_condition, closure_table=CODINGS_CLOSURE_TABLE, field_id=field_id,
+                codings=codings,
+            )
+
+        return '(field_id = {} and {})'.format(field_id, events_condition)
+
+    def get_codings(self, data_coding, codings=None, descendants=False):
+        """
+        Returns the codings of a data-coding.
+        :param data_coding: data-coding id (like 19 for ICD10).
+        :param codings: list of codings to return. If None, all codings are returned.
+        :param descendants: if True, the codings under the ones specified are also returned (only for hierarchical
+        data-codings).
+        :return: a DataFrame with columns coding, meaning, node_id, parent_id, selectable and, if descendants is
+        True, ancestor_coding and depth.
+        """
+        parameters = {'data_coding': int(data_coding)}
+
+        if codings is None:
+            sql = """
+                select coding, meaning, node_id, parent_id, selectable
+                from codings
+                where data_coding = %(data_coding)s
+                order by coding
+            """
+        elif not descendants:
+            sql = """
+                select coding, meaning, node_id, parent_id, selectable
+                from codings
+                where data_coding = %(data_coding)s and coding = any(%(codings)s)
+                order by coding
+            """
+            parameters['codings'] = [str(c) for c in get_list(codings)]
+        else:
+            sql = """
+                select distinct cl.ancestor_coding, c.coding, c.meaning, c.node_id, c.parent_id, c.selectable,
+                    cl.depth
+                from {closure_table} cl join codings c
+                  on c.data_coding = cl.data_coding and c.node_id = cl.node_id
+                where cl.data_coding = %(data_coding)s and cl.ancestor_coding = any(%(codings)s)
+                order by cl.ancestor_coding, cl.depth, c.coding
+            """.format(closure_table=CODINGS_CLOSURE_TABLE)
+            parameters['codings'] = [str(c) for c in get_list(codings)]
+
+        return pd.read_sql(sql, self._get_db_engine(), params=parameters)
+
+    def _get_yaml_data_sql(self, yaml_file, section):
+        """
+        Builds the SQL query for a (non-simple) YAML section. The whole section is computed with a single scan over
+        all the tables needed: every table is left joined to all_eids and each column is an expression over them
+        (CASE WHEN for each category code). The results are the same as computing each column (and each category
+        code) separately and then joining them by eid:
+          - an eid matching several categories of the same column appears once per (distinct) category.
+          - a category condition only matches if the eid has data in the tables it uses.
+          - eids with no value in any column are not returned.
+        :return: a tuple with the SQL query and the list of column names.
+        """
         all_columns = []
-        all_columns_sql_queries = []
 
-        where_st = ''
-        where_fields = []
-        if 'samples_filters' in yaml_file:
-            where_st = self._get_filterings(yaml_file['samples_filters'])
-            where_fields = self._get_fields_from_statements([where_st])
+        samples_filters = yaml_file['samples_filters'] if 'samples_filters' in yaml_file else None
+
+        # samples filters are either evaluated once and joined as a table, or applied in the query
+        filter_relations = []
+        if samples_filters is not None and self.samples_filters_cache:
+            filter_relations = [self._get_samples_filters_table(samples_filters)]
+            samples_filters = None
+
+        eid_column = '{}.eid'.format(ALL_EIDS_TABLE)
 
-        for column, column_dict in yaml_file[section].items():
+        filters_tables = []
+        if samples_filters is not None:
+            filters_tables = self._get_needed_tables(self._get_fields_from_statements(samples_filters))
+
+        # categories and cases/controls only consider eids present in the tables used by the samples filters
+        filters_presence = self._get_tables_presence(filters_tables)
+
+        def get_condition(conditions):
+            conditions = [c for c in conditions if c is not None]
+            if len(conditions) == 0:
+                return 'true'
+
+            return ' and '.join(conditions)
+
+        all_tables = list(filters_tables)
+        cases_joins = []
+        base_columns = []
+        outer_columns = []
+        outer_joins = []
+        presence_conditions = []
+
+        for column_idx, (column, column_dict) in enumerate(yaml_file[section].items()):
             all_columns.append(column)
 
-            subqueries = []
+            base_column = 'v{}'.format(column_idx)
 
             if isinstance(column_dict, dict):
+                # each value is NULL if the category does not apply
+                column_values = []
+
                 for df, df_cods in column_dict.items():
                     if df == 'sql':
                         for cat_code, cat_condition in df_cods.items():
-                            # TODO: check for repeated category codes
-                            needed_tables = self._get_needed_tables(
-                                self._get_fields_from_statements([cat_condition]) + where_fields
-                            )
-
-                            sql_code = """
-                                select eid, {cat_code} as {column_name}
-                                from {cases_joins}
-                                {where_st}
-                            """.format(
-                                    cat_code=cat_code,
-                                    column_name=column,
-                                    cases_joins=self._create_joins(needed_tables + [ALL_EIDS_TABLE]),
-                                    where_st='where ({}) {}'.format(cat_condition, (' AND ({})'.format(where_st) if where_st else ''))
-                            )
-
-                            subqueries.append(sql_code)
+                            cat_tables = self._get_needed_tables(self._get_fields_from_statements([cat_condition]))
+                            all_tables.extend(cat_tables)
+
+                            column_values.append('case when {conditions} then {cat_code} end'.format(
+                                conditions=get_condition([
+                                    filters_presence,
+                                    self._get_tables_presence(cat_tables),
+                                    '({})'.format(self._get_filterings([cat_condition], eid_column=eid_column)),
+                                ]),
+                                cat_code=cat_code,
+                            ))
 
                     elif df == 'case_control':
                         cases_conditions = [
-                            '(field_id = {} and event in ({}))'.format(
-                                field_id, ', '.join("'{}'".format(cod) for cod in get_list(field_cond['coding']))
-                            ) for field_id, field_cond in df_cods.items()
+                            self._get_case_control_condition(field_id, field_cond)
+                            for field_id, field_cond in df_cods.items()
                         ]
 
-                        sql_cases = """
-                            select distinct eid
-                            from events
-                            where {conditions}
-                        """.format(conditions=' OR '.join(cases_conditions))
-
-                        sql_cases_code = """
-                                select eid, 1 as {column_name}
-                                from {cases_joins}
-                                {where_st}
-                        """.format(
-                            column_name=column,
-                            cases_joins=self._create_joins([
-                                '({}) ev'.format(sql_cases)
-                            ] + self._get_needed_tables(where_fields)),
-                            where_st='where ' + (where_st if where_st else '1=1')
-                        )
-
-                        subqueries.append(sql_cases_code)
-
-                        # controls
-                        sql_controls_code = """
-                            select aet.eid, 0 as {column_name}
-                            from {controls_joins}
-                            {where_st}
-                            and aet.eid not in (
-                                {sql_cases}
+                        cases_relation = 'cc{}_{}'.format(column_idx, len(cases_joins))
+                        cases_joins.append("""
+                            left outer join (
+                                select distinct eid
+                                from events
+                                where {conditions}
+                            ) {cases_relation} using (eid)
+                        """.format(conditions=' OR '.join(cases_conditions), cases_relation=cases_relation))
+
+                        column_values.append(
+                            'case when {conditions} then (case when {cases_relation}.eid is not null then 1 else 0 end) end'.format(
+                                conditions=get_condition([filters_presence]),
+                                cases_relation=cases_relation,
                             )
-                        """.format(
-                            column_name=column,
-                            controls_joins=self._create_joins([
-                                '{} aet'.format(ALL_EIDS_TABLE),
-                            ] + self._get_needed_tables(where_fields)),
-                            where_st='where ' + (where_st if where_st else '1=1'),
-                            sql_cases=sql_cases,
                         )
 
-                        subqueries.append(sql_controls_code)
-
                     else:
                         raise Exception('Invalid selector type')
 
+                if len(column_values) == 1:
+                    base_columns.append('{} as {}'.format(column_values[0], base_column))
+                    outer_columns.append('b.{}::text as {}'.format(base_column, column))
+                    presence_conditions.append('b.{} is not null'.format(base_column))
+                else:
+                    # one row for each distinct category that applies
+                    base_columns.append('array_remove(array[{}], NULL) as {}'.format(
+                        ', '.join(column_values), base_column
+                    ))
+                    outer_columns.append('u{}.v::text as {}'.format(column_idx, column))
+                    outer_joins.append(
+                        'left outer join lateral (select distinct v from unnest(b.{base_column}) v) u{column_idx} '
+                        'on true'.format(base_column=base_column, column_idx=column_idx)
+                    )
+                    presence_conditions.append('cardinality(b.{}) > 0'.format(base_column))
+
             elif isinstance(column_dict, str):
-                final_sql = self._get_query_sql(
-                    columns=['({}) as {}'.format(column_dict, column)],
-                    filterings=yaml_file['samples_filters'] if 'samples_filters' in yaml_file else None,
-                )
+                column_tables = self._get_needed_tables(self._get_fields_from_statements([column_dict]))
+                all_tables.extend(column_tables)
 
-                subqueries.append(final_sql)
+                # as a regular query, the eid is returned if it is present in any of the tables used
+                column_presence = self._get_tables_presence(
+                    list(dict.fromkeys(column_tables + filters_tables)), operator='or'
+                )
+                base_columns.append('case when {presence} then ({expression}) end as {base_column}'.format(
+                    presence=get_condition([column_presence]),
+                    expression=column_dict,
+                    base_column=base_column,
+                ))
+                base_columns.append('{} as p{}'.format(get_condition([column_presence]), column_idx))
+                outer_columns.append('b.{}::text as {}'.format(base_column, column))
+                presence_conditions.append('b.p{}'.format(column_idx))
             else:
                 raise Exception('Invalid query type')
 
-            column_sql_query = ' union distinct '.join(subqueries)
+        base_joins = [ALL_EIDS_TABLE]
+        base_joins.extend('inner join {} using (eid)'.format(t) for t in filter_relations)
+        base_joins.extend('left outer join {} using (eid)'.format(t) for t in dict.fromkeys(all_tables))
+        base_joins.extend(cases_joins)
+
+        final_sql_query = """
+            select b.eid, {outer_columns}
+            from (
+                select {eid_column} as eid, {base_columns}
+                from {base_joins}
+                {where_st}
+            ) b
+            {outer_joins}
+            where {presence_conditions}
+        """.format(
+            outer_columns=', '.join(outer_columns),
+            eid_column=eid_column,
+            base_columns=', '.join(base_columns),
+            base_joins=' '.join(base_joins),
+            where_st=(
+                'where {}'.format(self._get_filterings(samples_filters, eid_column=eid_column))
+                if samples_filters is not None else ''
+            ),
+            outer_joins=' '.join(outer_joins),
+            presence_conditions=' or '.join('({})'.format(c) for c in presence_conditions),
+        )
+
+        return final_sql_query, all_columns
+
+    def _query_yaml_data_parallel(self, yaml_file, section, order_by_table=None):
+        """
+        Queries each column of a YAML section concurrently (each one on its own connection from the pool) and
+        joins the results by eid. Eids matching several categories of a column get one row per category, as
+        when the section is computed with a single query. All columns are read into memory before the data is
+        split into chunks.
+        """
+        all_columns = list(yaml_file[section].keys())
+
+        if 'samples_filters' in yaml_file and self.samples_filters_cache:
+            # evaluate them once before the columns are queried
+            self._get_samples_filters_table(yaml_file['samples_filters'])
 
-            all_columns_sql_queries.append(column_sql_query)
+        def get_column_data(column):
+            column_yaml_file = {k: v for k, v in yaml_file.items() if k == 'samples_filters'}
+            column_yaml_file[section] = {column: yaml_file[section][column]}
+
+            column_sql, _ = self._get_yaml_data_sql(column_yaml_file, section)
+            logger.debug(column_sql)
+
+            self._check_query_cost(column_sql)
+
+            try:
+                return pd.read_sql(column_sql, self._get_db_engine())
+            except ProgrammingError as e:
+                raise UkbRestSQLExecutionError(str(e))
+
+        logger.info('Querying {} columns of section {} with {} jobs'.format(
+            len(all_columns), section, self.yaml_columns_n_jobs))
+
+        with timed('sql'):
+            with ThreadPoolExecutor(max_workers=min(self.yaml_columns_n_jobs, len(all_columns))) as executor:
+                columns_data = list(executor.map(get_column_data, all_columns))
+
+            if order_by_table is not None:
+                order_by_eids = pd.read_sql(
+                    'select eid from {} order by index asc'.format(order_by_table), self._get_db_engine()
+                )
+
+        with timed('transform'):
+            data = columns_data[0]
+            for column_data in columns_data[1:]:
+                data = data.merge(column_data, on='eid', how='outer')
+
+            if order_by_table is not None:
+                data = order_by_eids.merge(data, on='eid', how='left')
+
+            data = data.set_index('eid').loc[:, all_columns]
+
+        if self.sql_chunksize is None:
+            chunks = [data]
+        else:
+            chunks = (data.iloc[chunk_start:chunk_start + self.sql_chunksize]
+                      for chunk_start in range(0, max(data.shape[0], 1), self.sql_chunksize))
+
+        for chunk in chunks:
+            METRICS.inc(ROWS_TOTAL, chunk.shape[0])
+
+            yield chunk
+
+    def _get_yaml_section_sql(self, yaml_file, section):
+        """
+        Returns the SQL query for a (non-simple) YAML section, reading it from its materialized table if there is
+        one.
+        """
+        derived_table = self._get_derived_phenotypes_table(yaml_file, section)
+
+        if derived_table is not None:
+            logger.info('Reading materialized section {} from {}'.format(section, derived_table))
+
+            all_columns = list(yaml_file[section].keys())
+            final_sql_query = """
+                select eid, {columns_names}
+                from {derived_table}
+            """.format(
+                columns_names=', '.join(all_columns),
+                derived_table=derived_table,
+            )
+        else:
+            final_sql_query, all_columns = self._get_yaml_data_sql(yaml_file, section)
+
+        return final_sql_query, all_columns
+
+    def query_yaml_data(self, yaml_file, section, order_by_table=None):
+        if self.yaml_columns_n_jobs > 1 and len(yaml_file[section]) > 1 and \
+                self._get_derived_phenotypes_table(yaml_file, section) is None:
+            return self._query_yaml_data_parallel(yaml_file, section, order_by_table)
+
+        final_sql_query, all_columns = self._get_yaml_section_sql(yaml_file, section)
 
         order_by_dict = None
         if order_by_table is not None:
@@ -937,24 +2415,197 @@ class Pheno2SQL(DBAccess):
                     ', '.join('{column_name}::text'.format(column_name=column) for column in all_columns),
             }
 
-        final_sql_query = """
-            select eid, {columns_names}
-            from {inner_queries}
-        """.format(
-            columns_names=', '.join('{}::text'.format(column) for column in all_columns),
-            inner_queries=self._create_joins(
-                ['({}) iq{}'.format(iq, iq_idx) for iq_idx, iq in enumerate(all_columns_sql_queries)],
-                join_type='full outer join'
-            ),
-        )
-
         return self._query_generic(
             final_sql_query,
             order_by_dict=order_by_dict
         )
 
-    def query_yaml(self, yaml_file, section, order_by_table=None):
+    def _get_yaml_section_definition(self, yaml_file, section):
+        """
+        Returns a JSON representation of everything needed to compute a YAML section: the section itself and the
+        samples filters. It is used to identify materialized sections.
+        """
+        def normalize(value):
+            if isinstance(value, dict):
+                return {str(k): normalize(v) for k, v in value.items()}
+            elif isinstance(value, (list, tuple)):
+                return [normalize(v) for v in value]
+
+            return value
+
+        definition = {section: yaml_file[section]}
+        if 'samples_filters' in yaml_file:
+            definition['samples_filters'] = yaml_file['samples_filters']
+
+        return json.dumps(normalize(definition), sort_keys=True)
+
+    def _get_derived_phenotypes_table(self, yaml_file, section):
+        """
+        If the YAML section (with the same samples filters) was materialized, returns the name of the table
+        holding it. Otherwise returns None. The result is kept for DATA_GENERATION_CHECK_INTERVAL seconds (or until
+        data changes).
+        """
+        definition = self._get_yaml_section_definition(yaml_file, section)
+
+        derived_key = (self._get_db_uri(), self._get_data_generation(), definition)
+        table_name, check_time = self._derived_phenotypes_tables.get(derived_key, (None, None))
+        if check_time is not None and time.monotonic() - check_time < self.DATA_GENERATION_CHECK_INTERVAL:
+            return table_name
+
+        table_name = None
+        if self._get_db_engine().has_table(DERIVED_PHENOTYPES_TABLE):
+            derived_tables = pd.read_sql(
+                'select table_name from {} where definition_hash = %(definition_hash)s and definition = %(definition)s'.format(
+                    DERIVED_PHENOTYPES_TABLE
+                ),
+                self._get_db_engine(),
+                params={'definition_hash': hashlib.md5(definition.encode('utf-8')).hexdigest(), 'definition': definition}
+            )
+
+            if derived_tables.shape[0] > 0:
+                table_name = derived_tables.iloc[0, 0]
+
+        self._derived_phenotypes_tables[derived_key] = (table_name, time.monotonic())
+
+        return table_name
+
+    def _materialize_derived_phenotypes(self, name, section, definition):
+        table_name = DERIVED_PHENOTYPES_TABLE_PREFIX + name
+        logger.info('Materializing section {} into table {}'.format(section, table_name))
+
+        final_sql_query, _ = self._get_yaml_data_sql(json.loads(definition), section)
+
+        # the table is built aside and then replaces the current one, so queries never see it half-built
+        new_table_name = table_name + '_new'
+
+        with self._get_db_engine().connect() as conn:
+            conn.execute("""
+                DROP TABLE IF EXISTS {new_table_name};
+                CREATE TABLE {new_table_name} AS {final_sql_query};
+            """.format(new_table_name=self._get_qualified_table_name(new_table_name), final_sql_query=final_sql_query))
+
+        # the same eid could appear more than once (if it belongs to more than one category)
+        create_indexes(new_table_name, ('eid',), db_engine=self._get_db_engine())
+
+        with self._get_db_engine().connect() as conn:
+            conn.execute('ANALYZE {}'.format(new_table_name))
+
+        with self._get_db_engine().begin() as conn:
+            conn.execute("""
+                DROP TABLE IF EXISTS {table_name};
+                ALTER TABLE {new_table_name} RENAME TO {table_name_only};
+                ALTER INDEX {new_index_name} RENAME TO ix_{table_name_only}_eid;
+            """.format(
+                table_name=self._get_qualified_table_name(table_name),
+                new_table_name=self._get_qualified_table_name(new_table_name),
+                new_index_name=self._get_qualified_table_name('ix_{}_eid'.format(new_table_name)),
+                table_name_only=table_name,
+            ))
+
+        return table_name
+
+    def register_derived_phenotypes(self, yaml_file, section, name=None):
+        """
+        Materializes a YAML section into a table, so later queries of the same section (with the same samples
+        filters) read it directly. Materialized sections are refreshed each time data is loaded.
+        :param yaml_file: the YAML file already parsed.
+        :param section: the section to materialize; simple sections are not supported.
+        :param name: the name of the derived phenotypes (the section name by default).
+        :return: the name of the table created.
+        """
+        if section.startswith('simple_'):
+            raise UkbRestValidationError('Simple sections cannot be materialized: {}'.format(section))
+
+        if section not in yaml_file:
+            raise UkbRestValidationError('Section not found in YAML file: {}'.format(section))
+
+        if name is None:
+            name = section
+
+        if re.match('^[a-z_][a-z0-9_]*$', name) is None:
+            raise UkbRestValidationError('Invalid name for derived phenotypes (only a-z, 0-9 and _ are allowed): {}'.format(name))
+
+        if DERIVED_PHENOTYPES_TABLE_PREFIX + name == DERIVED_PHENOTYPES_TABLE:
+            raise UkbRestValidationError('Invalid name for derived phenotypes: {}'.format(name))
+
+        definition = self._get_yaml_section_definition(yaml_file, section)
+
+        create_table(DERIVED_PHENOTYPES_TABLE,
+            columns=[
+                'name text NOT NULL',
+                'section text NOT NULL',
+                'definition text NOT NULL',
+                'definition_hash text NOT NULL',
+                'table_name text NOT NULL',
+            ],
+            constraints=[
+                'pk_{} PRIMARY KEY (name)'.format(DERIVED_PHENOTYPES_TABLE)
+            ],
+            db_engine=self._get_db_engine(),
+            drop_if_exists=False
+        )
+
+        table_name = self._materialize_derived_phenotypes(name, section, definition)
+
+        with self._get_db_engine().connect() as conn:
+            conn.execute(
+                'DELETE FROM {} WHERE name = %(name)s'.format(DERIVED_PHENOTYPES_TABLE),
+                name=name
+            )
+
+            conn.execute(
+                'INSERT INTO {} (name, section, definition, definition_hash, table_name) '
+                'VALUES (%(name)s, %(section)s, %(definition)s, %(definition_hash)s, %(table_name)s)'.format(
+                    DERIVED_PHENOTYPES_TABLE
+                ),
+                name=name, section=section, definition=definition,
+                definition_hash=hashlib.md5(definition.encode('utf-8')).hexdigest(), table_name=table_name
+            )
+
+        self._derived_phenotypes_tables = {}
+
+        return table_name
+
+    def _refresh_derived_phenotypes(self):
+        if self.db_type == 'sqlite' or not self._get_db_engine().has_table(DERIVED_PHENOTYPES_TABLE):
+            return
+
+        derived_phenotypes = pd.read_sql(
+            'select name, section, definition from {}'.format(DERIVED_PHENOTYPES_TABLE),
+            self._get_db_engine()
+        )
+
+        logger.info('Refreshing {} materialized sections'.format(derived_phenotypes.shape[0]))
+
+        for row in derived_phenotypes.itertuples():
+            try:
+                self._materialize_derived_phenotypes(row.name, row.section, row.definition)
+            except (ProgrammingError, DataError, UkbRestValidationError) as e:
+                # its data would be outdated (or missing in a new schema), so queries compile the YAML section again
+                logger.error('Materialized section {} could not be refreshed, it is removed: {}'.format(row.name, str(e)))
+                self._remove_derived_phenotypes(row.name)
+
+    def _remove_derived_phenotypes(self, name):
+        table_name = DERIVED_PHENOTYPES_TABLE_PREFIX + name
+
+        with self._get_db_engine().begin() as conn:
+            conn.execute(
+                'DELETE FROM {} WHERE name = %(name)s'.format(DERIVED_PHENOTYPES_TABLE),
+                name=name
+            )
+
+            conn.execute("""
+                DROP TABLE IF EXISTS {table_name};
+                DROP TABLE IF EXISTS {new_table_name};
+            """.format(
+                table_name=self._get_qualified_table_name(table_name),
+                new_table_name=self._get_qualified_table_name(table_name + '_new'),
+            ))
+
+        self._derived_phenotypes_tables = {}
+
+    def query_yaml(self, yaml_file, section, order_by_table=None, format_integers=True):
         if section.startswith('simple_'):
-            return self.query_yaml_simple_data(yaml_file, section, order_by_table)
+            return self.query_yaml_simple_data(yaml_file, section, order_by_table, format_integers)
         else:
             return self.query_yaml_data(yaml_file, section, order_by_table)
@@ -1,14 +1,37 @@
 from os.path import join, basename, splitext
 from glob import glob
+import csv
+import io
 import re
 
 import pandas as pd
+from joblib import Parallel, delayed
 
-from ukbrest.common.utils.constants import WITHDRAWALS_TABLE
-from ukbrest.common.utils.db import create_table, create_indexes, DBAccess
+from ukbrest.common.pheno2sql import Pheno2SQL
+from ukbrest.common.utils.constants import WITHDRAWALS_TABLE, CODINGS_CLOSURE_TABLE
+from ukbrest.common.utils.db import create_table, create_indexes, DBAccess, copy_data
 from ukbrest.config import logger
 
 
+CODINGS_COLUMNS = ['data_coding', 'coding', 'meaning', 'node_id', 'parent_id', 'selectable']
+
+
+def _read_coding_file(coding_file):
+    """
+    Reads a coding file, where columns can be separated by more than one tab. Tabs are collapsed first, so the file is
+    parsed by pandas' C engine instead of the (much slower) python one needed by a regular expression separator.
+    """
+    with open(coding_file, 'r', encoding='utf-8') as f:
+        content = re.sub('\t+', '\t', f.read())
+
+    data = pd.read_csv(io.StringIO(content), sep='\t', na_filter=False, quoting=csv.QUOTE_NONE)
+
+    data['data_coding'] = int(splitext(basename(coding_file))[0].split('_')[1])
+
+    # columns missing in this file (like node_id in non-hierarchical codings) are NULL
+    return data.reindex(columns=CODINGS_COLUMNS)
+
+
 class Postloader(DBAccess):
     def __init__(self, db_uri):
         super(Postloader, self).__init__(db_uri)
@@ -17,6 +40,20 @@ class Postloader(DBAccess):
             'points': re.compile('[\.]{1,}')
         }
 
+    def _get_pheno2sql(self):
+        """
+        Returns a Pheno2SQL object accessing the phenotype data already loaded (if it was loaded in blue/green mode,
+        that of the active schema).
+        """
+        return Pheno2SQL((), self.db_uri, db_pool_parameters=self.db_pool_parameters, blue_green=True)
+
+    def _refresh_derived_data(self):
+        """
+        Tables loaded here can be used by queries (like withdrawals in samples filters), so data derived from them is
+        refreshed. If data was loaded in blue/green mode, the active schema is the one updated.
+        """
+        self._get_pheno2sql().refresh_derived_data()
+
     def load_withdrawals(self, withdrawals_dir):
         db_engine = self._get_db_engine()
 
@@ -29,25 +66,35 @@ class Postloader(DBAccess):
                 )
             """)
 
-            for input_file in glob(join(withdrawals_dir, '*.csv')):
-                logger.info(f'Reading input file {input_file}')
+        files_data = []
+
+        for input_file in glob(join(withdrawals_dir, '*.csv')):
+            logger.info(f'Reading input file {input_file}')
+
+            data = pd.read_csv(input_file, header=None)
+            data = data.rename(columns={0: 'eid'})
+
+            n_data_before = data.shape[0]
+            data = data.drop_duplicates()
+            if n_data_before != data.shape[0]:
+                logger.warning(f'Duplicate IDs in file were removed ({n_data_before} vs {data.shape[0]})')
 
-                data = pd.read_csv(input_file, header=None)
-                data = data.rename(columns={0: 'eid'})
+            files_data.append(data)
 
-                n_data_before = data.shape[0]
-                data = data.drop_duplicates()
-                if n_data_before != data.shape[0]:
-                    logger.warning(f'Duplicate IDs in file were removed ({n_data_before} vs {data.shape[0]})')
+        if len(files_data) > 0:
+            data = pd.concat(files_data, ignore_index=True).drop_duplicates()
 
-                # remove duplicates already in DB
-                current_eids = pd.read_sql(f'select eid from {WITHDRAWALS_TABLE}', conn)['eid']
-                data = data.loc[~data['eid'].isin(current_eids)]
+            # sample IDs already in the table are skipped by the database
+            n_new_eids = copy_data(WITHDRAWALS_TABLE, data, db_engine, on_conflict_do_nothing=True)
+            logger.info(f'Written to SQL table: {n_new_eids} new sample IDs')
 
-                logger.info(f'Writing to SQL table: {data.shape[0]} new sample IDs')
-                data.to_sql(WITHDRAWALS_TABLE, db_engine, index=False, if_exists='append')
+        self._refresh_derived_data()
 
-    def load_codings(self, codings_dir):
+    def load_codings(self, codings_dir, n_jobs=-1):
+        """
+        Loads all coding files (coding_N.tsv, where N is the data-coding) from codings_dir.
+        :param n_jobs: number of processes parsing coding files (joblib's meaning; -1 is all CPUs).
+        """
         logger.info('Loading codings from {}'.format(codings_dir))
         db_engine = self._get_db_engine()
 
@@ -66,22 +113,61 @@ class Postloader(DBAccess):
             db_engine=self._get_db_engine()
          )
 
-        for afile in glob(join(codings_dir, '*.tsv')):
-            afile_base = basename(afile)
+        coding_files = glob(join(codings_dir, '*.tsv'))
+        logger.info('Processing {} coding files'.format(len(coding_files)))
 
-            logger.info('Processing coding file: {}'.format(afile_base))
+        codings_data = Parallel(n_jobs=n_jobs)(
+            delayed(_read_coding_file)(coding_file) for coding_file in coding_files
+        )
 
-            data = pd.read_table(afile, sep='\t+', na_filter=False, engine='python')
-
-            data_coding = int(splitext(afile_base)[0].split('_')[1])
-            data['data_coding'] = data_coding
-
-            data.to_sql('codings', db_engine, if_exists='append', index=False)
+        if len(codings_data) > 0:
+            n_codings = copy_data('codings', codings_data, db_engine)
+            logger.info('{} codings loaded'.format(n_codings))
 
         create_indexes('codings', ['data_coding', 'coding', 'node_id', 'parent_id', 'selectable'], db_engine=db_engine)
 
         self._vacuum('codings')
 
+        self._create_codings_closure()
+
+        self._refresh_derived_data()
+
+    def _create_codings_closure(self):
+        """
+        Precomputes, for each hierarchical coding (those with node_id/parent_id), all the descendants of each node
+        (including itself, with depth 0). This way, expanding a subtree (like all ICD10 codes under J45) is a simple
+        lookup instead of a recursive query.
+        """
+        logger.info('Creating codings closure table')
+
+        db_engine = self._get_db_engine()
+
+        with db_engine.connect() as conn:
+            conn.execute(f"""
+                DROP TABLE IF EXISTS {CODINGS_CLOSURE_TABLE};
+
+                CREATE TABLE {CODINGS_CLOSURE_TABLE} AS
+                with recursive closure(data_coding, ancestor_node_id, node_id, depth) as (
+                    select distinct data_coding, node_id, node_id, 0
+                    from codings
+                    where node_id is not null
+                  union
+                    select c.data_coding, cl.ancestor_node_id, c.node_id, cl.depth + 1
+                    from closure cl join codings c
+                      on c.data_coding = cl.data_coding and c.parent_id = cl.node_id
+                )
+                select distinct cl.data_coding, a.coding as ancestor_coding, cl.ancestor_node_id,
+                    d.coding, cl.node_id, d.selectable, cl.depth
+                from closure cl
+                  join codings a on a.data_coding = cl.data_coding and a.node_id = cl.ancestor_node_id
+                  join codings d on d.data_coding = cl.data_coding and d.node_id = cl.node_id
+            """)
+
+        create_indexes(CODINGS_CLOSURE_TABLE, [('data_coding', 'ancestor_coding'), ('data_coding', 'ancestor_node_id')],
+                       db_engine=db_engine)
+
+        self._vacuum(CODINGS_CLOSURE_TABLE)
+
     def _rename_column(self, column_name, identifier_columns):
         # first, substitute not-permitted characters
         standard_rename = re.sub(self.patterns['points'], '_', column_name.lower()).strip('_')
@@ -103,7 +189,13 @@ class Postloader(DBAccess):
             return 'Text'
 
     def load_samples_data(self, data_dir, identifier_columns={}, skip_columns={}, separators={}):
-        db_engine = self._get_db_engine()
+        # samples data is added to the phenotype data (the fields table), so if it was loaded in blue/green mode,
+        # tables are created in the active schema
+        p2sql = self._get_pheno2sql()
+        db_engine = p2sql._get_db_engine()
+
+        search_path = p2sql._get_search_path()
+        schema = search_path[0] if search_path is not None else None
 
         for afile in glob(join(data_dir, '*.txt')):
             filename = basename(afile)
@@ -126,6 +218,7 @@ class Postloader(DBAccess):
                 continue
 
             table_name = splitext(filename)[0]
+            qualified_table_name = p2sql._get_qualified_table_name(table_name)
 
             # rename columns
             columns_rename = {old_col: self._rename_column(old_col, eid_columns) for old_col in data.columns}
@@ -136,14 +229,17 @@ class Postloader(DBAccess):
 
             data = data.rename(columns=columns_rename)
 
-            data.to_sql(table_name, db_engine, if_exists='replace', index=False)
+            # the table is created from the columns types, and data is bulk-loaded
+            data.head(0).to_sql(table_name, db_engine, schema=schema, if_exists='replace', index=False)
+            copy_data(qualified_table_name, data, db_engine)
 
             # add primary key
             logger.info('Adding primary key')
             with db_engine.connect() as conn:
                 conn.execute("""
-                    ALTER TABLE {table_name} ADD CONSTRAINT pk_{table_name} PRIMARY KEY ({id_cols});
-                """.format(table_name=table_name, id_cols=','.join(eid_columns)))
+                    ALTER TABLE {qualified_table_name} ADD CONSTRAINT pk_{table_name} PRIMARY KEY ({id_cols});
+                """.format(qualified_table_name=qualified_table_name, table_name=table_name,
+                           id_cols=','.join(eid_columns)))
 
             # insert new data columns into fields table
             logger.info("Adding columns to 'fields' table")
@@ -157,4 +253,6 @@ class Postloader(DBAccess):
                 'type': columns_dtypes_to_fields,
             })
 
-            fields_table_data.to_sql('fields', db_engine, index=False, if_exists='append')
+            fields_table_data.to_sql('fields', db_engine, schema=schema, index=False, if_exists='append')
+
+        self._refresh_derived_data()
@@ -1,3 +1,11 @@
 ALL_EIDS_TABLE='all_eids'
 WITHDRAWALS_TABLE='withdrawals'
-BGEN_SAMPLES_TABLE='bgen_samples'
\ No newline at end of file
+BGEN_SAMPLES_TABLE='bgen_samples'
+DERIVED_PHENOTYPES_TABLE='derived_phenotypes'
+DERIVED_PHENOTYPES_TABLE_PREFIX='derived_'
+METADATA_TABLE='ukbrest_metadata'
+SAMPLES_FILTERS_TABLE_PREFIX='samples_filter_'
+CODINGS_CLOSURE_TABLE='codings_closure'
+LOAD_CHECKPOINTS_TABLE='ukbrest_load_checkpoints'
+BLUE_GREEN_SCHEMAS_TABLE='ukbrest_schemas'
+BLUE_GREEN_SCHEMA_PREFIX='ukbrest_data_'
@@ -27,7 +27,15 @@ def get_tmpdir(tmpdir):
     return tmpdir
 
 
-def generate_random_gen(n_variants, n_samples, chromosome=1, initial_position=100):
+def generate_random_gen(n_variants, n_samples, chromosome=1, initial_position=100, random_state=None):
+    """
+    Generates random genotype data in GEN format. All variants and samples are generated at once with numpy.
+    :param random_state: a numpy RandomState (the global numpy random state is used if None).
+    :return: a DataFrame with one row per variant.
+    """
+    if random_state is None:
+        random_state = np.random.mtrand._rand
+
     # generate columns
     initial_cols = ['chr', 'snpid', 'rsid', 'pos', 'allele1', 'allele2']
 
@@ -41,36 +49,37 @@ def generate_random_gen(n_variants, n_samples, chromosome=1, initial_position=10
     if chromosome == 1:
         initial_snp_id = 1
 
-    # generate variants for each sample
-    genotype = []
-
-    current_position = initial_position
-
-    for variant_id in range(n_variants):
-        nucleotids = list(np.random.choice(['A', 'G', 'T', 'C'], size=2, replace=False))
-
-        header = [
-            '{:02d}'.format(chromosome),
-            '{:02d}:{:d}_{}_{}'.format(chromosome, current_position, nucleotids[0], nucleotids[1]),
-            'rs{:d}'.format(initial_snp_id + variant_id),
-            current_position,
-            nucleotids[0],
-            nucleotids[1]
-        ]
-
-        samples = [
-            list(np.random.dirichlet(np.ones(3) + np.random.choice([0, 0, 10], size=3, replace=False), size=1)[0])
-            for i in range(n_samples)
-        ]
-        # BGEN v1.1: accurate to four decimal places; here I round to 5 places, but when read back only 4 should
-        # be considered.
-        samples = ['{:.5f}'.format(item) for sublist in samples for item in sublist] # flatten
-
-        genotype.append(header + samples)
-
-        current_position += np.random.randint(50, 100)
-
-    return pd.DataFrame(genotype, columns=new_cols)
+    # two different nucleotids for each variant
+    nucleotids = np.array(['A', 'G', 'T', 'C'])[np.argsort(random_state.random_sample((n_variants, 4)), axis=1)[:, :2]]
+
+    positions = initial_position + np.concatenate(
+        ([0], np.cumsum(random_state.randint(50, 100, size=max(n_variants - 1, 0))))
+    ).astype(int)[:n_variants]
+
+    chromosome_str = '{:02d}'.format(chromosome)
+
+    genotype = pd.DataFrame({
+        'chr': chromosome_str,
+        'snpid': [
+            '{}:{:d}_{}_{}'.format(chromosome_str, pos, a1, a2)
+            for pos, (a1, a2) in zip(positions, nucleotids)
+        ],
+        'rsid': ['rs{:d}'.format(initial_snp_id + variant_id) for variant_id in range(n_variants)],
+        'pos': positions,
+        'allele1': nucleotids[:, 0],
+        'allele2': nucleotids[:, 1],
+    }, columns=initial_cols)
+
+    # dirichlet samples (as normalized gamma samples); each sample of each variant favors one genotype
+    alpha = 1 + 10 * np.eye(3)[random_state.randint(0, 3, size=(n_variants, n_samples))]
+    probs = random_state.standard_gamma(alpha)
+    probs /= probs.sum(axis=2, keepdims=True)
+
+    # BGEN v1.1: accurate to four decimal places; here I round to 5 places, but when read back only 4 should
+    # be considered.
+    probs = np.char.mod('%.5f', probs.reshape(n_variants, n_samples * 3))
+
+    return pd.concat((genotype, pd.DataFrame(probs, columns=samples_cols)), axis=1)
 
 
 if __name__ == '__main__':
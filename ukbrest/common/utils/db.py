@@ -1,11 +1,162 @@
-from sqlalchemy import create_engine
+import io
+import os
+import threading
+import time
+from urllib.parse import urlencode
 
+from sqlalchemy import create_engine, event, exc
+from sqlalchemy.pool import NullPool
 
-def create_table(table_name, columns, db_engine, constraints=None, drop_if_exists=True):
+from ukbrest.config import logger, get_db_pool_parameters
+
+
+# engines shared by all objects accessing the same database in a process
+_db_engines = {}
+_db_engines_lock = threading.Lock()
+
+
+def _add_pool_listeners(engine, pool_pre_ping):
+    pool_stats = {
+        'connections_created': 0,
+        'connect_time': 0.0,
+        'checkouts': 0,
+        'disconnects_detected': 0,
+    }
+
+    @event.listens_for(engine, 'do_connect')
+    def receive_do_connect(dialect, connection_record, cargs, cparams):
+        connection_record.info['ukbrest_connect_start'] = time.time()
+
+    @event.listens_for(engine.pool, 'connect')
+    def receive_connect(dbapi_connection, connection_record):
+        pool_stats['connections_created'] += 1
+
+        connect_start = connection_record.info.pop('ukbrest_connect_start', None)
+        if connect_start is not None:
+            pool_stats['connect_time'] += time.time() - connect_start
+
+    @event.listens_for(engine.pool, 'checkout')
+    def receive_checkout(dbapi_connection, connection_record, connection_proxy):
+        pool_stats['checkouts'] += 1
+
+        if not pool_pre_ping:
+            return
+
+        # pessimistic disconnect handling: the pool replaces the connection if it was closed by the server
+        cursor = dbapi_connection.cursor()
+        try:
+            cursor.execute('SELECT 1')
+        except Exception:
+            pool_stats['disconnects_detected'] += 1
+            raise exc.DisconnectionError()
+        finally:
+            cursor.close()
+
+    engine.ukbrest_pool_stats = pool_stats
+
+
+def get_db_engine(db_uri, pool_size=10, max_overflow=10, pool_timeout=30, pool_recycle=-1, pool_pre_ping=True,
+                  external_pool=False):
+    """
+    Returns the engine for a database, shared by all objects in the process (so each process has a single
+    connection pool for each database and pool parameters). Engines are not shared among processes, like forked
+    workers.
+    :param external_pool: if True, connections are not kept open by SQLAlchemy, since an external pool (like
+    pgbouncer) is used.
+    """
+    if db_uri is None or db_uri == "":
+        raise ValueError('DB URI was not set')
+
+    engine_key = (os.getpid(), db_uri, pool_size, max_overflow, pool_timeout, pool_recycle, pool_pre_ping,
+                  external_pool)
+
+    with _db_engines_lock:
+        if engine_key not in _db_engines:
+            if external_pool or db_uri.startswith('sqlite'):
+                kargs = {'poolclass': NullPool}
+            else:
+                kargs = {
+                    'pool_size': pool_size,
+                    'max_overflow': max_overflow,
+                    'pool_timeout': pool_timeout,
+                    'pool_recycle': pool_recycle,
+                }
+
+            engine = create_engine(db_uri, **kargs)
+            _add_pool_listeners(engine, pool_pre_ping and not external_pool)
+
+            _db_engines[engine_key] = engine
+
+        return _db_engines[engine_key]
+
+
+def dispose_db_engine(db_uri):
+    """
+    Closes all connections of the engines for a database in this process (for instance, before forking).
+    """
+    with _db_engines_lock:
+        engines_keys = [k for k in _db_engines if k[:2] == (os.getpid(), db_uri)]
+        engines = [_db_engines.pop(k) for k in engines_keys]
+
+    for engine in engines:
+        engine.dispose()
+
+
+def prewarm_db_engine(db_uri, n_connections=None, **pool_parameters):
+    """
+    Opens connections in advance, so the first requests do not have to wait for them.
+    :param n_connections: number of connections to open. By default, the pool size.
+    """
+    engine = get_db_engine(db_uri, **pool_parameters)
+
+    if n_connections is None:
+        n_connections = pool_parameters.get('pool_size', 10)
+
+    connections = []
+    try:
+        for i in range(n_connections):
+            connections.append(engine.connect())
+    finally:
+        for conn in connections:
+            conn.close()
+
+    logger.info('{} database connections opened'.format(len(connections)))
+
+
+def get_db_pool_stats(engine):
+    """
+    Returns metrics about the connection pool of an engine.
+    """
+    pool = engine.pool
+
+    pool_stats = dict(getattr(engine, 'ukbrest_pool_stats', {}))
+    pool_stats['pool_class'] = type(pool).__name__
+
+    for stat_name in ('size', 'checkedin', 'checkedout', 'overflow'):
+        if hasattr(pool, stat_name):
+            pool_stats[stat_name] = getattr(pool, stat_name)()
+
+    return pool_stats
+
+
+def get_db_uri(db_uri, search_path=None):
+    """
+    Returns the database URI with the search_path set for all its connections (libpq's options parameter).
+    Engines are cached by URI, so there is one for each search_path.
+    """
+    if not search_path:
+        return db_uri
+
+    options = urlencode({'options': '-csearch_path={}'.format(','.join(search_path))})
+
+    return '{}{}{}'.format(db_uri, '&' if '?' in db_uri else '?', options)
+
+
+def create_table(table_name, columns, db_engine, constraints=None, drop_if_exists=True, unlogged=False):
     with db_engine.connect() as conn:
         sql_st = """
             {drop_st}
-            CREATE TABLE {create_if_not_exists} {table_name}
+            CREATE {unlogged} TABLE {create_if_not_exists} {table_name}
             (
                 {columns}
                 {constraints}
@@ -15,6 +166,7 @@ def create_table(table_name, columns, db_engine, constraints=None, drop_if_exist
             );
         """.format(
             drop_st='DROP TABLE IF EXISTS {0};'.format(table_name) if drop_if_exists else '',
+            unlogged='UNLOGGED' if unlogged else '',
             create_if_not_exists='if not exists' if not drop_if_exists else '',
             table_name=table_name,
             columns=',\n'.join(columns),
@@ -25,45 +177,112 @@ def create_table(table_name, columns, db_engine, constraints=None, drop_if_exist
         conn.execute(sql_st)
 
 
-def create_indexes(table_name, columns, db_engine):
-    with db_engine.connect() as conn:
-        for column_spec in columns:
+def copy_data(table_name, data, db_engine, columns=None, on_conflict_do_nothing=False):
+    """
+    Bulk-loads data into an existing table with PostgreSQL's COPY (much faster than INSERT statements). Missing
+    values are loaded as NULL, and empty strings as such.
+    :param data: a DataFrame, or a list of them with the same columns (written one after the other).
+    :param columns: table columns matching those of data (by default, the data column names).
+    :param on_conflict_do_nothing: if True, data is copied into a temporary table and then inserted skipping rows
+    that violate a unique constraint (like those already in the table).
+    :return: the number of rows inserted.
+    """
+    if not isinstance(data, (list, tuple)):
+        data = [data]
+
+    if columns is None:
+        columns = list(data[0].columns)
+
+    columns_sql = ', '.join(columns)
+
+    buffer = io.StringIO()
+    for data_part in data:
+        data_part.to_csv(buffer, header=False, index=False, na_rep='\\N')
+    buffer.seek(0)
+
+    conn = db_engine.raw_connection()
+    try:
+        cursor = conn.cursor()
+
+        copy_table_name = table_name
+        if on_conflict_do_nothing:
+            copy_table_name = 'tmp_copy_{}'.format(table_name.replace('.', '_'))
+            cursor.execute('CREATE TEMPORARY TABLE {} (LIKE {} INCLUDING DEFAULTS) ON COMMIT DROP'.format(
+                copy_table_name, table_name
+            ))
+
+        cursor.copy_expert(
+            "COPY {} ({}) FROM STDIN WITH (FORMAT csv, NULL '\\N')".format(copy_table_name, columns_sql),
+            buffer
+        )
+        n_rows = sum(data_part.shape[0] for data_part in data)
 
-            if not isinstance(column_spec, (tuple, list)):
-                column_spec = (column_spec,)
+        if on_conflict_do_nothing:
+            cursor.execute('INSERT INTO {table_name} ({columns}) SELECT {columns} FROM {copy_table_name} '
+                           'ON CONFLICT DO NOTHING'.format(table_name=table_name, columns=columns_sql,
+                                                          copy_table_name=copy_table_name))
+            n_rows = cursor.rowcount
 
-            index_name_suffix = '_'.join(column_spec)
-            columns_name = ', '.join(column_spec)
+        cursor.close()
 
-            index_sql = """
-                CREATE INDEX ix_{table_name}_{index_name_suffix}
-                ON {table_name} USING btree
-                ({columns_name})
-            """.format(table_name=table_name, index_name_suffix=index_name_suffix, columns_name=columns_name)
+        conn.commit()
+    finally:
+        conn.close()
 
+    return n_rows
+
+
+def get_create_index_statements(table_name, columns, if_not_exists=False):
+    """
+    Returns the CREATE INDEX statements of the columns specified (each item can be a column or a tuple of them).
+    """
+    statements = []
+
+    for column_spec in columns:
+
+        if not isinstance(column_spec, (tuple, list)):
+            column_spec = (column_spec,)
+
+        index_name_suffix = '_'.join(column_spec)
+        columns_name = ', '.join(column_spec)
+
+        index_sql = """
+            CREATE INDEX {if_not_exists} ix_{table_name}_{index_name_suffix}
+            ON {table_name} USING btree
+            ({columns_name})
+        """.format(table_name=table_name, index_name_suffix=index_name_suffix, columns_name=columns_name,
+                   if_not_exists='IF NOT EXISTS' if if_not_exists else '')
+
+        statements.append(index_sql)
+
+    return statements
+
+
+def create_indexes(table_name, columns, db_engine, if_not_exists=False):
+    with db_engine.connect() as conn:
+        for index_sql in get_create_index_statements(table_name, columns, if_not_exists):
             conn.execute(index_sql)
 
 
 class DBAccess():
-    def __init__(self, db_uri):
+    def __init__(self, db_uri, db_pool_parameters=None):
         self.db_uri = db_uri
-        self.db_engine = None
+
+        self.db_pool_parameters = db_pool_parameters
+        if self.db_pool_parameters is None:
+            self.db_pool_parameters = get_db_pool_parameters()
+
+    def _get_db_uri(self):
+        return self.db_uri
 
     def _close_db_engine(self):
-        if self.db_engine is not None:
-            self.db_engine.dispose()
-            del(self.db_engine)
-            self.db_engine = None
+        dispose_db_engine(self._get_db_uri())
 
     def _get_db_engine(self):
-        if self.db_engine is None:
-            if self.db_uri is None or self.db_uri == "":
-                raise ValueError('DB URI was not set')
-
-            kargs = {'pool_size': 10}
-            self.db_engine = create_engine(self.db_uri, **kargs)
+        return get_db_engine(self._get_db_uri(), **self.db_pool_parameters)
 
-        return self.db_engine
+    def get_db_pool_stats(self):
+        return get_db_pool_stats(self._get_db_engine())
 
     def _vacuum(self, table_name):
         with self._get_db_engine().connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
@@ -0,0 +1,144 @@
+"""
+Profiling of data loading: time and peak memory of each stage, metrics of each unit of work (a table, a
+data-field) and progress logging with an estimated time to finish.
+"""
+import json
+import resource
+import sys
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import timedelta
+
+from ukbrest.config import logger
+
+
+# seconds between progress messages of the same unit of work
+PROGRESS_INTERVAL = 30
+
+
+def get_peak_rss():
+    """
+    Returns the peak resident set size of the current process, in bytes.
+    """
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # bytes in macOS, kilobytes in Linux
+    return peak_rss if sys.platform == 'darwin' else peak_rss * 1024
+
+
+def _format_eta(seconds):
+    return str(timedelta(seconds=int(seconds)))
+
+
+class ProgressReporter(object):
+    """
+    Logs the progress of a unit of work, given the fraction of it already done.
+    """
+
+    def __init__(self, name, interval=PROGRESS_INTERVAL):
+        self.name = name
+        self.interval = interval
+
+        self.start_time = time.perf_counter()
+        self.last_report_time = self.start_time
+
+    def update(self, fraction_done, n_rows):
+        now = time.perf_counter()
+
+        if now - self.last_report_time < self.interval:
+            return
+
+        self.last_report_time = now
+
+        elapsed_time = now - self.start_time
+        rows_per_second = n_rows / elapsed_time if elapsed_time > 0 else 0.0
+
+        eta = 'unknown'
+        if fraction_done > 0:
+            eta = _format_eta(elapsed_time * (1 - fraction_done) / fraction_done)
+
+        logger.info('{}: {:.1%} done, {} rows ({:.0f} rows/s), ETA {}'.format(
+            self.name, fraction_done, n_rows, rows_per_second, eta
+        ))
+
+
+class LoadProfiler(object):
+    def __init__(self):
+        self.start_time = time.perf_counter()
+
+        self.stages = []
+        self.units = []
+
+    @contextmanager
+    def stage(self, name, **info):
+        """
+        Measures the wall time and peak memory (of the main process) of a loading stage.
+        """
+        logger.info('Stage {} started'.format(name))
+
+        start_time = time.perf_counter()
+
+        try:
+            yield
+        finally:
+            elapsed_time = time.perf_counter() - start_time
+
+            stage_info = OrderedDict(stage=name)
+            stage_info.update(info)
+            stage_info['time'] = elapsed_time
+            stage_info['peak_rss'] = get_peak_rss()
+            self.stages.append(stage_info)
+
+            logger.info('Stage {} finished in {} (total elapsed time: {})'.format(
+                name, _format_eta(elapsed_time), _format_eta(time.perf_counter() - self.start_time)
+            ))
+
+    def add_unit(self, stage, **metrics):
+        """
+        Adds the metrics of a unit of work of a stage (like rows and bytes of a table).
+        """
+        unit_info = OrderedDict(stage=stage)
+        unit_info.update(metrics)
+        self.units.append(unit_info)
+
+    def get_summary(self):
+        """
+        Aggregates the metrics of the units of each stage.
+        """
+        summary = OrderedDict()
+
+        for stage_info in self.stages:
+            stage_summary = summary.setdefault(stage_info['stage'], OrderedDict(time=0.0))
+            stage_summary['time'] += stage_info['time']
+
+        for unit_info in self.units:
+            stage_summary = summary.setdefault(unit_info['stage'], OrderedDict(time=0.0))
+
+            for metric in ('rows', 'bytes_read', 'temp_bytes_written', 'copy_time'):
+                if metric in unit_info:
+                    stage_summary[metric] = stage_summary.get(metric, 0) + unit_info[metric]
+
+            if 'peak_rss' in unit_info:
+                stage_summary['max_worker_peak_rss'] = max(stage_summary.get('max_worker_peak_rss', 0),
+                                                           unit_info['peak_rss'])
+
+        for stage_summary in summary.values():
+            if 'rows' in stage_summary and stage_summary['time'] > 0:
+                stage_summary['rows_per_second'] = stage_summary['rows'] / stage_summary['time']
+
+        return summary
+
+    def get_profile(self):
+        return OrderedDict([
+            ('total_time', time.perf_counter() - self.start_time),
+            ('summary', self.get_summary()),
+            ('stages', self.stages),
+            ('units', self.units),
+        ])
+
+    def save(self, output_file):
+        with open(output_file, 'w') as f:
+            json.dump(self.get_profile(), f, indent=2)
+
+        logger.info('Loading profile written to {}'.format(output_file))
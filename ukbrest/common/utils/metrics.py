@@ -0,0 +1,164 @@
+"""
+In-process metrics (latency histograms and counters) exposed in the Prometheus text format. Each worker process
+keeps its own metrics.
+"""
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+from flask import g, has_request_context
+
+
+# upper bounds (seconds) of the latency histograms buckets
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+
+STAGE_SECONDS = 'ukbrest_stage_seconds'
+ROWS_TOTAL = 'ukbrest_rows_total'
+BYTES_TOTAL = 'ukbrest_bytes_total'
+
+HELP = {
+    STAGE_SECONDS: 'Time spent in each stage of a request',
+    ROWS_TOTAL: 'Rows returned by phenotype queries',
+    BYTES_TOTAL: 'Bytes produced by serializers',
+}
+
+
+def _get_labels_key(labels):
+    return tuple(sorted((labels or {}).items()))
+
+
+def _format_labels(labels_key, extra_labels=()):
+    labels = list(labels_key) + list(extra_labels)
+    if len(labels) == 0:
+        return ''
+
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('"', '\\"')) for k, v in labels) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Histogram(object):
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def render(self, name, labels_key):
+        lines = []
+
+        cumulative_count = 0
+        for upper_bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            cumulative_count += count
+            lines.append('{}_bucket{} {}'.format(
+                name, _format_labels(labels_key, (('le', _format_value(upper_bound)),)), cumulative_count
+            ))
+
+        lines.append('{}_sum{} {}'.format(name, _format_labels(labels_key), _format_value(self.sum)))
+        lines.append('{}_count{} {}'.format(name, _format_labels(labels_key), cumulative_count))
+
+        return lines
+
+
+class MetricsRegistry(object):
+    def __init__(self):
+        self._lock = threading.Lock()
+
+        self.histograms = {}
+        self.counters = {}
+
+    def observe(self, name, value, labels=None):
+        with self._lock:
+            histograms = self.histograms.setdefault(name, {})
+            labels_key = _get_labels_key(labels)
+
+            if labels_key not in histograms:
+                histograms[labels_key] = Histogram()
+
+            histograms[labels_key].observe(value)
+
+    def inc(self, name, value=1, labels=None):
+        with self._lock:
+            counters = self.counters.setdefault(name, {})
+            labels_key = _get_labels_key(labels)
+
+            counters[labels_key] = counters.get(labels_key, 0) + value
+
+    def reset(self):
+        with self._lock:
+            self.histograms = {}
+            self.counters = {}
+
+    def render(self, gauges=None):
+        """
+        Returns all metrics in the Prometheus text format.
+        :param gauges: dictionary with additional gauges (name: value) computed by the caller.
+        """
+        lines = []
+
+        with self._lock:
+            for name, histograms in sorted(self.histograms.items()):
+                lines.append('# HELP {} {}'.format(name, HELP.get(name, name)))
+                lines.append('# TYPE {} histogram'.format(name))
+
+                for labels_key, histogram in sorted(histograms.items()):
+                    lines.extend(histogram.render(name, labels_key))
+
+            for name, counters in sorted(self.counters.items()):
+                lines.append('# HELP {} {}'.format(name, HELP.get(name, name)))
+                lines.append('# TYPE {} counter'.format(name))
+
+                for labels_key, value in sorted(counters.items()):
+                    lines.append('{}{} {}'.format(name, _format_labels(labels_key), _format_value(value)))
+
+        for name, value in sorted((gauges or {}).items()):
+            if value is None:
+                continue
+
+            lines.append('# TYPE {} gauge'.format(name))
+            lines.append('{} {}'.format(name, _format_value(value)))
+
+        return '\n'.join(lines) + '\n'
+
+
+METRICS = MetricsRegistry()
+
+
+def record_stage(stage, elapsed_time, **labels):
+    """
+    Records the time spent in a stage. If there is a request being processed, it is also added to its timings
+    (used by the Server-Timing header).
+    """
+    METRICS.observe(STAGE_SECONDS, elapsed_time, dict(labels, stage=stage))
+
+    if has_request_context():
+        request_timings = g.setdefault('ukbrest_timings', {})
+        request_timings[stage] = request_timings.get(stage, 0.0) + elapsed_time
+
+
+@contextmanager
+def timed(stage, **labels):
+    start_time = time.perf_counter()
+
+    try:
+        yield
+    finally:
+        record_stage(stage, time.perf_counter() - start_time, **labels)
+
+
+def get_server_timing(request_timings):
+    """
+    Returns the value of the Server-Timing header for the timings (in seconds) of a request.
+    """
+    return ', '.join(
+        '{};dur={:.1f}'.format(stage, stage_time * 1000) for stage, stage_time in sorted(request_timings.items())
+    )
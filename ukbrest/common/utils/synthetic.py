@@ -0,0 +1,270 @@
+"""
+Generates synthetic datasets shaped like the UK Biobank ones (a phenotype CSV, its .html schema and genotype
+BGEN/sample files) to reproduce loading and querying performance at realistic scale. Everything is generated
+with numpy by blocks of at most block_cells values (samples x columns for phenotypes, variants x samples for
+genotypes), so memory usage depends on the block size and not on the size of the dataset (but a genotype block
+has at least one variant with all samples).
+"""
+import os
+from os.path import join
+from subprocess import Popen, PIPE
+
+import numpy as np
+import pandas as pd
+
+from ukbrest.common.utils.datagen import generate_random_gen
+from ukbrest.config import logger
+
+
+# proportion of data-fields of each type
+FIELD_TYPES = (
+    ('Integer', 0.20),
+    ('Continuous', 0.30),
+    ('Categorical (single)', 0.25),
+    ('Categorical (multiple)', 0.10),
+    ('Date', 0.10),
+    ('Text', 0.05),
+)
+
+FIRST_FIELD_ID = 100
+FIRST_CODING = 1000
+FIRST_EID = 1000000
+MAX_EID = 9999999
+BASE_DATE = np.datetime64('1990-01-01')
+
+# maximum number of values generated at once
+DEFAULT_BLOCK_CELLS = 2000000
+
+
+def get_fields_schema(n_columns, random_state, max_instances=4, max_arrays=40):
+    """
+    Generates the data-fields of the dataset, with instances and arrays, until n_columns columns are reached.
+    'Categorical (multiple)' data-fields have many arrays, as in the UK Biobank.
+    :return: a DataFrame with one row per column: column_name (like 100-0.0), field_id, instance, array, type,
+    coding (NaN if none) and n_categories.
+    """
+    types, types_probs = zip(*FIELD_TYPES)
+
+    columns = []
+    field_id = FIRST_FIELD_ID
+
+    while len(columns) < n_columns:
+        field_type = types[random_state.choice(len(types), p=types_probs)]
+
+        n_instances = random_state.randint(1, max_instances + 1)
+        n_arrays = random_state.randint(2, max_arrays + 1) if field_type == 'Categorical (multiple)' else 1
+
+        coding = np.nan
+        n_categories = 0
+        if field_type.startswith('Categorical'):
+            coding = FIRST_CODING + field_id
+            n_categories = random_state.randint(2, 200)
+
+        for instance in range(n_instances):
+            for array in range(n_arrays):
+                columns.append((
+                    '{}-{}.{}'.format(field_id, instance, array), field_id, instance, array, field_type, coding,
+                    n_categories,
+                ))
+
+        field_id += 1
+
+    return pd.DataFrame(
+        columns[:n_columns],
+        columns=['column_name', 'field_id', 'instance', 'array', 'type', 'coding', 'n_categories']
+    )
+
+
+def get_eids(n_samples, random_state):
+    return np.sort(random_state.choice(np.arange(FIRST_EID, MAX_EID + 1), size=n_samples, replace=False))
+
+
+def get_block_data(schema, n_rows, random_state, sparsity=0.3):
+    """
+    Generates the values of all columns for n_rows samples, as strings (empty ones are missing values).
+    :param sparsity: proportion of missing values in each column. 'Categorical (multiple)' columns are filled from
+    the first array, so higher arrays are emptier, as in the UK Biobank.
+    :return: a numpy array of strings with shape (n_rows, number of columns).
+    """
+    block = np.empty((n_rows, schema.shape[0]), dtype=object)
+
+    for field_type, type_columns in schema.groupby('type', sort=False):
+        col_idxs = type_columns.index.values
+        shape = (n_rows, len(col_idxs))
+
+        if field_type == 'Integer':
+            values = np.char.mod('%d', random_state.randint(-10, 1000, size=shape))
+        elif field_type == 'Continuous':
+            values = np.char.mod('%.5f', random_state.normal(100, 25, size=shape))
+        elif field_type in ('Categorical (single)', 'Categorical (multiple)'):
+            n_categories = type_columns['n_categories'].values
+            values = np.char.mod('%d', (random_state.random_sample(shape) * n_categories).astype(int) + 1)
+        elif field_type == 'Date':
+            values = (BASE_DATE + random_state.randint(0, 365 * 30, size=shape)).astype(str)
+        else:
+            values = np.char.add('text', np.char.mod('%d', random_state.randint(0, 100000, size=shape)))
+
+        if field_type == 'Categorical (multiple)':
+            # each sample has a number of items, filling arrays from the first one
+            n_items = random_state.geometric(0.3, size=(n_rows, 1)) - 1
+            missing = type_columns['array'].values[np.newaxis, :] >= n_items
+        else:
+            missing = random_state.random_sample(shape) < sparsity
+
+        block[:, col_idxs] = np.where(missing, '', values)
+
+    return block
+
+
+def write_phenotype_csv(output_file, schema, eids, random_state, block_cells=DEFAULT_BLOCK_CELLS, sparsity=0.3):
+    """
+    Writes the phenotype CSV file (eid and all the columns in schema) by blocks of samples, each one with at most
+    block_cells values (at least one sample).
+    """
+    header = ['eid'] + schema['column_name'].tolist()
+    block_size = max(block_cells // max(schema.shape[0], 1), 1)
+
+    with open(output_file, 'w') as f:
+        f.write(','.join('"{}"'.format(c) for c in header) + '\n')
+
+        for block_start in range(0, len(eids), block_size):
+            block_eids = eids[block_start:block_start + block_size]
+
+            block = get_block_data(schema, len(block_eids), random_state, sparsity)
+
+            pd.DataFrame(block, index=block_eids).to_csv(f, header=False, index=True)
+
+            logger.info('Samples written: {}'.format(block_start + len(block_eids)))
+
+
+def write_phenotype_html(output_file, schema, n_samples):
+    """
+    Writes the .html file with the columns types and descriptions, in the same format as the UK Biobank one.
+    """
+    rows = [
+        '<tr><td style="text-align: right;">0</td><td><a>eid</a></td><td style="text-align: right;">{}</td>'
+        '<td>Sequence</td><td>Encoded anonymised participant ID</td></tr>'.format(n_samples)
+    ]
+
+    for col_idx, col in enumerate(schema.itertuples(), start=1):
+        description = 'Synthetic field {}'.format(col.field_id)
+
+        if not pd.isnull(col.coding):
+            description += '<br>Uses data-coding <a>{:d}</a> comprises {:d} Integer-valued members in a simple list.'.format(
+                int(col.coding), int(col.n_categories)
+            )
+
+        rows.append(
+            '<tr><td style="text-align: right;">{col_idx}</td><td><a>{column_name}</a></td>'
+            '<td style="text-align: right;">{n_samples}</td><td>{type}</td><td>{description}</td></tr>'.format(
+                col_idx=col_idx, column_name=col.column_name, n_samples=n_samples, type=col.type,
+                description=description,
+            )
+        )
+
+    with open(output_file, 'w') as f:
+        f.write(
+            '<!DOCTYPE HTML PUBLIC "-//W3C//DTD HTML 4.01 Transitional//EN" "http://www.w3.org/TR/html4/loose.dtd">\n'
+            '<html lang="en">\n<head>\n<title>Synthetic dataset</title>\n</head>\n<body>\n'
+            '<table border cellspacing="0">\n'
+            '<tr><th>Column</th><th><a href="#udi">UDI</a></th><th><a href="#count">Count</a></th><th>Type</th>'
+            '<th>Description</th></tr>\n'
+        )
+        f.write('\n'.join(rows))
+        f.write('\n</table>\n</body>\n</html>\n')
+
+
+def write_genotype(output_dir, eids, chromosome, n_variants, random_state, block_cells=DEFAULT_BLOCK_CELLS,
+                   bgen=True, qctool_path='qctool'):
+    """
+    Writes genotype data for the samples: a .gen file (by blocks of variants) and a .sample file. If bgen is True,
+    the .gen file is converted to BGEN (named as ukbrest expects it, like chr1impv1.bgen) with qctool.
+    :param block_cells: maximum number of genotypes (variants x samples) generated at once; blocks have at least one
+    variant.
+    :return: the path of the genotype file written (.bgen or .gen).
+    """
+    block_size = max(block_cells // max(len(eids), 1), 1)
+
+    gen_file = join(output_dir, 'chr{:d}impv1.gen'.format(chromosome))
+    sample_file = join(output_dir, 'impv1.sample')
+
+    samples_data = pd.DataFrame({
+        'ID_1': np.concatenate(([0], eids)),
+        'ID_2': np.concatenate(([0], eids)),
+        'missing': np.zeros(len(eids) + 1, dtype=int),
+    }, columns=['ID_1', 'ID_2', 'missing'])
+    samples_data.to_csv(sample_file, sep=' ', header=True, index=False)
+
+    with open(gen_file, 'w') as f:
+        for block_start in range(0, n_variants, block_size):
+            n_block_variants = min(block_size, n_variants - block_start)
+
+            gen_data = generate_random_gen(n_block_variants, len(eids), chromosome,
+                                           initial_position=100 + block_start * 100, random_state=random_state)
+            gen_data['rsid'] = ['rs{:d}'.format(chromosome * 1000000 + block_start + i)
+                                for i in range(n_block_variants)]
+
+            gen_data.to_csv(f, sep=' ', header=False, index=False)
+
+    if not bgen:
+        return gen_file
+
+    bgen_file = join(output_dir, 'chr{:d}impv1.bgen'.format(chromosome))
+
+    p = Popen([qctool_path, '-g', gen_file, '-s', sample_file, '-og', bgen_file], stdout=PIPE, stderr=PIPE)
+    stdout_data, stderr_data = p.communicate()
+
+    if p.returncode != 0:
+        raise Exception(stdout_data + b'\n' + stderr_data)
+
+    os.remove(gen_file)
+
+    return bgen_file
+
+
+def generate_dataset(output_dir, n_samples, n_columns, n_variants=0, chromosomes=(1,),
+                     block_cells=DEFAULT_BLOCK_CELLS, sparsity=0.3, bgen=True, seed=0):
+    """
+    Generates a synthetic dataset in output_dir: synthetic.csv and synthetic.html with the phenotype data and,
+    if n_variants > 0, genotype files for each chromosome.
+    :param block_cells: maximum number of values (phenotypes or genotypes) generated at once.
+    """
+    random_state = np.random.RandomState(seed)
+
+    os.makedirs(output_dir, exist_ok=True)
+
+    schema = get_fields_schema(n_columns, random_state)
+    eids = get_eids(n_samples, random_state)
+
+    logger.info('Generating {} samples and {} columns ({} data-fields)'.format(
+        n_samples, schema.shape[0], schema['field_id'].nunique()
+    ))
+
+    write_phenotype_html(join(output_dir, 'synthetic.html'), schema, n_samples)
+    write_phenotype_csv(join(output_dir, 'synthetic.csv'), schema, eids, random_state, block_cells, sparsity)
+
+    if n_variants > 0:
+        for chromosome in chromosomes:
+            logger.info('Generating {} variants for chromosome {}'.format(n_variants, chromosome))
+            write_genotype(output_dir, eids, chromosome, n_variants, random_state, block_cells=block_cells, bgen=bgen)
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Generates a synthetic UK Biobank-like dataset.')
+    parser.add_argument('output_dir', type=str, help='Output directory')
+    parser.add_argument('--n-samples', type=int, default=10000, help='Number of samples (up to 500000)')
+    parser.add_argument('--n-columns', type=int, default=1000, help='Number of phenotype columns (up to 20000)')
+    parser.add_argument('--n-variants', type=int, default=0, help='Number of variants per chromosome')
+    parser.add_argument('--chromosomes', type=int, nargs='+', default=[1], help='Chromosomes to generate')
+    parser.add_argument('--block-cells', type=int, default=DEFAULT_BLOCK_CELLS,
+                        help='Maximum number of values (samples x columns, or variants x samples) generated at once')
+    parser.add_argument('--sparsity', type=float, default=0.3, help='Proportion of missing values')
+    parser.add_argument('--no-bgen', dest='bgen', action='store_false', help='Keep .gen files (qctool is not used)')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed')
+
+    args = parser.parse_args()
+
+    generate_dataset(args.output_dir, args.n_samples, args.n_columns, args.n_variants, args.chromosomes,
+                     args.block_cells, args.sparsity, args.bgen, args.seed)
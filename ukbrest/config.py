@@ -25,8 +25,32 @@ TMP_DIR_ENV='UKBREST_TEMP_DIR'
 DEBUG_ENV='UKBREST_DEBUG'
 SQL_CHUNKSIZE_ENV='UKBREST_SQL_CHUNKSIZE'
 LOADING_N_JOBS_ENV= 'UKBREST_LOADING_N_JOBS'
+LAYOUT_PLAN_ENV='UKBREST_LAYOUT_PLAN'
+LOAD_PROFILE_FILE_ENV='UKBREST_LOAD_PROFILE_FILE'
+MAINTENANCE_WORK_MEM_ENV='UKBREST_MAINTENANCE_WORK_MEM'
+BULK_LOAD_ENV='UKBREST_BULK_LOAD'
+REWRITE_NOT_IN_ENV='UKBREST_REWRITE_NOT_IN'
+SAMPLES_FILTERS_CACHE_ENV='UKBREST_SAMPLES_FILTERS_CACHE'
+YAML_COLUMNS_N_JOBS_ENV='UKBREST_YAML_COLUMNS_N_JOBS'
+MAX_QUERY_COST_ENV='UKBREST_MAX_QUERY_COST'
+PREPARED_STATEMENTS_ENV='UKBREST_PREPARED_STATEMENTS'
+BLUE_GREEN_ENV='UKBREST_BLUE_GREEN'
+DB_POOL_SIZE_ENV='UKBREST_DB_POOL_SIZE'
+DB_MAX_OVERFLOW_ENV='UKBREST_DB_MAX_OVERFLOW'
+DB_POOL_TIMEOUT_ENV='UKBREST_DB_POOL_TIMEOUT'
+DB_POOL_RECYCLE_ENV='UKBREST_DB_POOL_RECYCLE'
+DB_POOL_PRE_PING_ENV='UKBREST_DB_POOL_PRE_PING'
+DB_POOL_PREWARM_ENV='UKBREST_DB_POOL_PREWARM'
+DB_EXTERNAL_POOL_ENV='UKBREST_DB_EXTERNAL_POOL'
+SERIALIZER_BUFFER_SIZE_ENV='UKBREST_SERIALIZER_BUFFER_SIZE'
+RESPONSE_COMPRESSION_ENV='UKBREST_RESPONSE_COMPRESSION'
+RESPONSE_COMPRESSION_LEVEL_ENV='UKBREST_RESPONSE_COMPRESSION_LEVEL'
+RESPONSE_COMPRESSION_THREAD_ENV='UKBREST_RESPONSE_COMPRESSION_THREAD'
+METRICS_ENV='UKBREST_METRICS'
+SERVER_TIMING_ENV='UKBREST_SERVER_TIMING'
 
 LOAD_DATA_VACUUM = 'UKBREST_VACUUM'
+LOAD_DATA_RESUME = 'UKBREST_LOAD_RESUME'
 
 HTTP_AUTH_USERS_FILE = 'UKBREST_HTTP_USERS_FILE_PATH'
 
@@ -66,12 +90,71 @@ debug = bool(environ.get(DEBUG_ENV, False))
 # SQL queries will be read by chunks with this size (number of rows)
 sql_chunksize = environ.get(SQL_CHUNKSIZE_ENV, None)
 
+# rewrite "eid not in (select eid ...)" conditions in queries as "not exists" (anti joins)
+rewrite_not_in = environ.get(REWRITE_NOT_IN_ENV, 'false').lower() in ('1', 'true', 'yes')
+
+# evaluate samples filters of YAML queries once per data load and keep the selected eids in a table
+samples_filters_cache = environ.get(SAMPLES_FILTERS_CACHE_ENV, 'false').lower() in ('1', 'true', 'yes')
+
+# number of YAML columns queried concurrently (1 computes the whole section with a single query)
+yaml_columns_n_jobs = environ.get(YAML_COLUMNS_N_JOBS_ENV, 1)
+
+# queries with a larger estimated cost (PostgreSQL's EXPLAIN) are rejected
+max_query_cost = environ.get(MAX_QUERY_COST_ENV, None)
+
+# run phenotype queries as prepared statements, with filter constants as parameters
+prepared_statements = environ.get(PREPARED_STATEMENTS_ENV, 'false').lower() in ('1', 'true', 'yes')
+
+# data is loaded into a new schema, which replaces the one used by queries only when loading finishes
+blue_green = environ.get(BLUE_GREEN_ENV, 'false').lower() in ('1', 'true', 'yes')
+
+# database connection pool (one per process and database)
+db_pool_size = environ.get(DB_POOL_SIZE_ENV, 10)
+db_max_overflow = environ.get(DB_MAX_OVERFLOW_ENV, 10)
+db_pool_timeout = environ.get(DB_POOL_TIMEOUT_ENV, 30)
+db_pool_recycle = environ.get(DB_POOL_RECYCLE_ENV, -1)
+db_pool_pre_ping = environ.get(DB_POOL_PRE_PING_ENV, 'true').lower() in ('1', 'true', 'yes')
+# number of connections opened when the web server starts
+db_pool_prewarm = environ.get(DB_POOL_PREWARM_ENV, 0)
+# connections are handled by an external pool (like pgbouncer)
+db_external_pool = environ.get(DB_EXTERNAL_POOL_ENV, 'false').lower() in ('1', 'true', 'yes')
+
+# phenotype data is sent to clients in blocks of at least this size (bytes)
+serializer_buffer_size = environ.get(SERIALIZER_BUFFER_SIZE_ENV, 256 * 1024)
+
+# compression of responses (if the client accepts it): comma-separated list of encodings (gzip, zstd), or empty
+response_compression = environ.get(RESPONSE_COMPRESSION_ENV, 'gzip,zstd')
+response_compression_level = environ.get(RESPONSE_COMPRESSION_LEVEL_ENV, None)
+# compress in the request thread while data is produced in another one
+response_compression_thread = environ.get(RESPONSE_COMPRESSION_THREAD_ENV, 'false').lower() in ('1', 'true', 'yes')
+
+# expose timings and other metrics in /metrics (Prometheus text format; it uses the same authentication as the API)
+metrics = environ.get(METRICS_ENV, 'false').lower() in ('1', 'true', 'yes')
+# add the Server-Timing header to responses (stages finished before the response starts)
+server_timing = environ.get(SERVER_TIMING_ENV, 'false').lower() in ('1', 'true', 'yes')
+
 loading_chunksize = environ.get(LOADING_CHUNKSIZE, 5000)
 
 loading_n_jobs = environ.get(LOADING_N_JOBS_ENV, -1)
 
+# YAML file with groups of columns that should be stored in the same table (see ukbrest.common.layout)
+layout_plan = environ.get(LAYOUT_PLAN_ENV, None)
+
+# JSON file where the time, rows, bytes and memory of each loading stage and table are written
+load_profile_file = environ.get(LOAD_PROFILE_FILE_ENV, None)
+
+# PostgreSQL's maintenance_work_mem of each connection building indexes when loading (up to loading_n_jobs at once);
+# if not set, the server's one is used
+maintenance_work_mem = environ.get(MAINTENANCE_WORK_MEM_ENV, None)
+
+# load into UNLOGGED tables (switched to LOGGED at the end) with session settings that reduce WAL and fsync work
+bulk_load = environ.get(BULK_LOAD_ENV, 'false').lower() in ('1', 'true', 'yes')
+
 load_data_vacuum = environ.get(LOAD_DATA_VACUUM, True)
 
+# skip units of work completed by a previous (failed) load
+load_data_resume = environ.get(LOAD_DATA_RESUME, 'false').lower() in ('1', 'true', 'yes')
+
 http_auth_users_file = environ.get(HTTP_AUTH_USERS_FILE, None)
 
 
@@ -95,6 +178,7 @@ def get_postloader_parameters():
 def get_postloader_codings_parameters():
     return {
         'codings_dir': codings_path,
+        'n_jobs': int(loading_n_jobs),
     }
 
 
@@ -131,12 +215,34 @@ def get_pheno2sql_parameters():
         'tmpdir': tmpdir,
         'loading_chunksize': int(loading_chunksize),
         'sql_chunksize': int(sql_chunksize) if sql_chunksize is not None else None,
+        'layout_plan': layout_plan,
+        'rewrite_not_in': rewrite_not_in,
+        'samples_filters_cache': samples_filters_cache,
+        'yaml_columns_n_jobs': int(yaml_columns_n_jobs),
+        'max_query_cost': float(max_query_cost) if max_query_cost is not None else None,
+        'prepared_statements': prepared_statements,
+        'load_profile_file': load_profile_file,
+        'maintenance_work_mem': maintenance_work_mem,
+        'bulk_load': bulk_load,
+        'blue_green': blue_green,
+    }
+
+
+def get_db_pool_parameters():
+    return {
+        'pool_size': int(db_pool_size),
+        'max_overflow': int(db_max_overflow),
+        'pool_timeout': int(db_pool_timeout),
+        'pool_recycle': int(db_pool_recycle),
+        'pool_pre_ping': db_pool_pre_ping,
+        'external_pool': db_external_pool,
     }
 
 
 def get_pheno2sql_load_parameters():
     return {
-        'vacuum': load_data_vacuum
+        'vacuum': load_data_vacuum,
+        'resume': load_data_resume,
     }
 
 
@@ -156,6 +262,16 @@ def get_argparse_arguments(parser=None):
     parser.add_argument('--loading-n-jobs', type=int, help='The loading step will be parallelized with n number of jobs. By default it is the number of cores')
     parser.add_argument('--tmpdir', type=str, help='Temporal directory. Temporary CSV files are written here.')
     parser.add_argument('--loading-chunksize', type=int, help='For the loading step, this will specify the number of rows read each time from CSV files. It is set to 5000 by default.')
+    parser.add_argument('--layout-plan', type=str, help='YAML file with groups of columns that should be stored in the same table. It can be created with ukbrest.common.layout from YAML query files or query logs.')
+    parser.add_argument('--rewrite-not-in', action='store_true', default=None, help='Rewrite conditions like "eid not in (select eid ...)" in queries as "not exists", so they can be run as anti joins.')
+    parser.add_argument('--samples-filters-cache', action='store_true', default=None, help='Evaluate samples filters of YAML queries once per data load and join the selected samples in each query.')
+    parser.add_argument('--yaml-columns-n-jobs', type=int, help='Number of columns of a YAML section queried concurrently, each one on its own database connection. By default (1) a section is computed with a single query. With more than one job, results are not streamed: the whole section is read into memory first.')
+    parser.add_argument('--max-query-cost', type=float, help='Queries with an estimated cost (from PostgreSQL EXPLAIN) larger than this are rejected. No limit by default.')
+    parser.add_argument('--prepared-statements', action='store_true', default=None, help='Run phenotype queries as prepared statements (with filter constants as parameters), so they are planned once per connection.')
+    parser.add_argument('--load-profile-file', type=str, help='JSON file where a profile of the loading process (time, rows, bytes and peak memory of each stage and table) is written.')
+    parser.add_argument('--blue-green', action='store_true', default=None, help='Load data into a new database schema and switch queries to it only when loading finishes, so the API keeps serving the previous data meanwhile.')
+    parser.add_argument('--maintenance-work-mem', type=str, help='PostgreSQL maintenance_work_mem (like 256MB) of each connection building primary keys and indexes after data is loaded. Up to --loading-n-jobs indexes are built at once. By default, the server\'s one is used.')
+    parser.add_argument('--bulk-load', action='store_true', default=None, help='Load data into UNLOGGED tables (switched to LOGGED once loaded and indexed) and without waiting for WAL flushes on commit. Much less WAL is written, but tables of an interrupted load are emptied if PostgreSQL crashes.')
     parser.add_argument('--sql-chunksize', type=int, help='When performing any SQL query, this will be the the number of rows processed at each time. 5000 rows by default.')
     parser.add_argument('--debug', action='store_true')
     parser.add_argument('--host', type=str, help='Host', default='127.0.0.1')
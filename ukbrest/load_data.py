@@ -16,6 +16,9 @@ parser.add_argument('--load-samples-data', action='store_true')
 parser.add_argument('--identifier-columns', type=str, nargs='+', help='Format file1.txt:column1 file2.txt:column2 ...')
 parser.add_argument('--skip-columns', type=str, nargs='+', help='Format file1.txt:column1 file2.txt:column2 ...')
 parser.add_argument('--separators', type=str, nargs='+', help='Format file1.txt:column1 file2.txt:column2 ...')
+parser.add_argument('--materialize-yaml', type=str, help='YAML file with sections to materialize as derived phenotypes')
+parser.add_argument('--resume', action='store_true', default=None, help='Resume a failed load, skipping the work already done')
+parser.add_argument('--materialize-sections', type=str, nargs='+', help='Format section1 section2:name2 ... (name is optional)')
 
 
 @handle_errors
@@ -72,10 +75,34 @@ def load_data(args):
     p2sql = Pheno2SQL(**pheno2sql_parameters)
 
     load_parameters = config.get_pheno2sql_load_parameters()
+    load_parameters = update_parameters_from_args(load_parameters, args)
 
     p2sql.load_data(**load_parameters)
 
 
+@handle_errors
+def materialize_derived_phenotypes(args):
+    from ruamel.yaml import YAML
+
+    pheno2sql_parameters = config.get_pheno2sql_parameters()
+    pheno2sql_parameters = update_parameters_from_args(pheno2sql_parameters, args)
+
+    if parameter_empty(pheno2sql_parameters, 'db_uri'):
+        parser.error('--db-uri missing')
+
+    if args.materialize_sections is None:
+        parser.error('--materialize-sections missing')
+
+    with open(args.materialize_yaml, 'r') as f:
+        yaml_file = YAML(typ='safe').load(f)
+
+    p2sql = Pheno2SQL(**pheno2sql_parameters)
+
+    for section_spec in args.materialize_sections:
+        section, _, name = section_spec.partition(':')
+        p2sql.register_derived_phenotypes(yaml_file, section, name=name or None)
+
+
 @handle_errors
 def load_sql():
     pheno2sql_parameters = config.get_pheno2sql_parameters()
@@ -105,5 +132,8 @@ if __name__ == '__main__':
     elif args.load_sql:
         load_sql()
 
+    elif args.materialize_yaml is not None:
+        materialize_derived_phenotypes(args)
+
     else:
         load_data(args)
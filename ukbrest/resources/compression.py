@@ -0,0 +1,169 @@
+import queue
+import threading
+import zlib
+
+from ukbrest.config import logger, response_compression, response_compression_level, response_compression_thread
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+# preferred first
+SUPPORTED_ENCODINGS = ('zstd', 'gzip')
+
+DEFAULT_LEVELS = {
+    'gzip': 6,
+    'zstd': 3,
+}
+
+
+def _get_available_encodings():
+    available = [e.strip().lower() for e in response_compression.split(',') if e.strip() != '']
+
+    if zstandard is None and 'zstd' in available:
+        available.remove('zstd')
+
+    return [e for e in SUPPORTED_ENCODINGS if e in available]
+
+
+def get_content_encoding(accept_encoding):
+    """
+    Chooses the compression for a response given the Accept-Encoding header of the request.
+    :return: the encoding name, or None if the response should not be compressed.
+    """
+    if not accept_encoding:
+        return None
+
+    accepted = {}
+    for encoding_spec in accept_encoding.split(','):
+        encoding_parts = encoding_spec.strip().split(';')
+        encoding = encoding_parts[0].strip().lower()
+
+        quality = 1.0
+        for param in encoding_parts[1:]:
+            param = param.strip()
+            if param.startswith('q='):
+                try:
+                    quality = float(param[2:])
+                except ValueError:
+                    quality = 0.0
+
+        accepted[encoding] = quality
+
+    for encoding in _get_available_encodings():
+        if accepted.get(encoding, accepted.get('*', 0.0)) > 0:
+            return encoding
+
+    return None
+
+
+def _run_in_thread(blocks, max_queued_blocks=4, put_timeout=0.5):
+    """
+    Iterates blocks in another thread, so producing them (querying the database, serializing) overlaps with
+    consuming them (compressing, sending). If the consumer stops iterating (for instance, the client disconnected),
+    the producer thread stops and closes blocks.
+    """
+    blocks_queue = queue.Queue(maxsize=max_queued_blocks)
+    end_of_data = object()
+    stop = threading.Event()
+
+    def put(item):
+        # never blocks forever: gives up if the consumer is gone
+        while not stop.is_set():
+            try:
+                blocks_queue.put(item, timeout=put_timeout)
+                return True
+            except queue.Full:
+                pass
+
+        return False
+
+    def producer():
+        try:
+            for block in blocks:
+                if not put(block):
+                    break
+        except Exception as e:
+            put(e)
+        finally:
+            if hasattr(blocks, 'close'):
+                blocks.close()
+
+            put(end_of_data)
+
+    producer_thread = threading.Thread(target=producer, daemon=True)
+    producer_thread.start()
+
+    try:
+        while True:
+            block = blocks_queue.get()
+
+            if block is end_of_data:
+                break
+
+            if isinstance(block, Exception):
+                raise block
+
+            yield block
+    finally:
+        stop.set()
+
+
+def compress_stream(blocks, encoding, level=None, use_thread=None):
+    """
+    Compresses a stream of bytes blocks incrementally.
+    :param encoding: gzip or zstd.
+    :param level: compression level (by default, from configuration or a standard one for each encoding).
+    :param use_thread: if True, blocks are produced in another thread while compressing.
+    """
+    if level is None:
+        level = int(response_compression_level) if response_compression_level is not None else DEFAULT_LEVELS[encoding]
+
+    if use_thread is None:
+        use_thread = response_compression_thread
+
+    if use_thread:
+        blocks = _run_in_thread(blocks)
+
+    if encoding == 'gzip':
+        # wbits 16 + 15: gzip header and trailer
+        compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    elif encoding == 'zstd':
+        compressor = zstandard.ZstdCompressor(level=level).compressobj()
+    else:
+        raise ValueError('Unsupported encoding: {}'.format(encoding))
+
+    logger.debug('Compressing response with {} (level {})'.format(encoding, level))
+
+    try:
+        for block in blocks:
+            if isinstance(block, str):
+                block = block.encode('utf-8')
+
+            compressed_block = compressor.compress(block)
+            if compressed_block:
+                yield compressed_block
+    finally:
+        if use_thread:
+            blocks.close()
+
+    yield compressor.flush()
+
+
+def compress_response(data, request_headers, response_headers):
+    """
+    Compresses the data of a response if the client accepts it, adding the needed response headers.
+    :return: the data to send.
+    """
+    content_encoding = get_content_encoding(request_headers.get('Accept-Encoding'))
+
+    response_headers['Vary'] = 'Accept-Encoding'
+
+    if content_encoding is None:
+        return data
+
+    response_headers['Content-Encoding'] = content_encoding
+
+    return compress_stream(data, content_encoding)
@@ -28,3 +28,8 @@ class UkbRestProgramExecutionError(UkbRestException):
 class UkbRestSQLExecutionError(UkbRestException):
     def __init__(self, message):
         super(UkbRestSQLExecutionError, self).__init__(message, 'SQL_EXECUTION_ERROR')
+
+
+class UkbRestQueryCostError(UkbRestException):
+    def __init__(self, message):
+        super(UkbRestQueryCostError, self).__init__(message, 'QUERY_COST_ERROR')
@@ -1,8 +1,19 @@
+import io
 import json
 
-from flask import Response
+import numpy as np
+from flask import Response, request
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
 
 from ukbrest.common.utils.constants import BGEN_SAMPLES_TABLE
+from ukbrest.common.utils.metrics import timed, METRICS, BYTES_TOTAL
+from ukbrest.config import serializer_buffer_size
+from ukbrest.resources.compression import compress_response
 from ukbrest.resources.error_handling import handle_http_errors
 
 
@@ -24,14 +35,39 @@ class DataIterator:
 
 
 class GenericSerializer():
+    # if True, data is serialized with its types (integers are not formatted as text)
+    typed = False
+
+    def __init__(self, buffer_size=None):
+        """
+        :param buffer_size: data is sent in blocks of at least this number of bytes (except the last one).
+        """
+        self.buffer_size = buffer_size if buffer_size is not None else int(serializer_buffer_size)
+
     def data_generator(self, all_data, data_conversion_func, **kwargs):
-        from io import StringIO
+        # all chunks are encoded into the same buffer, which is emptied each time a block is sent
+        buffer = io.BytesIO()
+        text_buffer = io.TextIOWrapper(buffer, encoding='utf-8', newline='', write_through=True)
 
         for row_idx, row in enumerate(all_data):
-            f = StringIO()
-            data_conversion_func(row, f, header=(row_idx == 0), **kwargs)
+            with timed('serialize', format=self.format_name):
+                data_conversion_func(row, text_buffer, header=(row_idx == 0), **kwargs)
+
+            if buffer.tell() >= self.buffer_size:
+                yield self._count_bytes(buffer.getvalue())
+
+                buffer.seek(0)
+                buffer.truncate()
+
+        yield self._count_bytes(buffer.getvalue())
 
-            yield f.getvalue()
+    @property
+    def format_name(self):
+        return type(self).__name__.replace('Serializer', '').lower()
+
+    def _count_bytes(self, block):
+        METRICS.inc(BYTES_TOTAL, len(block), {'format': self.format_name})
+        return block
 
     def _get_args(self, *args):
         data = args[0]
@@ -48,21 +84,27 @@ class GenericSerializer():
     def get_order_by_table(self):
         return None
 
+    def _get_serialize_args(self, data):
+        return {
+            'na_rep': self._get_value_from_dict('missing_code', data, default_value='NA'),
+        }
+
     @handle_http_errors
     def __call__(self, *args, **kwargs):
         data, code = self._get_args(*args)
-        missing_code = self._get_value_from_dict('missing_code', data, default_value='NA')
 
-        headers = self._get_value_from_dict('headers', kwargs, {})
+        headers = dict(self._get_value_from_dict('headers', kwargs, {}) or {})
 
         data_response = DataIterator(
             self.data_generator(
                 data['data'],
                 self.serialize,
-                na_rep=missing_code
+                **self._get_serialize_args(data)
             )
         )
 
+        data_response = compress_response(data_response, request.headers, headers)
+
         resp = Response(
             data_response,
             code
@@ -87,16 +129,146 @@ class BgenieSerializer(GenericSerializer):
 
 class Plink2Serializer(GenericSerializer):
     def serialize(self, data_frame, out_buffer, **kwargs):
+        # chunks are not used after being serialized, so they are modified in place instead of copied
         data_frame.index.name = 'FID'
-        data = data_frame.assign(IID=data_frame.index.values.copy())
 
-        columns = data.columns.tolist()
-        columns_reordered = ['IID'] + [c for c in columns if c != 'IID']
-        data = data.loc[:, columns_reordered]
+        if 'IID' in data_frame.columns:
+            data_frame['IID'] = data_frame.index.values
+            data_frame = data_frame.loc[:, ['IID'] + [c for c in data_frame.columns if c != 'IID']]
+        else:
+            data_frame.insert(0, 'IID', data_frame.index.values)
 
         kwargs['na_rep'] = 'NA'
 
-        data.to_csv(out_buffer, sep='\t', **kwargs)
+        data_frame.to_csv(out_buffer, sep='\t', **kwargs)
+
+
+class _StreamSink(object):
+    """
+    Write-only file object that keeps the data written until it is taken, while reporting the position in the
+    whole stream (needed by writers, like Parquet's, that compute offsets).
+    """
+
+    def __init__(self):
+        self.blocks = []
+        self.size = 0
+        self.position = 0
+        self.closed = False
+
+    def write(self, data):
+        data = bytes(data)
+
+        self.blocks.append(data)
+        self.size += len(data)
+        self.position += len(data)
+
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def take(self):
+        data = b''.join(self.blocks)
+
+        self.blocks = []
+        self.size = 0
+
+        return data
+
+
+class ArrowSerializer(GenericSerializer):
+    """
+    Arrow IPC stream, with one record batch for each chunk of data. Column types are taken from the fields
+    table (columns_types); other columns keep the type of the first chunk.
+    """
+    typed = True
+
+    def _get_arrow_type(self, field_type, series):
+        if field_type == 'Integer':
+            return pyarrow.int64()
+        elif field_type == 'Continuous':
+            return pyarrow.float64()
+        elif field_type in ('Date', 'Time'):
+            return pyarrow.timestamp('us')
+        elif field_type is not None or series.dtype == np.object_:
+            return pyarrow.string()
+
+        return pyarrow.from_numpy_dtype(series.dtype)
+
+    def _get_record_batch(self, data_frame, columns_types, schema=None):
+        data_frame = data_frame.reset_index()
+
+        arrays = []
+        for col_idx, col in enumerate(data_frame.columns):
+            if schema is not None:
+                col_type = schema[col_idx].type
+            elif col == 'eid':
+                col_type = pyarrow.int64()
+            else:
+                col_type = self._get_arrow_type(columns_types.get(col), data_frame[col])
+
+            # for instance, integers with missing values are read as floats
+            col_array = pyarrow.array(data_frame[col], from_pandas=True)
+            if col_array.type != col_type:
+                col_array = col_array.cast(col_type)
+
+            arrays.append(col_array)
+
+        return pyarrow.RecordBatch.from_arrays(arrays, [str(c) for c in data_frame.columns])
+
+    def _get_writer(self, sink, schema):
+        return pyarrow.RecordBatchStreamWriter(sink, schema)
+
+    def _write_batch(self, writer, record_batch):
+        writer.write_batch(record_batch)
+
+    def _get_serialize_args(self, data):
+        return {
+            'columns_types': self._get_value_from_dict('columns_types', data, default_value={}),
+        }
+
+    def data_generator(self, all_data, data_conversion_func, columns_types=None, **kwargs):
+        columns_types = columns_types if columns_types is not None else {}
+
+        sink = _StreamSink()
+        writer = None
+        schema = None
+
+        for data_frame in all_data:
+            with timed('serialize', format=self.format_name):
+                record_batch = self._get_record_batch(data_frame, columns_types, schema)
+
+                if writer is None:
+                    schema = record_batch.schema
+                    writer = self._get_writer(pyarrow.PythonFile(sink, mode='w'), schema)
+
+                self._write_batch(writer, record_batch)
+
+            if sink.size >= self.buffer_size:
+                yield self._count_bytes(sink.take())
+
+        if writer is not None:
+            writer.close()
+
+        yield self._count_bytes(sink.take())
+
+
+class ParquetSerializer(ArrowSerializer):
+    """
+    Parquet file, with one row group for each chunk of data.
+    """
+
+    def _get_writer(self, sink, schema):
+        return pyarrow.parquet.ParquetWriter(sink, schema)
+
+    def _write_batch(self, writer, record_batch):
+        writer.write_table(pyarrow.Table.from_batches([record_batch]))
 
 
 class JsonSerializer(GenericSerializer):
@@ -2,10 +2,11 @@ import os
 import json
 
 import werkzeug
-from flask import current_app as app, Response
+from flask import current_app as app, Response, request
 from flask_restful import Api
 
 from ukbrest.common.utils.datagen import get_temp_file_name
+from ukbrest.resources.compression import compress_response
 from ukbrest.resources.ukbrestapi import UkbRestAPI
 
 
@@ -60,8 +61,10 @@ def generate(file_path, file_mode='rb', delete=False):
 
 
 def output_bgen(bgen_filepath, code, headers=None):
-    resp = Response(generate(bgen_filepath, delete=True), code)
-    resp.headers.extend(headers or {})
+    headers = dict(headers or {})
+
+    resp = Response(compress_response(generate(bgen_filepath, delete=True), request.headers, headers), code)
+    resp.headers.extend(headers)
     return resp
 
 
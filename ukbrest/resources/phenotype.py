@@ -1,10 +1,13 @@
+import pandas as pd
 from ruamel.yaml import YAML
 from werkzeug.datastructures import FileStorage
-from flask_restful import current_app as app, Api
+from flask import request
+from flask_restful import current_app as app, Api, inputs
 
 from ukbrest.resources.exceptions import UkbRestValidationError
 from ukbrest.resources.ukbrestapi import UkbRestAPI
-from ukbrest.resources.formats import CSVSerializer, BgenieSerializer, Plink2Serializer, JsonSerializer
+from ukbrest.resources.formats import CSVSerializer, BgenieSerializer, Plink2Serializer, JsonSerializer, \
+    ArrowSerializer, ParquetSerializer, pyarrow
 
 
 PHENOTYPE_FORMATS = {
@@ -13,6 +16,13 @@ PHENOTYPE_FORMATS = {
     'text/bgenie': BgenieSerializer(),
 }
 
+# binary formats need pyarrow, which is optional
+if pyarrow is not None:
+    PHENOTYPE_FORMATS.update({
+        'application/vnd.apache.arrow.stream': ArrowSerializer(),
+        'application/parquet': ParquetSerializer(),
+    })
+
 
 class PhenotypeAPI(UkbRestAPI):
     def __init__(self, **kwargs):
@@ -32,12 +42,40 @@ class PhenotypeAPI(UkbRestAPI):
         if args.columns is None and args.ecolumns is None:
             raise UkbRestValidationError('You have to specify either columns or ecolumns')
 
-        data_results = self.pheno2sql.query(args.columns, args.ecolumns, args.filters)
+        typed = args.Accept in PHENOTYPE_FORMATS and PHENOTYPE_FORMATS[args.Accept].typed
 
-        return {
+        data_results = self.pheno2sql.query(args.columns, args.ecolumns, args.filters, format_integers=not typed)
+
+        final_results = {
             'data': data_results,
         }
 
+        if typed:
+            final_results['columns_types'] = self.pheno2sql.get_query_columns_types(args.columns, args.ecolumns)
+
+        return final_results
+
+
+class PhenotypeExplainAPI(UkbRestAPI):
+    def __init__(self, **kwargs):
+        super(PhenotypeExplainAPI, self).__init__()
+
+        self.parser.add_argument('columns', type=str, action='append', required=False, help='Columns to include')
+        self.parser.add_argument('ecolumns', type=str, action='append', required=False, help='Columns to include (with regular expressions)')
+        self.parser.add_argument('filters', type=str, action='append', required=False, help='Filters to include (AND)')
+
+        self.pheno2sql = app.config['pheno2sql']
+
+    def get(self):
+        args = self.parser.parse_args()
+
+        if args.columns is None and args.ecolumns is None:
+            raise UkbRestValidationError('You have to specify either columns or ecolumns')
+
+        return {
+            'data': self.pheno2sql.explain(args.columns, args.ecolumns, args.filters),
+        }
+
 
 class PhenotypeFieldsAPI(UkbRestAPI):
     def __init__(self, **kwargs):
@@ -46,15 +84,88 @@ class PhenotypeFieldsAPI(UkbRestAPI):
         self.pheno2sql = app.config['pheno2sql']
 
     def get(self):
-        self.pheno2sql.get_field_dtype()
+        data_results = self.pheno2sql.get_fields_catalog().get_column_names()
+
+        return {
+            'data': data_results,
+        }
+
+
+class CodingsAPI(UkbRestAPI):
+    def __init__(self, **kwargs):
+        super(CodingsAPI, self).__init__()
+
+        self.parser.add_argument('coding', type=str, action='append', required=False, help='Codings to include')
+        self.parser.add_argument('descendants', type=inputs.boolean, required=False, default=False,
+                                 help='Include all codings under the ones specified')
+
+        self.pheno2sql = app.config['pheno2sql']
+
+    def get(self, data_coding):
+        args = self.parser.parse_args()
 
-        data_results = [k for k, v in self.pheno2sql._fields_dtypes.items()]
+        if args.descendants and not args.coding:
+            raise UkbRestValidationError('You must specify at least one coding to get its descendants')
+
+        codings = self.pheno2sql.get_codings(data_coding, args.coding, args.descendants)
+
+        data_results = []
+        for row in codings.itertuples(index=False):
+            item = {
+                'coding': row.coding,
+                'meaning': row.meaning,
+                'node_id': int(row.node_id) if not pd.isnull(row.node_id) else None,
+                'parent_id': int(row.parent_id) if not pd.isnull(row.parent_id) else None,
+                'selectable': bool(row.selectable) if not pd.isnull(row.selectable) else None,
+            }
+
+            if args.descendants:
+                item['ancestor_coding'] = row.ancestor_coding
+                item['depth'] = int(row.depth)
+
+            data_results.append(item)
 
         return {
             'data': data_results,
         }
 
 
+class PhenotypeFieldsCatalogAPI(UkbRestAPI):
+    def __init__(self, **kwargs):
+        super(PhenotypeFieldsCatalogAPI, self).__init__()
+
+        self.parser.add_argument('prefix', type=str, required=False, help='Column name prefix')
+        self.parser.add_argument('regex', type=str, required=False, help='Regular expression for the column name')
+        self.parser.add_argument('q', type=str, required=False, help='Text to search in the description')
+        self.parser.add_argument('type', type=str, required=False, help='Field type')
+        self.parser.add_argument('coding', type=int, required=False, help='Data-coding')
+        self.parser.add_argument('instance', type=int, required=False, help='Instance number')
+        self.parser.add_argument('field_id', type=str, required=False, help='Field id')
+        self.parser.add_argument('offset', type=int, required=False, default=0, help='Number of fields to skip')
+        self.parser.add_argument('limit', type=int, required=False, default=100, help='Maximum number of fields')
+
+        self.pheno2sql = app.config['pheno2sql']
+
+    def get(self):
+        args = self.parser.parse_args()
+
+        search_args = {k: v for k, v in args.items()}
+        catalog = self.pheno2sql.get_fields_catalog()
+
+        etag = catalog.get_etag(**search_args)
+        headers = {'ETag': '"{}"'.format(etag)}
+
+        if etag in [t.strip().strip('"') for t in (request.headers.get('If-None-Match') or '').split(',')]:
+            return {'data': []}, 304, headers
+
+        n_total, data_results = catalog.search(**search_args)
+        headers['X-Total-Count'] = str(n_total)
+
+        return {
+            'data': data_results,
+        }, 200, headers
+
+
 class QueryAPI(UkbRestAPI):
     def __init__(self, **kwargs):
         super(QueryAPI, self).__init__()
@@ -73,26 +184,53 @@ class QueryAPI(UkbRestAPI):
         yaml = YAML(typ='safe')
 
         order_by_table = None
+        typed = False
         if args.Accept in PHENOTYPE_FORMATS:
             serializer = PHENOTYPE_FORMATS[args.Accept]
             order_by_table = serializer.get_order_by_table()
+            typed = serializer.typed
+
+        yaml_file = yaml.load(args.file)
 
         data_results = self.pheno2sql.query_yaml(
-            yaml.load(args.file),
+            yaml_file,
             args.section,
-            order_by_table=order_by_table
+            order_by_table=order_by_table,
+            format_integers=not typed,
         )
 
         final_results = {
             'data': data_results,
         }
 
+        if typed:
+            final_results['columns_types'] = self.pheno2sql.get_yaml_columns_types(yaml_file, args.section)
+
         if args.missing_code is not None:
             final_results['missing_code'] = args.missing_code
 
         return final_results
 
 
+class QueryExplainAPI(UkbRestAPI):
+    def __init__(self, **kwargs):
+        super(QueryExplainAPI, self).__init__()
+
+        self.parser.add_argument('file', type=FileStorage, location='files', required=True)
+        self.parser.add_argument('section', type=str, required=True)
+
+        self.pheno2sql = app.config['pheno2sql']
+
+    def post(self):
+        args = self.parser.parse_args()
+
+        yaml = YAML(typ='safe')
+
+        return {
+            'data': self.pheno2sql.explain_yaml(yaml.load(args.file), args.section),
+        }
+
+
 class PhenotypeApiObject(Api):
     def __init__(self, app, default_mediatype='text/plink2'):
         super(PhenotypeApiObject, self).__init__(app, default_mediatype=default_mediatype)
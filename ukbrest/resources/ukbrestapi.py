@@ -1,8 +1,32 @@
+import time
+from functools import wraps
+
+from flask import g
 from flask_restful import Resource, reqparse, current_app as app
 
+from ukbrest.common.utils.metrics import record_stage
 from ukbrest.resources.error_handling import handle_http_errors
 
 
+def _login_required_timed(auth, method):
+    """
+    Like auth.login_required, but records the time spent authenticating the request.
+    """
+    @wraps(method)
+    def authenticated_method(*args, **kwargs):
+        record_stage('auth', time.perf_counter() - g.ukbrest_auth_start)
+        return method(*args, **kwargs)
+
+    protected_method = auth.login_required(authenticated_method)
+
+    @wraps(method)
+    def timed_method(*args, **kwargs):
+        g.ukbrest_auth_start = time.perf_counter()
+        return protected_method(*args, **kwargs)
+
+    return timed_method
+
+
 class UkbRestAPI(Resource):
     HTTP_METHODS = ('get', 'post')
 
@@ -20,4 +44,4 @@ class UkbRestAPI(Resource):
 
             for met in UkbRestAPI.HTTP_METHODS:
                 if met in dir(self):
-                    setattr(self, met, auth.login_required(getattr(self, met)))
+                    setattr(self, met, _login_required_timed(auth, getattr(self, met)))
@@ -3,6 +3,7 @@ from ukbrest.app import app
 from ukbrest.common.genoquery import GenoQuery
 from ukbrest.common.pheno2sql import Pheno2SQL
 from ukbrest.common.utils.auth import PasswordHasher
+from ukbrest.common.utils.db import prewarm_db_engine
 
 
 def setup_app(app, ph):
@@ -14,6 +15,10 @@ def setup_app(app, ph):
     p2sql = Pheno2SQL(**config.get_pheno2sql_parameters())
     app.config.update({'pheno2sql': p2sql})
 
+    # each worker opens its connections when it starts, instead of on the first requests
+    if int(config.db_pool_prewarm) > 0:
+        prewarm_db_engine(p2sql._get_db_uri(), int(config.db_pool_prewarm), **config.get_db_pool_parameters())
+
     # Add auth object
     auth = ph.setup_http_basic_auth()
     app.config.update({'auth': auth})